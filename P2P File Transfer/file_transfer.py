@@ -1,90 +1,61 @@
+import time
+_STARTED = time.perf_counter()  # Origin of the startup timing report
+
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from tkinterdnd2 import DND_FILES, TkinterDnD
-import socket
-import ssl
+import io
 import os
-import hashlib
+import sys
 import threading
-import time
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography import x509
-from cryptography.x509.oid import NameOID
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-import datetime
-import json
-from datetime import datetime, timedelta
-import queue
-from cryptography.fernet import Fernet
-import base64
+from datetime import datetime
+
+from p2pft.dedup import CHUNK_STORE_MAX_SIZE
+from p2pft.engine import DEFAULT_PORT, RATE_LIMIT_BYTES, format_size, local_ip, parse_connection_code
+from p2pft.discovery import Discovery
+from p2pft.identity import (
+    DEFAULT_KEY_TYPE, fingerprint_matches, generate_certificates, get_cert_fingerprint, is_legacy_identity,
+    rotate_identity,
+)
+from p2pft.metrics import MetricsRecorder
+from p2pft.probe import PeerProber
+from p2pft.scheduler import DEFAULT_PRIORITY, MAX_CONCURRENT_TRANSFERS, PRIORITIES, TransferScheduler
+from p2pft.settings import SecureSettings
 
 # Configuration
-BUFFER_SIZE = 4096
-DEFAULT_PORT = 8443
-CERT_EXPIRY_DAYS = 365
-RATE_LIMIT_BYTES = 1024 * 1024 * 10  # 10 MB/s
-TRANSFER_TIMEOUT = 30  # seconds
-MAX_RETRIES = 3
-
-class RateLimiter:
-    def __init__(self, rate_limit_bytes):
-        self.rate_limit = rate_limit_bytes
-        self.transferred = 0
-        self.last_check = time.time()
-
-    def can_transfer(self, bytes_count):
-        current_time = time.time()
-        time_passed = current_time - self.last_check
-        
-        if time_passed >= 1.0:
-            self.transferred = 0
-            self.last_check = current_time
-        
-        if self.transferred + bytes_count <= self.rate_limit:
-            self.transferred += bytes_count
-            return True
-        return False
-
-class SecureSettings:
-    def __init__(self):
-        self.key = self._get_or_create_key()
-        self.cipher = Fernet(self.key)
-    
-    def _get_or_create_key(self):
-        key_file = "settings.key"
-        if os.path.exists(key_file):
-            with open(key_file, "rb") as f:
-                return f.read()
-        else:
-            key = Fernet.generate_key()
-            with open(key_file, "wb") as f:
-                f.write(key)
-            return key
-    
-    def save_settings(self, data):
-        encrypted = self.cipher.encrypt(json.dumps(data).encode())
-        with open("settings.enc", "wb") as f:
-            f.write(encrypted)
-    
-    def load_settings(self):
-        try:
-            with open("settings.enc", "rb") as f:
-                encrypted = f.read()
-            decrypted = self.cipher.decrypt(encrypted)
-            return json.loads(decrypted)
-        except Exception:
-            return {}
+PROGRESS_INTERVAL_MS = 100  # How often the UI redraws transfer progress
+STARTUP_TIMING = os.environ.get("P2PFT_STARTUP_TIMING")  # Print the startup timing report to stderr when set
+HISTORY_PAGE_SIZE = 100  # Transfers the history view holds at a time
+SEARCH_DELAY_MS = 250  # Pause in typing before the history search runs
+PEER_POLL_MS = 1000  # How often the UI collects LAN announcements and probe results; PeerProber decides when to probe
+QUEUE_REFRESH_MS = 500  # How often the queue tab redraws the state and progress of transfers
+
+def peer_address(peer):
+    return peer["ip"], int(peer["port"])
+
+def render_qr_code(data):
+    """PNG image of a QR code for data, or None without the qrcode and Pillow packages"""
+    try:
+        import qrcode
+        qr = qrcode.QRCode(version=1, box_size=10, border=5)
+        qr.add_data(data)
+        qr.make(fit=True)
+        img = qr.make_image(fill_color="black", back_color="white")
+    except ImportError:
+        return None
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
 
 class FileTransferApp:
     def __init__(self):
-        self.root = TkinterDnD.Tk()
+        self.startup_marks = [("imports", time.perf_counter())]
+        self.root = tk.Tk()
         self.root.title("Secure P2P File Transfer")
         self.root.geometry("700x500")
         
         # Initialize file paths
         self.file_path = None
+        self.file_paths = []
         self.save_path = None
         
         # Use a native Windows theme if available
@@ -94,23 +65,30 @@ class FileTransferApp:
         except Exception:
             self.style.theme_use("clam")
         
-        self.transfer_active = False
+        self.transfer_active = threading.Event()  # Cleared while transfers are paused
+        self.scheduler = None  # Runs every transfer, sharing one rate limit; created in finish_startup()
+        self.peer_prober = PeerProber()  # Decides whether saved peers are online
+        self.discovery = None  # Started in finish_startup()
+        self.announced = {}  # Port -> offer names of the running sends announced on the LAN
+        self.code_port = None  # Port of the send the connection code points at, None while none is listening
+        self.local_address = None  # Looked up off the UI thread by build_connection_code()
+        self.nearby_peers = {}  # Tree row -> peer announced on the LAN
+        self.heard_fingerprints = set()  # Fingerprints in the latest round of announcements
         self.current_progress = 0
-        self.transfer_history = []
-        self.secure_settings = SecureSettings()
+        self.secure_settings = None  # Opened in finish_startup(), once the window is up
+        self.metrics_recorder = MetricsRecorder()
         
         # Generate certificates BEFORE UI creation
-        self.generate_certificates()
+        generate_certificates()
         
         # Now create the UI components
         self.create_widgets()
+        self.startup_marks.append(("widgets", time.perf_counter()))
         
         # Create a status bar for feedback
         self.status_var = tk.StringVar(value="Ready")
         self.status_bar = ttk.Label(self.root, textvariable=self.status_var, relief="sunken", anchor="w")
         self.status_bar.pack(side="bottom", fill="x", padx=2, pady=2)
-        
-        self.load_saved_settings()
 
         # Create custom styles for progress bars
         self.style.configure("Red.Horizontal.TProgressbar", 
@@ -134,9 +112,70 @@ class FileTransferApp:
         )
         self.connection_status.pack(side="left")
         
+        # Everything slow waits until the window has been drawn
+        self.root.bind("<Map>", self.on_first_map)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def on_close(self):
+        if self.discovery:
+            self.discovery.close()  # Tells the other nodes right away instead of letting them time out
+        self.root.destroy()
+
+    def on_first_map(self, event):
+        if event.widget is not self.root:
+            return
+        self.root.unbind("<Map>")
+        self.startup_marks.append(("first paint", time.perf_counter()))
+        self.root.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        """Load what the first paint does not need: settings, peers, history and drag and drop"""
+        self.secure_settings = SecureSettings()
+        self.scheduler = TransferScheduler(
+            self.secure_settings, rate_limit_bytes=RATE_LIMIT_BYTES, resume_event=self.transfer_active,
+            on_change=lambda job: self.root.after(0, self.refresh_queue),
+            on_finish=self.job_finished,
+            on_error=lambda job, err: self.root.after(0, self.show_job_error, job, err))
+        self.load_saved_settings()
+        self.load_saved_peers()
+        self.load_history()
+        self.refresh_connection_code(announce=False)
+        self.start_discovery()
+        self.scheduler.start()  # Picks up transfers still queued when the app last closed
+        self.watch_queue()
+        self.enable_drag_and_drop()
+        if is_legacy_identity():
+            self.status_var.set("This node still uses a legacy RSA identity; "
+                                "Settings > New Identity replaces it")
+        self.startup_marks.append(("ready", time.perf_counter()))
+        if STARTUP_TIMING:
+            report = ", ".join(f"{name} {(mark - _STARTED) * 1000:.0f} ms" for name, mark in self.startup_marks)
+            print(f"Startup: {report}", file=sys.stderr)
+        
         # Set up a periodic check for peer availability
         self.root.after(1000, self.check_peer_availability)
 
+    def enable_drag_and_drop(self):
+        """Load tkdnd into the running Tk; it is slow to load, so the window does not wait for it"""
+        try:
+            from tkinterdnd2 import DND_FILES, TkinterDnD
+            TkinterDnD._require(self.root)
+        except (ImportError, RuntimeError):
+            self.drop_frame.config(text="Drag & Drop unavailable")
+            return
+        self.drop_frame.drop_target_register(DND_FILES)
+        self.drop_frame.dnd_bind('<<Drop>>', self.handle_drop)
+
+    def start_discovery(self):
+        """Listen for the other nodes on the LAN; running sends are announced by update_announcements()"""
+        discovery = Discovery(get_cert_fingerprint())
+        try:
+            discovery.start()
+        except OSError as e:
+            self.status_var.set(f"LAN discovery unavailable: {e}")
+            return
+        self.discovery = discovery
+
     def create_widgets(self):
         self.notebook = ttk.Notebook(self.root)
         
@@ -156,6 +195,10 @@ class FileTransferApp:
         settings_frame = ttk.Frame(self.notebook, padding=10)
         self.create_settings_ui(settings_frame)
         
+        # Queue Tab
+        queue_frame = ttk.Frame(self.notebook, padding=10)
+        self.create_queue_tab(queue_frame)
+        
         # History Tab
         history_frame = ttk.Frame(self.notebook, padding=10)
         self.create_history_tab(history_frame)
@@ -164,6 +207,7 @@ class FileTransferApp:
         self.notebook.add(sender_frame, text="Sender")
         self.notebook.add(receiver_frame, text="Receiver")
         self.notebook.add(settings_frame, text="Settings")
+        self.notebook.add(queue_frame, text="Queue")
         self.notebook.add(history_frame, text="History")
         
         self.notebook.pack(expand=True, fill="both", padx=5, pady=5)
@@ -174,41 +218,20 @@ class FileTransferApp:
         connection_frame = ttk.LabelFrame(parent, text="Your Connection Info", padding=10)
         connection_frame.grid(row=0, column=0, padx=5, pady=10, sticky="nsew", columnspan=2)
         
-        # Get and display connection code
-        self.connection_code = self.generate_connection_code()
+        # Display the connection code of the latest running send, filled in by refresh_connection_code()
+        self.connection_code = None
         code_frame = ttk.Frame(connection_frame)
         code_frame.pack(fill="x", expand=True, pady=10)
         
-        self.code_display = ttk.Label(code_frame, text=self.connection_code, font=("Arial", 16))
+        self.code_display = ttk.Label(code_frame, text="Looking up address...", font=("Arial", 16))
         self.code_display.pack(side="left", padx=10)
         
         ttk.Button(code_frame, text="Copy", command=self.copy_connection_code).pack(side="left", padx=5)
         ttk.Button(code_frame, text="Refresh", command=self.refresh_connection_code).pack(side="left")
         
-        # Show QR code for mobile scanning
-        try:
-            import qrcode
-            from PIL import ImageTk, Image
-            import io
-            
-            # Generate QR code for connection info
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            connection_info = f"p2pft://{self.connection_code}"
-            qr.add_data(connection_info)
-            qr.make(fit=True)
-            
-            img = qr.make_image(fill_color="black", back_color="white")
-            buffer = io.BytesIO()
-            img.save(buffer, format="PNG")
-            buffer.seek(0)
-            
-            # Convert to PhotoImage and display
-            qr_image = ImageTk.PhotoImage(Image.open(buffer))
-            qr_label = ttk.Label(connection_frame, image=qr_image)
-            qr_label.image = qr_image  # Keep a reference
-            qr_label.pack(pady=10)
-        except ImportError:
-            ttk.Label(connection_frame, text="Install qrcode and Pillow packages for QR code generation").pack(pady=10)
+        # Show QR code for mobile scanning, once it has been rendered
+        self.qr_label = ttk.Label(connection_frame)
+        self.qr_label.pack(pady=10)
         
         # Connect to peer section
         connect_to_frame = ttk.LabelFrame(parent, text="Connect to Peer", padding=10)
@@ -230,7 +253,7 @@ class FileTransferApp:
         
         # Saved peers section
         peers_frame = ttk.LabelFrame(parent, text="Saved Peers", padding=10)
-        peers_frame.grid(row=2, column=0, padx=5, pady=10, sticky="nsew", columnspan=2)
+        peers_frame.grid(row=2, column=0, padx=5, pady=10, sticky="nsew")
         
         # Create a treeview to display saved peers
         columns = ("name", "last_connected", "status")
@@ -254,41 +277,80 @@ class FileTransferApp:
         ttk.Button(peers_button_frame, text="Remove", command=self.remove_selected_peer).pack(side="left", padx=5)
         ttk.Button(peers_button_frame, text="Add New", command=self.add_new_peer).pack(side="left", padx=5)
         
+        # Peers announcing themselves on the LAN, kept current by check_peer_availability()
+        nearby_frame = ttk.LabelFrame(parent, text="Nearby Peers", padding=10)
+        nearby_frame.grid(row=2, column=1, padx=5, pady=10, sticky="nsew")
+        
+        columns = ("name", "address", "offers")
+        self.nearby_tree = ttk.Treeview(nearby_frame, columns=columns, show="headings", height=5)
+        
+        self.nearby_tree.heading("name", text="Name")
+        self.nearby_tree.heading("address", text="Address")
+        self.nearby_tree.heading("offers", text="Offers")
+        
+        self.nearby_tree.column("name", width=100)
+        self.nearby_tree.column("address", width=120)
+        self.nearby_tree.column("offers", width=150)
+        
+        self.nearby_tree.pack(fill="both", expand=True, pady=5)
+        self.nearby_tree.bind("<Double-1>", lambda event: self.connect_to_nearby_peer())
+        
+        nearby_button_frame = ttk.Frame(nearby_frame)
+        nearby_button_frame.pack(fill="x", pady=5)
+        
+        ttk.Button(nearby_button_frame, text="Connect", command=self.connect_to_nearby_peer).pack(side="left", padx=5)
+        ttk.Button(nearby_button_frame, text="Save", command=self.save_nearby_peer).pack(side="left", padx=5)
+        
         # Configure grid weights
         parent.columnconfigure(0, weight=1)
+        parent.columnconfigure(1, weight=1)
         parent.rowconfigure(2, weight=1)
-        
-        # Load saved peers
-        self.load_saved_peers()
 
-    def generate_connection_code(self):
-        """Generate a user-friendly connection code containing IP and fingerprint"""
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            local_ip = s.getsockname()[0]
-        except Exception:
-            local_ip = "127.0.0.1"
-        finally:
-            s.close()
-        
+    def generate_connection_code(self, ip, port):
+        """Generate a user-friendly connection code containing IP, port and fingerprint"""
         # Get first 8 characters of fingerprint for shorter code
-        short_fingerprint = self.get_cert_fingerprint()[:8]
+        short_fingerprint = get_cert_fingerprint()[:8]
         
         # Combine IP, port and shortened fingerprint into connection code
-        return f"{local_ip}:{DEFAULT_PORT}:{short_fingerprint}"
+        return f"{ip}:{port}:{short_fingerprint}"
 
     def copy_connection_code(self):
         """Copy connection code to clipboard"""
+        if not self.connection_code:
+            self.status_var.set("Start a transfer to get a connection code")
+            return
         self.root.clipboard_clear()
         self.root.clipboard_append(self.connection_code)
         self.status_var.set("Connection code copied to clipboard!")
 
-    def refresh_connection_code(self):
-        """Refresh the connection code"""
-        self.connection_code = self.generate_connection_code()
-        self.code_display.config(text=self.connection_code)
-        self.status_var.set("Connection code refreshed")
+    def refresh_connection_code(self, announce=True):
+        """Refresh the connection code and its QR code in the background"""
+        threading.Thread(target=self.build_connection_code, args=(self.code_port, announce), daemon=True).start()
+
+    def build_connection_code(self, port, announce):
+        # Looking up the local address and rendering the QR code both stay off the UI thread
+        ip = local_ip()
+        code = self.generate_connection_code(ip, port) if port else None
+        qr_png = render_qr_code(f"p2pft://{code}") if code else None
+        self.root.after(0, self.show_connection_code, ip, port, code, qr_png, announce)
+
+    def show_connection_code(self, ip, port, code, qr_png, announce):
+        self.local_address = ip
+        if port != self.code_port:
+            return  # A newer refresh is on its way
+        self.connection_code = code
+        if code is None:
+            self.code_display.config(text="Start a transfer to get a connection code")
+            self.qr_label.config(image="", text="")
+            self.qr_label.image = None
+        elif qr_png is None:
+            self.qr_label.config(text="Install qrcode and Pillow packages for QR code generation")
+        else:
+            qr_image = tk.PhotoImage(data=qr_png)
+            self.qr_label.config(image=qr_image)
+            self.qr_label.image = qr_image  # Keep a reference
+        if announce:
+            self.status_var.set("Connection code refreshed")
 
     def connect_to_peer(self):
         """Connect to a peer using their connection code"""
@@ -298,12 +360,7 @@ class FileTransferApp:
             return
         
         try:
-            parts = code.split(":")
-            if len(parts) != 3:
-                raise ValueError("Invalid connection code format")
-            
-            ip, port, fingerprint = parts
-            port = int(port)
+            ip, port, fingerprint = parse_connection_code(code)
             
             # Set values in receiver tab
             self.sender_ip.delete(0, tk.END)
@@ -323,34 +380,14 @@ class FileTransferApp:
             messagebox.showerror("Invalid Connection Code", str(e))
 
     def save_peer(self, name, ip, port, fingerprint):
-        """Save a peer to the peers list"""
-        settings = self.secure_settings.load_settings()
-        peers = settings.get("saved_peers", [])
-        
-        # Check if peer already exists by name
-        for i, peer in enumerate(peers):
-            if peer["name"] == name:
-                # Update existing peer
-                peers[i] = {
-                    "name": name,
-                    "ip": ip,
-                    "port": port,
-                    "fingerprint": fingerprint,
-                    "last_connected": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
-                break
-        else:
-            # Add new peer
-            peers.append({
-                "name": name,
-                "ip": ip,
-                "port": port,
-                "fingerprint": fingerprint,
-                "last_connected": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
-        
-        settings["saved_peers"] = peers
-        self.secure_settings.save_settings(settings)
+        """Save a peer to the peers list, replacing any peer of the same name"""
+        self.secure_settings.save_peer({
+            "name": name,
+            "ip": ip,
+            "port": port,
+            "fingerprint": fingerprint,
+            "last_connected": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
         self.load_saved_peers()  # Refresh the list
 
     def load_saved_peers(self):
@@ -358,15 +395,12 @@ class FileTransferApp:
         # Clear existing entries
         self.peers_tree.delete(*self.peers_tree.get_children())
         
-        # Load from settings
-        settings = self.secure_settings.load_settings()
-        peers = settings.get("saved_peers", [])
-        
-        for peer in peers:
-            self.peers_tree.insert("", "end", values=(
+        for peer in self.secure_settings.peers():
+            # Keyed by name, so probe results can find their row
+            self.peers_tree.insert("", "end", iid=peer["name"], values=(
                 peer["name"],
                 peer.get("last_connected", "Never"),
-                "Offline"  # Default status
+                "Online" if self.peer_heard(peer) or self.peer_prober.status(peer_address(peer)) else "Offline"
             ))
 
     def connect_to_selected_peer(self):
@@ -379,9 +413,58 @@ class FileTransferApp:
         # Get the name of the selected peer
         peer_name = self.peers_tree.item(selected[0])["values"][0]
         
-        # Find the peer in settings
-        settings = self.secure_settings.load_settings()
-        peers = settings.get("saved_peers", [])
+        # Find the peer in settings and fill in the receiver tab
+        peer = self.secure_settings.peer(str(peer_name))
+        if peer is None:
+            return
+        self.fill_receiver_tab(peer["ip"], peer["port"], peer["fingerprint"])
+        self.status_var.set(f"Ready to connect to {peer_name}")
+
+    def fill_receiver_tab(self, ip, port, fingerprint):
+        """Enter a peer's address and fingerprint in the receiver tab and switch to it"""
+        self.sender_ip.delete(0, tk.END)
+        self.sender_ip.insert(0, ip)
+        self.port.delete(0, tk.END)
+        self.port.insert(0, str(port))
+        self.fingerprint.delete(0, tk.END)
+        self.fingerprint.insert(0, fingerprint)
+        self.notebook.select(2)  # Index of receiver tab
+
+    def show_nearby_peers(self, peers):
+        """Bring the nearby peers list in line with the latest announcements"""
+        rows = {f"{peer['fingerprint']}:{peer['port']}": peer for peer in peers}
+        for row in self.nearby_tree.get_children():
+            if row not in rows:
+                self.nearby_tree.delete(row)
+        for row, peer in rows.items():
+            offers = ", ".join(peer["offers"])
+            if peer["offer_count"] > len(peer["offers"]):
+                offers += f" and {peer['offer_count'] - len(peer['offers'])} more"
+            values = (peer["name"], f"{peer['host']}:{peer['port']}", offers)
+            if not self.nearby_tree.exists(row):
+                self.nearby_tree.insert("", "end", iid=row, values=values)
+            elif self.nearby_peers.get(row) != peer:
+                self.nearby_tree.item(row, values=values)
+        self.nearby_peers = rows
+
+    def selected_nearby_peer(self):
+        selected = self.nearby_tree.selection()
+        if not selected or selected[0] not in self.nearby_peers:
+            messagebox.showinfo("Selection Required", "Please select a nearby peer")
+            return None
+        return self.nearby_peers[selected[0]]
+
+    def connect_to_nearby_peer(self):
+        peer = self.selected_nearby_peer()
+        if peer:
+            self.fill_receiver_tab(peer["host"], peer["port"], peer["fingerprint"])
+            self.status_var.set(f"Ready to connect to {peer['name']}")
+
+    def save_nearby_peer(self):
+        peer = self.selected_nearby_peer()
+        if peer:
+            self.save_peer(peer["name"], peer["host"], peer["port"], peer["fingerprint"])
+            self.status_var.set(f"Saved {peer['name']}")
 
     def remove_selected_peer(self):
         """Remove the selected peer from the saved peers list"""
@@ -397,16 +480,8 @@ class FileTransferApp:
         if not messagebox.askyesno("Confirm Deletion", f"Are you sure you want to remove '{peer_name}'?"):
             return
         
-        # Find the peer in settings and remove it
-        settings = self.secure_settings.load_settings()
-        peers = settings.get("saved_peers", [])
-        
-        # Filter out the selected peer
-        peers = [peer for peer in peers if peer["name"] != peer_name]
-        
-        # Update settings
-        settings["saved_peers"] = peers
-        self.secure_settings.save_settings(settings)
+        # Remove it from settings
+        self.secure_settings.remove_peer(str(peer_name))
         
         # Refresh the list
         self.load_saved_peers()
@@ -485,8 +560,10 @@ class FileTransferApp:
             .grid(row=0, column=0, padx=5, pady=5, sticky="w")
         ttk.Button(parent, text="Select Multiple", command=self.select_multiple_files)\
             .grid(row=0, column=1, padx=5, pady=5, sticky="w")
+        ttk.Button(parent, text="Select Folder", command=self.select_folder)\
+            .grid(row=0, column=2, padx=5, pady=5, sticky="w")
         self.selected_file_label = ttk.Label(parent, text="No file selected")
-        self.selected_file_label.grid(row=0, column=2, padx=5, pady=5, sticky="w")
+        self.selected_file_label.grid(row=0, column=3, padx=5, pady=5, sticky="w")
         
         ttk.Label(parent, text="Connection Info:")\
             .grid(row=1, column=0, columnspan=2, pady=5, sticky="w")
@@ -497,14 +574,17 @@ class FileTransferApp:
         self.progress.grid(row=3, column=0, columnspan=2, pady=10)
         self.eta_label = ttk.Label(parent, text="ETA: 0s")
         self.eta_label.grid(row=4, column=0, padx=5, pady=5, sticky="w")
-        ttk.Button(parent, text="Start Transfer", command=self.start_sender)\
-            .grid(row=4, column=1, padx=5, pady=5, sticky="e")
+        start_frame = ttk.Frame(parent)
+        start_frame.grid(row=4, column=1, padx=5, pady=5, sticky="e")
+        ttk.Label(start_frame, text="Priority:").pack(side="left")
+        self.send_priority_var = tk.StringVar(value=PRIORITIES[DEFAULT_PRIORITY])
+        ttk.Combobox(start_frame, textvariable=self.send_priority_var, values=PRIORITIES, state="readonly",
+                     width=8).pack(side="left", padx=5)
+        ttk.Button(start_frame, text="Start Transfer", command=self.start_sender).pack(side="left")
         
         # Drop files frame with a sunken border to hint drag/drop area
         self.drop_frame = ttk.LabelFrame(parent, text="➕ \nDrag & Drop Here", padding=10)
         self.drop_frame.grid(row=5, column=0, columnspan=2, pady=10, sticky="nsew")
-        self.drop_frame.drop_target_register(DND_FILES)
-        self.drop_frame.dnd_bind('<<Drop>>', self.handle_drop)
         
         self.pause_button = ttk.Button(parent, text="Pause", command=self.toggle_pause)
         self.pause_button.grid(row=6, column=0, padx=5, pady=5, sticky="w")
@@ -555,8 +635,13 @@ class FileTransferApp:
         
         self.receiver_progress = ttk.Progressbar(parent, orient="horizontal", length=300, mode="determinate")
         self.receiver_progress.grid(row=4, column=0, columnspan=2, padx=5, pady=10)
-        ttk.Button(parent, text="Start Receive", command=self.start_receiver)\
-            .grid(row=5, column=0, columnspan=2, padx=5, pady=10)
+        start_frame = ttk.Frame(parent)
+        start_frame.grid(row=5, column=0, columnspan=2, padx=5, pady=10)
+        ttk.Label(start_frame, text="Priority:").pack(side="left")
+        self.receive_priority_var = tk.StringVar(value=PRIORITIES[DEFAULT_PRIORITY])
+        ttk.Combobox(start_frame, textvariable=self.receive_priority_var, values=PRIORITIES, state="readonly",
+                     width=8).pack(side="left", padx=5)
+        ttk.Button(start_frame, text="Start Receive", command=self.start_receiver).pack(side="left")
         
         parent.columnconfigure(1, weight=1)
 
@@ -578,7 +663,30 @@ class FileTransferApp:
         # Rate limit
         ttk.Label(transfer_frame, text="Rate Limit (MB/s):").grid(row=0, column=0, sticky="w", padx=5, pady=5)
         self.rate_limit_var = tk.StringVar(value="10")
-        ttk.Spinbox(transfer_frame, from_=1, to=100, textvariable=self.rate_limit_var, width=5).grid(row=0, column=1, sticky="w", padx=5, pady=5)
+        self.rate_limit_var.trace_add("write", self.apply_rate_limit)
+        ttk.Spinbox(transfer_frame, from_=0, to=100, textvariable=self.rate_limit_var, width=5).grid(row=0, column=1, sticky="w", padx=5, pady=5)
+        ttk.Label(transfer_frame, text="(0 = unlimited)").grid(row=0, column=2, sticky="w", padx=5, pady=5)
+        
+        # Delta sync
+        self.delta_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(transfer_frame, text="Only send changes to files the receiver already has", variable=self.delta_var).grid(row=1, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        
+        # Chunk dedup across transfers
+        self.dedup_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(transfer_frame, text="Skip chunks the receiver already has from earlier transfers", variable=self.dedup_var).grid(row=2, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        ttk.Label(transfer_frame, text="Chunk Cache Size (GB):").grid(row=3, column=0, sticky="w", padx=5, pady=5)
+        self.cache_size_var = tk.StringVar(value="1")
+        ttk.Spinbox(transfer_frame, from_=0, to=1000, textvariable=self.cache_size_var, width=5).grid(row=3, column=1, sticky="w", padx=5, pady=5)
+        
+        # Archive streaming for folders of many small files
+        self.archive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(transfer_frame, text="Stream folders as one archive (fastest for many small files, replaces the two options above)", variable=self.archive_var).grid(row=4, column=0, columnspan=3, sticky="w", padx=5, pady=5)
+        
+        # Transfers running at once; the rest wait in the queue
+        ttk.Label(transfer_frame, text="Max Concurrent Transfers:").grid(row=5, column=0, sticky="w", padx=5, pady=5)
+        self.max_concurrent_var = tk.StringVar(value=str(MAX_CONCURRENT_TRANSFERS))
+        self.max_concurrent_var.trace_add("write", self.apply_max_concurrent)
+        ttk.Spinbox(transfer_frame, from_=1, to=20, textvariable=self.max_concurrent_var, width=5).grid(row=5, column=1, sticky="w", padx=5, pady=5)
         
         # Security settings
         security_frame = ttk.LabelFrame(parent, text="Security Settings", padding=10)
@@ -592,12 +700,51 @@ class FileTransferApp:
         self.compression_var = tk.BooleanVar(value=False)
         ttk.Checkbutton(security_frame, text="Enable compression", variable=self.compression_var).grid(row=1, column=0, sticky="w", padx=5, pady=5)
         
+        # Replace this node's identity, e.g. a legacy RSA one
+        ttk.Button(security_frame, text="New Identity...", command=self.new_identity).grid(row=2, column=0, sticky="w", padx=5, pady=5)
+        
         # Save button
         ttk.Button(parent, text="Save Settings", command=self.save_settings).grid(row=3, column=0, pady=15)
         
         # Configure grid weights
         parent.columnconfigure(0, weight=1)
 
+    def new_identity(self):
+        """Replace this node's certificate with a new one after the user confirms the fingerprint change"""
+        if any(job.state == "running" for job in self.scheduler.jobs()):
+            messagebox.showerror("Error", "Wait for the running transfers to finish first")
+            return
+        if not messagebox.askyesno(
+                "New Identity",
+                f"Generate a new {DEFAULT_KEY_TYPE.upper()} identity?\n\nThis changes your fingerprint. "
+                "Peers that saved the current one will refuse to connect until they are given the new one."):
+            return
+        old_fingerprint, fingerprint = rotate_identity()
+        if self.discovery:
+            self.discovery.fingerprint = fingerprint
+        self.refresh_connection_code(announce=False)
+        self.show_connection_info()
+        messagebox.showinfo("New Identity", f"Old fingerprint: {old_fingerprint}\n\nNew fingerprint: {fingerprint}")
+        self.status_var.set("New identity generated; give peers the new fingerprint")
+
+    def apply_rate_limit(self, *args):
+        """Apply the rate limit to running transfers as soon as it is edited"""
+        try:
+            rate_limit_mb = float(self.rate_limit_var.get())
+        except ValueError:
+            return
+        if self.scheduler:
+            self.scheduler.set_rate_limit(rate_limit_mb * 1024 * 1024)
+
+    def apply_max_concurrent(self, *args):
+        """Start queued transfers right away when more may run at once"""
+        try:
+            max_concurrent = int(self.max_concurrent_var.get())
+        except ValueError:
+            return
+        if self.scheduler:
+            self.scheduler.set_max_concurrent(max_concurrent)
+
     def set_default_save_path(self):
         path = filedialog.askdirectory()
         if path:
@@ -609,7 +756,11 @@ class FileTransferApp:
             "rate_limit": float(self.rate_limit_var.get()) * 1024 * 1024,  # Convert to bytes
             "verify_fingerprint": self.verify_fingerprint_var.get(),
             "compression": self.compression_var.get(),
-            "transfer_history": self.transfer_history
+            "delta_sync": self.delta_var.get(),
+            "dedup": self.dedup_var.get(),
+            "chunk_cache_size": float(self.cache_size_var.get()) * 1024 * 1024 * 1024,  # Convert to bytes
+            "archive_mode": self.archive_var.get(),
+            "max_concurrent_transfers": int(self.max_concurrent_var.get()),
         }
         self.secure_settings.save_settings(settings)
         messagebox.showinfo("Settings", "Settings saved successfully")
@@ -619,57 +770,36 @@ class FileTransferApp:
         if settings:
             self.default_save_path_var.set(settings.get("default_save_path", ""))
             rate_limit_mb = settings.get("rate_limit", 10 * 1024 * 1024) / (1024 * 1024)
-            self.rate_limit_var.set(str(int(rate_limit_mb)))
+            self.rate_limit_var.set(f"{rate_limit_mb:g}")
             self.verify_fingerprint_var.set(settings.get("verify_fingerprint", True))
             self.compression_var.set(settings.get("compression", False))
-            self.transfer_history = settings.get("transfer_history", [])
-
-    def generate_certificates(self):
-        if not os.path.exists("sender_cert.pem") or not os.path.exists("sender_key.pem"):
-            key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=2048,
-                backend=default_backend()
-            )
-            subject = issuer = x509.Name([
-                x509.NameAttribute(NameOID.COMMON_NAME, u"p2p-file-transfer"),
-                x509.NameAttribute(NameOID.ORGANIZATION_NAME, u"My Organization"),
-                x509.NameAttribute(NameOID.COUNTRY_NAME, u"US"),
-            ])
-            cert = (
-                x509.CertificateBuilder()
-                .subject_name(subject)
-                .issuer_name(issuer)
-                .public_key(key.public_key())
-                .serial_number(x509.random_serial_number())
-                .not_valid_before(datetime.utcnow())
-                .not_valid_after(datetime.utcnow() + timedelta(days=CERT_EXPIRY_DAYS))
-                .add_extension(
-                    x509.SubjectAlternativeName([x509.DNSName(u"localhost")]),
-                    critical=False,
-                )
-                .sign(key, hashes.SHA256(), default_backend())
-            )
-            with open("sender_key.pem", "wb") as f:
-                f.write(key.private_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PrivateFormat.TraditionalOpenSSL,
-                    encryption_algorithm=serialization.NoEncryption(),
-                ))
-            with open("sender_cert.pem", "wb") as f:
-                f.write(cert.public_bytes(serialization.Encoding.PEM))
-
-    def get_cert_fingerprint(self):
-        with open("sender_cert.pem", "rb") as f:
-            cert = x509.load_pem_x509_certificate(f.read(), default_backend())
-        return hashlib.sha256(cert.public_bytes(serialization.Encoding.DER)).hexdigest()
+            self.delta_var.set(settings.get("delta_sync", True))
+            self.dedup_var.set(settings.get("dedup", False))
+            cache_size_gb = settings.get("chunk_cache_size", CHUNK_STORE_MAX_SIZE) / (1024 * 1024 * 1024)
+            self.cache_size_var.set(f"{cache_size_gb:g}")
+            self.archive_var.set(settings.get("archive_mode", False))
+            self.max_concurrent_var.set(str(settings.get("max_concurrent_transfers", MAX_CONCURRENT_TRANSFERS)))
 
     def select_file(self):
         self.file_path = filedialog.askopenfilename()
         if self.file_path:
+            self.file_paths = [self.file_path]
             self.selected_file_label.config(text=os.path.basename(self.file_path))
             self.show_connection_info()
 
+    def select_folder(self):
+        """Select a whole directory tree for transfer"""
+        folder = filedialog.askdirectory()
+        if not folder:
+            return
+        
+        self.file_paths = [folder]
+        self.file_path = folder
+        self.selected_file_label.config(text=f"{os.path.basename(folder)}/")
+        self.files_listbox.delete(0, tk.END)
+        self.files_listbox.insert(tk.END, f"{os.path.basename(folder)}/")
+        self.show_connection_info()
+
     def select_files(self):
         self.file_paths = filedialog.askopenfilenames()
         if self.file_paths:
@@ -693,157 +823,74 @@ class FileTransferApp:
         else:
             self.selected_file_label.config(text=f"{len(file_paths)} files selected")
         
+        self.files_listbox.delete(0, tk.END)
+        for path in file_paths:
+            self.files_listbox.insert(tk.END, os.path.basename(path))
+        
         # Update connection info
         self.show_connection_info()
 
     def show_connection_info(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            local_ip = s.getsockname()[0]
-        except Exception:
-            local_ip = "127.0.0.1"
-        finally:
-            s.close()
-        
-        info = f"IP: {local_ip}\nPort: {DEFAULT_PORT}\nFingerprint: {self.get_cert_fingerprint()}"
+        port = self.code_port or "assigned when the transfer starts"
+        info = f"IP: {self.local_address or local_ip()}\nPort: {port}\nFingerprint: {get_cert_fingerprint()}"
         self.info_text.delete(1.0, tk.END)
         self.info_text.insert(tk.END, info)
 
     def start_sender(self):
-        if not self.file_path or not os.path.exists(self.file_path):
+        paths = self.file_paths or ([self.file_path] if self.file_path else [])
+        if not paths or not all(os.path.exists(path) for path in paths):
             messagebox.showerror("Error", "Please select a valid file first")
             return
         
         self.progress["value"] = 0
-        threading.Thread(target=self.run_sender, daemon=True).start()
-
-    def calculate_checksum(self, file_path):
-        """Calculate SHA-256 checksum of file"""
-        hasher = hashlib.sha256()
-        with open(file_path, 'rb') as f:
-            buf = f.read(BUFFER_SIZE)
-            while buf:
-                hasher.update(buf)
-                buf = f.read(BUFFER_SIZE)
-        return hasher.hexdigest()
-
-    def run_sender(self):
-        rate_limiter = RateLimiter(RATE_LIMIT_BYTES)
-        retry_count = 0
-        self.transfer_active = True  # Set to active when starting
-        
-        while retry_count < MAX_RETRIES:
-            try:
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-                context.load_cert_chain("sender_cert.pem", "sender_key.pem")
-                context.minimum_version = ssl.TLSVersion.TLSv1_3  # Force TLS 1.3
-                context.set_ciphers('ECDHE-RSA-AES256-GCM-SHA384')  # Use strong cipher suite
-                
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                    sock.settimeout(TRANSFER_TIMEOUT)
-                    sock.bind(('0.0.0.0', DEFAULT_PORT))
-                    sock.listen(1)
-                    
-                    # FIX: Accept connection on plain socket and then wrap it with SSL
-                    conn, addr = sock.accept()
-                    with context.wrap_socket(conn, server_side=True) as ssock:
-                        # Add session token
-                        session_token = os.urandom(32).hex()
-                        ssock.sendall(session_token.encode())
-                        
-                        # Send file metadata
-                        file_size = os.path.getsize(self.file_path)
-                        
-                        # Calculate checksum before sending
-                        checksum = self.calculate_checksum(self.file_path)
-                        metadata = {
-                            "size": file_size,
-                            "name": os.path.basename(self.file_path),
-                            "timestamp": datetime.now().isoformat(),
-                            "checksum": checksum
-                        }
-                        metadata_bytes = json.dumps(metadata).encode()
-                        ssock.sendall(metadata_bytes)
-                        
-                        # Send file contents
-                        with open(self.file_path, "rb") as f:
-                            bytes_sent = 0
-                            start_time = time.time()
-                            while bytes_sent < file_size:
-                                # Check if transfer is paused
-                                while not self.transfer_active:
-                                    time.sleep(0.1)  # Sleep while paused
-                                    
-                                chunk = f.read(BUFFER_SIZE)
-                                if not chunk:
-                                    break
-                                    
-                                # Rate limiting
-                                while not rate_limiter.can_transfer(len(chunk)) and self.transfer_active:
-                                    time.sleep(0.01)
-                                    
-                                ssock.sendall(chunk)
-                                bytes_sent += len(chunk)
-                                progress = (bytes_sent / file_size) * 100
-                                self.root.after(0, self.update_progress, progress, bytes_sent, file_size, start_time)
-                                
-                # Add to history when transfer completes
-                filename = os.path.basename(self.file_path)
-                file_size = os.path.getsize(self.file_path)
-                self.root.after(0, lambda: self.add_to_history(filename, file_size, "Sent"))
-                break  # Transfer complete, exit retry loop
-                
-            except Exception as e:
-                retry_count += 1
-                # Ensure messagebox is called on the main thread
-                self.root.after(0, lambda: messagebox.showerror("Transfer Error", str(e)))
-                if retry_count >= MAX_RETRIES:
-                    # Add failed transfer to history
-                    if self.file_path:
-                        filename = os.path.basename(self.file_path)
-                        try:
-                            file_size = os.path.getsize(self.file_path)
-                        except:
-                            file_size = 0
-                        self.root.after(0, lambda: self.add_to_history(filename, file_size, "Sent", "Failed"))
-
-    def update_progress(self, value, bytes_transferred, file_size, start_time):
-        self.progress["value"] = value
-        
-        # Update the progress bar color based on progress
+        name = ", ".join(os.path.basename(os.path.normpath(path)) for path in paths)
+        options = {"paths": list(paths), "compress": self.compression_var.get(), "delta": self.delta_var.get(),
+                   "dedup": self.dedup_var.get(), "archive": self.archive_var.get()}
+        self.transfer_active.set()  # Set to active when starting
+        job = self.scheduler.submit("send", name, options, PRIORITIES.index(self.send_priority_var.get()))
+        self.show_job_started(job)
+        self.watch_progress(job.progress, self.progress, self.eta_label)
+
+    def watch_progress(self, progress, bar, eta_label=None):
+        """Redraw a progress bar from a TransferProgress at a fixed frame rate"""
+        self.update_progress(progress, bar, eta_label)
+        if not progress.finished:
+            self.root.after(PROGRESS_INTERVAL_MS, self.watch_progress, progress, bar, eta_label)
+
+    def update_progress(self, progress, bar, eta_label=None):
+        value, bytes_transferred, speed, eta_seconds = progress.sample()
+        bar["value"] = value
+        
+        # Update the progress bar color based on progress, restyling only when it changes
         if value < 25:
-            self.progress.configure(style="Red.Horizontal.TProgressbar")
+            style = "Red.Horizontal.TProgressbar"
         elif value < 75:
-            self.progress.configure(style="Yellow.Horizontal.TProgressbar")
+            style = "Yellow.Horizontal.TProgressbar"
         else:
-            self.progress.configure(style="Green.Horizontal.TProgressbar")
+            style = "Green.Horizontal.TProgressbar"
+        if str(bar.cget("style")) != style:
+            bar.configure(style=style)
         
-        elapsed = time.time() - start_time
-        if elapsed > 0 and bytes_transferred > 0:
-            speed = bytes_transferred / elapsed  # bytes per second
-            remaining_size = file_size - bytes_transferred
+        if speed > 0 and eta_seconds is not None and not progress.finished:
+            speed_mb = speed / (1024 * 1024)
             
-            if speed > 0:
-                eta_seconds = remaining_size / speed
-                speed_mb = speed / (1024 * 1024)
+            # Format time nicely
+            if eta_seconds < 60:
+                eta_text = f"{eta_seconds:.0f} seconds"
+            elif eta_seconds < 3600:
+                eta_text = f"{eta_seconds/60:.1f} minutes"
+            else:
+                eta_text = f"{eta_seconds/3600:.1f} hours"
                 
-                # Format time nicely
-                if eta_seconds < 60:
-                    eta_text = f"{eta_seconds:.0f} seconds"
-                elif eta_seconds < 3600:
-                    eta_text = f"{eta_seconds/60:.1f} minutes"
-                else:
-                    eta_text = f"{eta_seconds/3600:.1f} hours"
-                    
-                self.eta_label.config(text=f"ETA: {eta_text} ({speed_mb:.2f} MB/s)")
-                
-                # Update status bar with transfer info
-                percent = int(value)
-                self.status_var.set(
-                    f"Transferring: {self.format_size(bytes_transferred)} of {self.format_size(file_size)} "
-                    f"({percent}%) at {speed_mb:.2f} MB/s"
-                )
+            if eta_label:
+                eta_label.config(text=f"ETA: {eta_text} ({speed_mb:.2f} MB/s)")
+            
+            # Update status bar with transfer info
+            percent = int(value)
+            self.status_var.set(
+                f"Transferring: {format_size(bytes_transferred)} of {format_size(progress.total)} "
+                f"({percent}%) at {speed_mb:.2f} MB/s"
+            )
 
     def select_save_path(self):
         save_dir = filedialog.askdirectory()
@@ -857,69 +904,42 @@ class FileTransferApp:
             return
         
         self.receiver_progress["value"] = 0
-        threading.Thread(target=self.run_receiver, daemon=True).start()
+        # Read the entries here; Tk widgets must not be touched from the worker thread
+        host, port = self.sender_ip.get(), int(self.port.get())
+        options = {"host": host, "port": port, "fingerprint": self.fingerprint.get(), "save_path": self.save_path,
+                   "chunk_cache_size": float(self.cache_size_var.get()) * 1024 * 1024 * 1024}
+        job = self.scheduler.submit("receive", f"{host}:{port}", options,
+                                    PRIORITIES.index(self.receive_priority_var.get()))
+        self.show_job_started(job)
+        self.watch_progress(job.progress, self.receiver_progress)
+
+    def show_job_started(self, job):
+        if job.state == "running":
+            self.status_var.set(f"Started {job.name}")
+        else:
+            self.status_var.set(f"Queued {job.name}; it starts when a running transfer finishes")
 
-    def run_receiver(self):
+    def job_finished(self, job, result):
+        """Called on the job's worker thread: write the metrics exports there, then finish up on the UI thread"""
+        direction = "Sent" if job.kind == "send" else "Received"
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         try:
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            context.load_verify_locations("sender_cert.pem")
-            context.minimum_version = ssl.TLSVersion.TLSv1_3  # Force TLS 1.3
-            context.set_ciphers('ECDHE-RSA-AES256-GCM-SHA384')  # Use strong cipher suite
-            
-            with socket.create_connection((self.sender_ip.get(), int(self.port.get())), timeout=TRANSFER_TIMEOUT) as sock:
-                with context.wrap_socket(sock, server_hostname="p2p-file-transfer") as ssock:
-                    # Verify fingerprint
-                    cert = ssock.getpeercert(binary_form=True)
-                    fingerprint = hashlib.sha256(cert).hexdigest()
-                    if fingerprint != self.fingerprint.get():
-                        raise ValueError("Certificate fingerprint does not match")
-                    
-                    # Receive session token
-                    session_token = ssock.recv(64).decode()
-                    
-                    # Receive file metadata
-                    metadata_bytes = ssock.recv(BUFFER_SIZE)
-                    metadata = json.loads(metadata_bytes.decode())
-                    file_size = metadata["size"]
-                    file_name = metadata["name"]
-                    
-                    # Receive file contents
-                    save_path = os.path.join(self.save_path, file_name)
-                    with open(save_path, "wb") as f:
-                        bytes_received = 0
-                        while bytes_received < file_size:
-                            chunk = ssock.recv(BUFFER_SIZE)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                            bytes_received += len(chunk)
-                            progress = (bytes_received / file_size) * 100
-                            self.root.after(0, lambda: self.update_receiver_progress(progress))
-                    
-                    # After receiving the file
-                    received_checksum = self.calculate_checksum(save_path)
-                    if received_checksum != metadata["checksum"]:
-                        self.root.after(0, lambda: messagebox.showerror(
-                            "Verification Failed", 
-                            "File may be corrupted. Checksums do not match."
-                         ))
-                        self.root.after(0, lambda: self.add_to_history(file_name, file_size, "Received", "Failed (Checksum)"))
-                    else:
-                        self.root.after(0, lambda: messagebox.showinfo(
-                            "Transfer Complete", 
-                            "File verified successfully."
-                        ))
-                        self.root.after(0, lambda: self.add_to_history(file_name, file_size, "Received"))
-            
-        except Exception as e:
-            self.root.after(0, lambda err=e: messagebox.showerror("Receive Error", str(err)))
-            # Try to get filename from metadata if available
-            filename = "Unknown"
-            filesize = 0
-            self.root.after(0, lambda: self.add_to_history(filename, filesize, "Received", "Failed"))
+            self.metrics_recorder.record(result, direction, timestamp)
+        except OSError as e:
+            self.root.after(0, self.status_var.set, f"Could not write transfer metrics: {e}")
+        self.root.after(0, self.finish_job, job, result, direction, timestamp)
 
-    def update_receiver_progress(self, value):
-        self.receiver_progress["value"] = value
+    def finish_job(self, job, result, direction, timestamp):
+        if job.kind == "receive":
+            if result.ok:
+                messagebox.showinfo("Transfer Complete", "File verified successfully.")
+            elif result.status != "Failed":  # Plain failures were reported by show_job_error()
+                messagebox.showerror("Verification Failed", "File may be corrupted. Checksums do not match.")
+        self.add_to_history(result.name, result.size, direction, result.status, result.peer,
+                            result.metrics.as_dict() if result.metrics else None, timestamp)
+
+    def show_job_error(self, job, err):
+        messagebox.showerror("Transfer Error" if job.kind == "send" else "Receive Error", str(err))
 
     def handle_drop(self, event):
         """Improved drag and drop file handling with multiple file support"""
@@ -973,21 +993,157 @@ class FileTransferApp:
         self.status_var.set(f"Added {len(file_paths)} file(s)")
 
     def toggle_pause(self):
-        self.transfer_active = not self.transfer_active
-        self.pause_button.config(text="Resume" if not self.transfer_active else "Pause")
-        if self.transfer_active:
-            self.status_var.set("Transfer resumed")
-        else:
+        if self.transfer_active.is_set():
+            self.transfer_active.clear()
+            self.pause_button.config(text="Resume")
             self.status_var.set("Transfer paused")
+        else:
+            self.transfer_active.set()
+            self.pause_button.config(text="Pause")
+            self.status_var.set("Transfer resumed")
         
+    def create_queue_tab(self, parent):
+        # Buttons to reorder, cancel and tidy up queued transfers
+        button_frame = ttk.Frame(parent)
+        button_frame.pack(side="bottom", fill="x", pady=5)
+        ttk.Button(button_frame, text="Higher Priority",
+                   command=lambda: self.change_job_priority(1)).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="Lower Priority",
+                   command=lambda: self.change_job_priority(-1)).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="Cancel", command=self.cancel_selected_job).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="Clear Finished", command=self.clear_finished_jobs).pack(side="right", padx=5)
+        
+        columns = ("name", "direction", "priority", "state", "progress", "code")
+        self.queue_tree = ttk.Treeview(parent, columns=columns, show="headings", selectmode="browse")
+        self.queue_tree.heading("name", text="Transfer")
+        self.queue_tree.heading("direction", text="Direction")
+        self.queue_tree.heading("priority", text="Priority")
+        self.queue_tree.heading("state", text="State")
+        self.queue_tree.heading("progress", text="Progress")
+        self.queue_tree.heading("code", text="Connection Code")
+        self.queue_tree.column("name", width=180)
+        self.queue_tree.column("direction", width=70)
+        self.queue_tree.column("priority", width=70)
+        self.queue_tree.column("state", width=110)
+        self.queue_tree.column("progress", width=110)
+        self.queue_tree.column("code", width=170)
+        
+        scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self.queue_tree.yview)
+        self.queue_tree.configure(yscrollcommand=scrollbar.set)
+        self.queue_tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+    def watch_queue(self):
+        self.refresh_queue()
+        self.root.after(QUEUE_REFRESH_MS, self.watch_queue)
+
+    def refresh_queue(self):
+        """Redraw the queue in the order the scheduler runs it, keeping the selection"""
+        jobs = self.scheduler.jobs()
+        ids = {job.id for job in jobs}
+        for row in self.queue_tree.get_children():
+            if row not in ids:
+                self.queue_tree.delete(row)
+        for index, job in enumerate(jobs):
+            if job.state == "running":
+                # Reads the counters without sample(), which would disturb the speed the progress bar shows
+                total = job.progress.total
+                progress = f"{job.progress.done / total:.0%} of {format_size(total)}" if total else "Waiting"
+            else:
+                progress = job.status or ""
+            # Running sends listen on their own port, so each has its own connection code
+            code = ""
+            if job.kind == "send" and job.state == "running" and job.port and self.local_address:
+                code = self.generate_connection_code(self.local_address, job.port)
+            values = (job.name, "Send" if job.kind == "send" else "Receive", PRIORITIES[job.priority],
+                      job.state.capitalize(), progress, code)
+            if self.queue_tree.exists(job.id):
+                self.queue_tree.item(job.id, values=values)
+                self.queue_tree.move(job.id, "", index)
+            else:
+                self.queue_tree.insert("", index, iid=job.id, values=values)
+        self.update_announcements(jobs)
+        self.update_connection_code(jobs)
+
+    def update_connection_code(self, jobs):
+        """Point the connection code, its QR code and the sender's connection info at the latest running send"""
+        sends = [job for job in jobs if job.kind == "send" and job.state == "running" and job.port]
+        port = max(sends, key=lambda job: job.created).port if sends else None
+        if port != self.code_port:
+            self.code_port = port
+            self.refresh_connection_code(announce=False)
+            self.show_connection_info()
+
+    def update_announcements(self, jobs):
+        """Announce exactly the sends that are listening, each on its own port with its own offers"""
+        if not self.discovery:
+            return
+        listening = {job.port: [os.path.basename(os.path.normpath(path)) for path in job.options["paths"]]
+                     for job in jobs if job.kind == "send" and job.state == "running" and job.port}
+        for port in self.announced.keys() - listening.keys():
+            self.discovery.withdraw(port)
+        for port, offers in listening.items():
+            if self.announced.get(port) != offers:
+                self.discovery.announce(port, offers)
+        self.announced = listening
+
+    def selected_job(self):
+        selected = self.queue_tree.selection()
+        return self.scheduler.job(selected[0]) if selected else None
+
+    def change_job_priority(self, step):
+        job = self.selected_job()
+        if job is None:
+            return
+        self.scheduler.set_priority(job.id, job.priority + step)
+        self.refresh_queue()
+
+    def cancel_selected_job(self):
+        job = self.selected_job()
+        if job is None:
+            return
+        if not self.scheduler.cancel(job.id):
+            messagebox.showinfo("Queue", "Only transfers that have not started yet can be cancelled")
+        self.refresh_queue()
+
+    def clear_finished_jobs(self):
+        self.scheduler.clear_finished()
+        self.refresh_queue()
+
     def create_history_tab(self, parent):
+        # Search bar: words to find in any column, and a status filter
+        search_frame = ttk.Frame(parent)
+        search_frame.pack(side="top", fill="x", pady=(0, 5))
+        ttk.Label(search_frame, text="Search:").pack(side="left", padx=5)
+        self.history_search_var = tk.StringVar()
+        self.history_search_var.trace_add("write", self.schedule_history_search)
+        ttk.Entry(search_frame, textvariable=self.history_search_var).pack(side="left", fill="x", expand=True, padx=5)
+        self.history_status_var = tk.StringVar(value="All")
+        status_filter = ttk.Combobox(search_frame, textvariable=self.history_status_var, state="readonly", width=16,
+                                     values=("All", "Completed", "Failed", "Failed (Checksum)"))
+        status_filter.pack(side="left", padx=5)
+        status_filter.bind("<<ComboboxSelected>>", self.schedule_history_search)
+        
+        # Page navigation and clear history button
+        nav_frame = ttk.Frame(parent)
+        nav_frame.pack(side="bottom", fill="x", pady=5)
+        self.history_newer_button = ttk.Button(nav_frame, text="< Newer", command=lambda: self.turn_history_page(-1))
+        self.history_newer_button.pack(side="left", padx=5)
+        self.history_page_label = ttk.Label(nav_frame, text="")
+        self.history_page_label.pack(side="left", padx=5)
+        self.history_older_button = ttk.Button(nav_frame, text="Older >", command=lambda: self.turn_history_page(1))
+        self.history_older_button.pack(side="left", padx=5)
+        ttk.Button(nav_frame, text="Clear History", 
+                   command=self.clear_history).pack(side="right", padx=5)
+        
         # Add columns and headers
-        columns = ("timestamp", "filename", "size", "direction", "status")
+        columns = ("timestamp", "filename", "peer", "size", "direction", "status")
         self.history_tree = ttk.Treeview(parent, columns=columns, show="headings")
         
         # Set column headings
         self.history_tree.heading("timestamp", text="Time")
         self.history_tree.heading("filename", text="Filename")
+        self.history_tree.heading("peer", text="Peer")
         self.history_tree.heading("size", text="Size")
         self.history_tree.heading("direction", text="Direction")
         self.history_tree.heading("status", text="Status")
@@ -995,6 +1151,7 @@ class FileTransferApp:
         # Set column widths
         self.history_tree.column("timestamp", width=150)
         self.history_tree.column("filename", width=200)
+        self.history_tree.column("peer", width=110)
         self.history_tree.column("size", width=80)
         self.history_tree.column("direction", width=80)
         self.history_tree.column("status", width=100)
@@ -1007,99 +1164,143 @@ class FileTransferApp:
         self.history_tree.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
         
-        # Clear history button
-        ttk.Button(parent, text="Clear History", 
-                   command=self.clear_history).pack(pady=10)
-        
-        # Load history from settings
-        self.load_history()
+        # Only one page of history is ever in the tree; see show_history_page()
+        self.history_offset = 0
+        self.history_results = None  # Matches of the current search, None when showing everything
+        self.history_search_job = None
+        self.history_search_id = 0
 
-    def add_to_history(self, filename, size, direction, status="Completed"):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.history_tree.insert("", 0, values=(timestamp, filename, self.format_size(size), direction, status))
-        # Also save to persistent storage
-        self.transfer_history.append({
+    def add_to_history(self, filename, size, direction, status="Completed", peer=None, metrics=None, timestamp=None):
+        timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Save to persistent storage, then redraw whatever page is showing
+        entry = {
             "timestamp": timestamp,
             "filename": filename,
+            "peer": peer or "",
             "size": size,
             "direction": direction,
             "status": status
-        })
-        self.save_history()
-
-    def format_size(self, size_bytes):
-        # Convert bytes to human-readable format
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size_bytes < 1024 or unit == 'GB':
-                return f"{size_bytes:.2f} {unit}"
-            size_bytes /= 1024
-
-    def save_history(self):
-        settings = self.secure_settings.load_settings()
-        settings["transfer_history"] = self.transfer_history
-        self.secure_settings.save_settings(settings)
+        }
+        if metrics:
+            entry["metrics"] = metrics
+        self.secure_settings.add_history(entry)
+        self.refresh_history()
+        return timestamp
 
     def load_history(self):
-        settings = self.secure_settings.load_settings()
-        self.transfer_history = settings.get("transfer_history", [])
-        for entry in self.transfer_history:
-            self.history_tree.insert("", 0, values=(
+        self.history_offset = 0
+        self.show_history_page()
+
+    def show_history_page(self):
+        """Fill the tree with the page at history_offset, from the store or the search results"""
+        if self.history_results is None:
+            total = self.secure_settings.history_count()
+            entries = self.secure_settings.history_page(self.history_offset, HISTORY_PAGE_SIZE)
+        else:
+            total = len(self.history_results)
+            entries = self.history_results[self.history_offset:self.history_offset + HISTORY_PAGE_SIZE]
+        
+        self.history_tree.delete(*self.history_tree.get_children())
+        for entry in entries:
+            self.history_tree.insert("", "end", values=(
                 entry["timestamp"], 
                 entry["filename"], 
-                self.format_size(entry["size"]), 
+                entry.get("peer", ""), 
+                format_size(entry["size"]), 
                 entry["direction"], 
                 entry["status"]
             ))
+        
+        if entries:
+            first = self.history_offset + 1
+            self.history_page_label.config(text=f"{first:,}-{first + len(entries) - 1:,} of {total:,}")
+        else:
+            self.history_page_label.config(text="No matching transfers" if self.history_results is not None else "No transfers")
+        self.history_newer_button.state(["!disabled" if self.history_offset > 0 else "disabled"])
+        self.history_older_button.state(["!disabled" if self.history_offset + len(entries) < total else "disabled"])
+
+    def turn_history_page(self, step):
+        self.history_offset = max(0, self.history_offset + step * HISTORY_PAGE_SIZE)
+        self.show_history_page()
+
+    def refresh_history(self):
+        if self.history_results is None:
+            self.show_history_page()
+        else:
+            self.start_history_search(keep_page=True)
+
+    def schedule_history_search(self, *args):
+        """Search as the user types, once they pause"""
+        if self.history_search_job:
+            self.root.after_cancel(self.history_search_job)
+        self.history_search_job = self.root.after(SEARCH_DELAY_MS, self.start_history_search)
+
+    def start_history_search(self, keep_page=False):
+        self.history_search_job = None
+        text = self.history_search_var.get().strip()
+        status = self.history_status_var.get()
+        self.history_search_id += 1
+        if not keep_page:
+            self.history_offset = 0
+        if not text and status == "All":
+            self.history_results = None
+            self.show_history_page()
+            return
+        
+        # The first search decrypts the whole history, so it runs off the UI thread
+        self.status_var.set("Searching history...")
+        threading.Thread(target=self.run_history_search,
+                         args=(self.history_search_id, text, None if status == "All" else status),
+                         daemon=True).start()
+
+    def run_history_search(self, search_id, text, status):
+        results = self.secure_settings.search_history(text, status)
+        self.root.after(0, self.show_history_results, search_id, results)
+
+    def show_history_results(self, search_id, results):
+        if search_id != self.history_search_id:
+            return  # A newer search has started since
+        self.history_results = results
+        self.status_var.set(f"Found {len(results):,} transfer(s)")
+        self.show_history_page()
 
     def clear_history(self):
-        self.history_tree.delete(*self.history_tree.get_children())
-        self.transfer_history = []
-        self.save_history()
+        self.secure_settings.clear_history()
+        self.history_offset = 0
+        self.refresh_history()
 
     def check_peer_availability(self):
-        """Check if saved peers are available"""
-        settings = self.secure_settings.load_settings()
-        peers = settings.get("saved_peers", [])
-        
-        # Check only if we have the peers tree
-        if hasattr(self, "peers_tree"):
-            for item in self.peers_tree.get_children():
-                peer_name = self.peers_tree.item(item)["values"][0]
-                
-                # Find this peer in our settings
-                for peer in peers:
-                    if peer["name"] == peer_name:
-                        # Try to ping the peer
-                        try:
-                            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            sock.settimeout(0.5)  # Short timeout to not block the UI
-                            result = sock.connect_ex((peer["ip"], int(peer["port"])))
-                            sock.close()
-                            
-                            # Update the status in the tree view
-                            if result == 0:
-                                # Port is open, peer might be available
-                                self.peers_tree.item(item, values=(
-                                    peer_name, 
-                                    peer.get("last_connected", "Never"),
-                                    "Online"
-                                ))
-                            else:
-                                self.peers_tree.item(item, values=(
-                                    peer_name,
-                                    peer.get("last_connected", "Never"),
-                                    "Offline"
-                                ))
-                        except:
-                            # In case of any error, mark as offline
-                            self.peers_tree.item(item, values=(
-                                peer_name,
-                                peer.get("last_connected", "Never"),
-                                "Offline"
-                            ))
+        """Show the peers heard on the LAN, and probe the saved peers that are not among them"""
+        nearby = self.discovery.peers() if self.discovery else []
+        self.show_nearby_peers(nearby)
+        
+        # A saved peer heard announcing is online without a probe. A probe is only a TCP connect,
+        # no stronger than an unauthenticated announcement, so peers discovery hears are not probed;
+        # the rest, such as peers on another subnet, still are
+        self.heard_fingerprints = {peer["fingerprint"] for peer in nearby}
+        names = {}  # Address -> names of the saved peers to probe
+        for peer in self.secure_settings.peers():
+            if self.peer_heard(peer):
+                self.set_peer_status(peer["name"], True)
+            else:
+                names.setdefault(peer_address(peer), []).append(peer["name"])
+        
+        # Probes run on the prober's threads; this only collects what they found
+        for address, online in self.peer_prober.poll(names).items():
+            for name in names[address]:
+                self.set_peer_status(name, online)
         
         # Schedule the next check
-        self.root.after(10000, self.check_peer_availability)  # Check every 10 seconds
+        self.root.after(PEER_POLL_MS, self.check_peer_availability)
+
+    def peer_heard(self, peer):
+        """Whether discovery currently hears a saved peer announcing itself"""
+        return any(fingerprint_matches(fingerprint, peer["fingerprint"]) for fingerprint in self.heard_fingerprints)
+
+    def set_peer_status(self, name, online):
+        status = "Online" if online else "Offline"
+        if self.peers_tree.exists(name) and self.peers_tree.set(name, "status") != status:
+            self.peers_tree.set(name, "status", status)
 
 if __name__ == "__main__":
     app = FileTransferApp()
@@ -0,0 +1,26 @@
+"""Headless P2P file transfer engine shared by the GUI and the p2pft command line"""
+import importlib
+
+# Exported names and their modules. They are imported on first use, so that
+# "import p2pft.engine" does not also load the server, swarm and cryptography.
+_EXPORTS = {
+    "DEFAULT_PORT": "engine", "ConnectionPool": "engine", "RateLimiter": "engine", "Receiver": "engine",
+    "Sender": "engine", "TransferProgress": "engine", "TransferResult": "engine",
+    "generate_certificates": "identity", "get_cert_fingerprint": "identity",
+    "ProtocolError": "protocol",
+    "Catalog": "server", "TransferServer": "server",
+    "SecureSettings": "settings",
+    "SwarmNode": "swarm",
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
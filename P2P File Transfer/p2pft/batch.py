@@ -0,0 +1,652 @@
+"""Manifests and the concatenated file stream of a multi-file batch"""
+import bisect
+import collections
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .delta import DELTA_MIN_SIZE, DeltaEncoder
+from .protocol import ARCHIVE_DIR, ARCHIVE_FILE, ARCHIVE_RECORD, RECIPE_RECORD, ProtocolError
+
+WRITE_QUEUE_DEPTH = 16  # Buffers the write-behind thread may fall behind the network
+ARCHIVE_READ_WORKERS = 8  # Threads reading small files ahead of an archive stream
+ARCHIVE_PREFETCH_FILES = 256  # Files read ahead at most
+ARCHIVE_PREFETCH_SIZE = 16 * 1024 * 1024  # Bytes read ahead at most
+ARCHIVE_SMALL_FILE_SIZE = 1024 * 1024  # Larger files are read straight into the frames instead
+ARCHIVE_SYNC_WORKERS = 4  # Threads syncing unpacked files while the next ones are written
+ARCHIVE_SYNC_BACKLOG = 64  # Open files waiting for their sync at most
+
+def build_manifest(paths):
+    """Expand files and directory trees into (source path, manifest entry) pairs.
+
+    Entries use "/"-separated paths relative to the parent of each selected
+    item, so a selected folder is recreated under the receiver's save path.
+    Trees are walked with os.scandir, whose entries know their type and
+    cache their stat, so a tree of many small files costs one stat each.
+    """
+    manifest = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            manifest.append((path, _manifest_entry(os.stat(path), os.path.basename(path))))
+            continue
+        _scan_tree(path, os.path.basename(path), manifest)
+    return manifest
+
+def _scan_tree(path, rel_dir, manifest):
+    """Add a directory's files, then its subdirectories in name order, as os.walk would list them"""
+    try:
+        with os.scandir(path) as scan:
+            children = sorted(scan, key=lambda child: child.name)
+    except OSError:
+        return  # Unreadable directories are skipped
+    if not children:
+        manifest.append((path, {"path": rel_dir, "size": 0, "dir": True}))
+    folders = []
+    for child in children:
+        try:
+            if child.is_dir():
+                if not child.is_symlink():
+                    folders.append(child)
+            elif child.is_file():
+                manifest.append((child.path, _manifest_entry(child.stat(), f"{rel_dir}/{child.name}")))
+        except OSError:
+            continue  # Vanished or unreadable since the directory was listed
+    for folder in folders:
+        _scan_tree(folder.path, f"{rel_dir}/{folder.name}", manifest)
+
+def _manifest_entry(stat, rel_path):
+    return {"path": rel_path, "size": stat.st_size, "mtime": stat.st_mtime}
+
+def safe_join(root, rel_path):
+    """Resolve a manifest path under root, refusing anything that escapes it"""
+    parts = rel_path.split("/")
+    for part in parts:
+        if part in ("", ".", "..") or os.sep in part or (os.altsep and os.altsep in part) \
+                or (os.name == "nt" and ":" in part):
+            raise ProtocolError(f"Refusing unsafe path in manifest: {rel_path!r}")
+    return os.path.join(root, *parts)
+
+def read_batch(manifest, buf, hasher, signatures=None, recipes=None, frame_size=None):
+    """Stream the concatenated contents of the manifest files.
+
+    Yields ("data", length) each time buf holds data to send, so many small
+    files go out as a few large data frames, ("copy", (offset, length))
+    for ranges of a delta-encoded file that the receiver already has, and
+    ("chunk", (digest, length)) for chunks held in the receiver's chunk
+    store. Every byte read from disk is fed to hasher. frame_size, if
+    given, is called after every data frame for how much of buf to fill
+    next, so the frame size can change while the batch streams.
+    """
+    signatures = signatures or {}
+    recipes = recipes or {}
+    def next_frame():
+        return buf[:frame_size()] if frame_size else buf
+    frame = next_frame()
+    filled = 0
+    for index, (source, entry) in enumerate(manifest):
+        remaining = 0 if entry.get("dir") else entry["size"]
+        if not remaining:
+            continue
+        with open(source, "rb") as f:
+            if index in recipes:
+                records, wanted = recipes[index]
+                for n, (digest, length) in enumerate(RECIPE_RECORD.iter_unpack(records)):
+                    remaining -= length
+                    if not wanted[n >> 3] & (0x80 >> (n & 7)):
+                        data = f.read(length)
+                        if len(data) != length:
+                            raise IOError(f"{source} changed size during transfer")
+                        hasher.update(data)
+                        if filled:
+                            yield "data", filled
+                            filled = 0
+                            frame = next_frame()
+                        yield "chunk", (digest, length)
+                        continue
+                    while length:
+                        read = f.readinto(frame[filled:filled + min(length, len(frame) - filled)])
+                        if not read:
+                            raise IOError(f"{source} changed size during transfer")
+                        hasher.update(frame[filled:filled + read])
+                        filled += read
+                        length -= read
+                        if filled == len(frame):
+                            yield "data", filled
+                            filled = 0
+                            frame = next_frame()
+                if remaining:
+                    raise IOError(f"{source} changed size during transfer")
+                continue
+            
+            if index in signatures:
+                encoder = DeltaEncoder(*signatures[index])
+                for op, value in encoder.encode(f, remaining, hasher):
+                    if op == "copy":
+                        if filled:
+                            yield "data", filled
+                            filled = 0
+                            frame = next_frame()
+                        yield "copy", value
+                        continue
+                    while value:
+                        length = min(len(value), len(frame) - filled)
+                        frame[filled:filled + length] = value[:length]
+                        value = value[length:]
+                        filled += length
+                        if filled == len(frame):
+                            yield "data", filled
+                            filled = 0
+                            frame = next_frame()
+                continue
+            
+            while remaining:
+                length = f.readinto(frame[filled:filled + min(remaining, len(frame) - filled)])
+                if not length:
+                    raise IOError(f"{source} changed size during transfer")
+                hasher.update(frame[filled:filled + length])
+                filled += length
+                remaining -= length
+                if filled == len(frame):
+                    yield "data", filled
+                    filled = 0
+                    frame = next_frame()
+    if filled:
+        yield "data", filled
+
+def archive_size(entries):
+    """Length of the archive stream read_archive() makes of these manifest entries"""
+    return sum(ARCHIVE_RECORD.size + len(entry["path"].encode()) + (0 if entry.get("dir") else entry["size"])
+               for entry in entries)
+
+def read_archive(manifest, buf, hasher, frame_size=None, workers=ARCHIVE_READ_WORKERS):
+    """Stream the manifest as an archive: one record per entry, each followed by its file's contents.
+
+    The receiver unpacks the stream as it arrives, so it needs no manifest
+    up front, and files of any size pack into full data frames. A pool of
+    workers reads small files ahead of the stream, at most
+    ARCHIVE_PREFETCH_FILES of them and ARCHIVE_PREFETCH_SIZE bytes, so
+    opening and reading thousands of them overlaps instead of each waiting
+    for the last; larger files are read straight into the frames. Yields
+    ("data", length) like read_batch(), and feeds every frame to hasher.
+    """
+    def next_frame():
+        return buf[:frame_size()] if frame_size else buf
+    frame = next_frame()
+    filled = 0
+    entries = iter(manifest)
+    pending = collections.deque()
+    prefetched = 0
+    with ThreadPoolExecutor(workers, thread_name_prefix="archive-read") as pool:
+        while True:
+            while len(pending) < ARCHIVE_PREFETCH_FILES and prefetched < ARCHIVE_PREFETCH_SIZE:
+                item = next(entries, None)
+                if item is None:
+                    break
+                source, entry = item
+                size = 0 if entry.get("dir") else entry["size"]
+                future = pool.submit(_read_small_file, source, size) if 0 < size <= ARCHIVE_SMALL_FILE_SIZE else None
+                pending.append((source, entry, size, future))
+                prefetched += size if future else 0
+            if not pending:
+                break
+            source, entry, size, future = pending.popleft()
+            
+            path = entry["path"].encode()
+            kind = ARCHIVE_DIR if entry.get("dir") else ARCHIVE_FILE
+            pieces = [ARCHIVE_RECORD.pack(kind, len(path), size, entry.get("mtime", 0.0)) + path]
+            if future:
+                pieces.append(future.result())
+                prefetched -= size
+            for piece in pieces:
+                piece = memoryview(piece)
+                while piece:
+                    length = min(len(piece), len(frame) - filled)
+                    frame[filled:filled + length] = piece[:length]
+                    piece = piece[length:]
+                    filled += length
+                    if filled == len(frame):
+                        hasher.update(frame)
+                        yield "data", filled
+                        filled = 0
+                        frame = next_frame()
+            if future or not size:
+                continue
+            
+            with open(source, "rb") as f:
+                while size:
+                    length = f.readinto(frame[filled:filled + min(size, len(frame) - filled)])
+                    if not length:
+                        raise IOError(f"{source} changed size during transfer")
+                    filled += length
+                    size -= length
+                    if filled == len(frame):
+                        hasher.update(frame)
+                        yield "data", filled
+                        filled = 0
+                        frame = next_frame()
+    if filled:
+        hasher.update(frame[:filled])
+        yield "data", filled
+
+def _read_small_file(source, size):
+    with open(source, "rb") as f:
+        data = f.read(size)
+    if len(data) != size:
+        raise IOError(f"{source} changed size during transfer")
+    return data
+
+def stream_starts(entries):
+    """Stream offset of each manifest entry, followed by the total size"""
+    return list(itertools.accumulate((0 if entry.get("dir") else entry["size"] for entry in entries), initial=0))
+
+def read_stream_range(manifest, starts, offset, buf):
+    """Fill buf with the batch stream from offset on, as read_batch would send it.
+
+    starts comes from stream_starts(), so any part of the stream can be
+    read again without walking the batch from the start.
+    """
+    index = bisect.bisect_right(starts, offset) - 1
+    filled = 0
+    while filled < len(buf) and index < len(manifest):
+        source, entry = manifest[index]
+        start = offset + filled - starts[index]
+        length = min(len(buf) - filled, starts[index + 1] - starts[index] - start)
+        if length > 0:
+            with open(source, "rb") as f:
+                f.seek(start)
+                while length:
+                    read = f.readinto(buf[filled:filled + length])
+                    if not read:
+                        raise IOError(f"{source} changed size during transfer")
+                    filled += read
+                    length -= read
+        index += 1
+    return filled
+
+def preallocate(f, size):
+    """Reserve a file's blocks up front where the platform supports it, to limit fragmentation"""
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass  # Not supported by this filesystem
+
+def sync_directory(path):
+    """Make a directory's entries durable, where directories can be opened at all"""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_stream_range(manifest, starts, offset, data, sync=False):
+    """Write data into the manifest files at a batch stream offset; the files must already exist"""
+    index = bisect.bisect_right(starts, offset) - 1
+    data = memoryview(data)
+    while data and index < len(manifest):
+        target, entry = manifest[index]
+        start = offset - starts[index]
+        length = min(len(data), starts[index + 1] - starts[index] - start)
+        if length > 0:
+            with open(target, "r+b") as f:
+                f.seek(start)
+                f.write(data[:length])
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            data = data[length:]
+            offset += length
+        index += 1
+
+class BatchWriter:
+    """Split the concatenated batch stream back into the files of a manifest.
+
+    Every file is written to "<name>.part", preallocated to its full size,
+    by a write-behind thread fed through a queue of at most queue_depth
+    buffers, so receiving from the network overlaps with disk writes.
+    Nothing appears under the real names until commit(), which runs once
+    the batch is verified and atomically replaces each file; discard()
+    removes the partial files instead. Files marked with use_basis() are
+    rebuilt from copy instructions against their existing copy, which
+    stays untouched until commit().
+    """
+
+    def __init__(self, root, entries, queue_depth=WRITE_QUEUE_DEPTH):
+        self.total_size = 0
+        self.parts = []  # (path written to, entry) for every manifest entry
+        self.error = None
+        self.stall_seconds = 0.0  # Time write() waited for room in the queue
+        self.disk_seconds = 0.0  # Time the write-behind thread spent writing and syncing
+        self._starts = stream_starts(entries)
+        self._files = []
+        self._bases = set()
+        for index, entry in enumerate(entries):
+            target = safe_join(root, entry["path"])
+            if entry.get("dir"):
+                os.makedirs(target, exist_ok=True)
+                self.parts.append((target, entry))
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self.parts.append((target + ".part", entry))
+            if entry["size"]:
+                self._files.append((index, target, entry))
+                self.total_size += entry["size"]
+            else:
+                open(target + ".part", "wb").close()
+        self._files.reverse()
+        self._index = None
+        self._basis = None
+        self._remaining = 0
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._thread = threading.Thread(target=self._write_behind, daemon=True)
+        self._thread.start()
+
+    def delta_candidates(self, min_size=DELTA_MIN_SIZE):
+        """Yield (index, path) for files whose existing copy is worth delta-encoding against"""
+        for index, target, entry in reversed(self._files):
+            if os.path.isfile(target) and os.path.getsize(target) >= min_size:
+                yield index, target
+
+    def use_basis(self, index):
+        self._bases.add(index)
+
+    def write(self, data):
+        """Queue data for the write-behind thread; the caller may reuse data right away"""
+        if self.error:
+            raise self.error
+        while data:
+            self._ensure_current()
+            length = min(len(data), self._remaining)
+            item = (self._index, bytes(data[:length]))
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                # The disk is behind the network
+                started = time.perf_counter()
+                self._queue.put(item)
+                self.stall_seconds += time.perf_counter() - started
+            data = data[length:]
+            self._remaining -= length
+
+    def read_basis(self, offset, length):
+        """Read a range of the existing copy of the file being rebuilt"""
+        self._ensure_current()
+        if self._basis is None:
+            raise ProtocolError("Copy instruction for a file without a basis")
+        if length > self._remaining:
+            raise ProtocolError("Copy instruction runs past the end of the file")
+        self._basis.seek(offset)
+        data = self._basis.read(length)
+        if len(data) != length:
+            raise ProtocolError("Copy instruction runs past the end of the basis file")
+        return data
+
+    def rewrite(self, offset, data):
+        """Overwrite a range of the stream after close(), for retransmitted chunks"""
+        write_stream_range(self.parts, self._starts, offset, data, sync=True)
+
+    def complete(self):
+        return not self._files and not self._remaining and not self.error
+
+    def close(self):
+        """Wait for queued writes to reach the disk, raising any error they hit"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._basis:
+            self._basis.close()
+            self._basis = None
+        if self.error:
+            raise self.error
+
+    def commit(self):
+        """Move every verified file into place under its real name"""
+        for part, entry in self.parts:
+            if entry.get("dir"):
+                continue
+            target = part[:-len(".part")]
+            os.replace(part, target)
+            if "mtime" in entry:
+                os.utime(target, (entry["mtime"], entry["mtime"]))
+
+    def discard(self):
+        """Drop the partial files, leaving any existing copies as they were"""
+        try:
+            self.close()
+        except OSError:
+            pass
+        for part, entry in self.parts:
+            if not entry.get("dir") and os.path.exists(part):
+                os.remove(part)
+
+    def _ensure_current(self):
+        if self._remaining:
+            return
+        if not self._files:
+            raise ProtocolError("Received more data than the manifest announced")
+        if self._basis:
+            self._basis.close()
+            self._basis = None
+        self._index, target, entry = self._files.pop()
+        self._remaining = entry["size"]
+        if self._index in self._bases:
+            self._basis = open(target, "rb")
+
+    def _write_behind(self):
+        current = None
+        current_index = None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.error:
+                continue  # Keep draining so the receiving side never blocks
+            index, data = item
+            started = time.perf_counter()
+            try:
+                if index != current_index:
+                    if current:
+                        self._finish_part(current)
+                    part, entry = self.parts[index]
+                    current = open(part, "wb")
+                    current_index = index
+                    preallocate(current, entry["size"])
+                current.write(data)
+            except OSError as e:
+                self.error = e
+            self.disk_seconds += time.perf_counter() - started
+        if current:
+            started = time.perf_counter()
+            try:
+                self._finish_part(current)
+            except OSError as e:
+                self.error = self.error or e
+            self.disk_seconds += time.perf_counter() - started
+
+    @staticmethod
+    def _finish_part(f):
+        try:
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+class ArchiveWriter:
+    """Unpack a read_archive() stream into the files it holds as it arrives.
+
+    A write-behind thread fed through a queue of at most queue_depth
+    buffers parses the records and writes each file to "<name>.part",
+    with commit() and discard() as in BatchWriter. Every file is synced
+    before commit() renames it, as there, but on a pool of sync workers
+    that takes each finished file while the next ones are written, so the
+    filesystem can commit many small files together; the directories they
+    went into are synced last. Only files of ARCHIVE_SMALL_FILE_SIZE or
+    more are preallocated. entries fills in as records arrive; count and size are
+    the entry count and file bytes the sender announced.
+    """
+
+    def __init__(self, root, count, size, queue_depth=WRITE_QUEUE_DEPTH):
+        self.root = root
+        self.count = count
+        self.total_size = size
+        self.entries = []
+        self.parts = []  # (path written to, entry) for every entry unpacked so far
+        self.error = None
+        self.stall_seconds = 0.0  # Time write() waited for room in the queue
+        self.disk_seconds = 0.0  # Time the write-behind thread spent unpacking and syncing
+        self._header = bytearray()
+        self._record = None  # (kind, path length, size, mtime) of a record whose path is still arriving
+        self._file = None
+        self._remaining = 0
+        self._folders = set()  # Directories known to exist
+        self._syncs = ThreadPoolExecutor(ARCHIVE_SYNC_WORKERS, thread_name_prefix="archive-sync")
+        self._sync_slots = threading.Semaphore(ARCHIVE_SYNC_BACKLOG)
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._thread = threading.Thread(target=self._write_behind, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        """Queue data for the write-behind thread; the caller may reuse data right away"""
+        if self.error:
+            raise self.error
+        item = bytes(data)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # The disk is behind the network
+            started = time.perf_counter()
+            self._queue.put(item)
+            self.stall_seconds += time.perf_counter() - started
+
+    def complete(self):
+        return (not self.error and not self._remaining and not self._header
+                and len(self.entries) == self.count)
+
+    def close(self):
+        """Wait for queued writes to reach the disk, raising any error they hit"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self.error:
+            raise self.error
+
+    def commit(self):
+        """Move every verified file into place under its real name"""
+        for part, entry in self.parts:
+            if entry.get("dir"):
+                continue
+            target = part[:-len(".part")]
+            os.replace(part, target)
+            os.utime(target, (entry["mtime"], entry["mtime"]))
+
+    def discard(self):
+        """Drop the partial files, leaving any existing copies as they were"""
+        try:
+            self.close()
+        except (OSError, ProtocolError):
+            pass
+        for part, entry in self.parts:
+            if not entry.get("dir") and os.path.exists(part):
+                os.remove(part)
+
+    def _write_behind(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self.error:
+                continue  # Keep draining so the receiving side never blocks
+            started = time.perf_counter()
+            try:
+                self._unpack(memoryview(data))
+            except (OSError, ProtocolError) as e:
+                self.error = e
+            self.disk_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        if self._file:
+            self._close_file()  # The stream ended inside this file; complete() tells
+        self._syncs.shutdown(wait=True)
+        try:
+            if not self.error:
+                for folder in self._folders:
+                    sync_directory(folder)
+        except OSError as e:
+            self.error = self.error or e
+        self.disk_seconds += time.perf_counter() - started
+
+    def _unpack(self, data):
+        while data:
+            if self._remaining:
+                length = min(len(data), self._remaining)
+                self._file.write(data[:length])
+                data = data[length:]
+                self._remaining -= length
+                if not self._remaining:
+                    self._close_file()
+                continue
+            needed = ARCHIVE_RECORD.size + (self._record[1] if self._record else 0)
+            take = needed - len(self._header)
+            self._header += data[:take]
+            data = data[take:]
+            if len(self._header) < needed:
+                break
+            if self._record is None:
+                self._record = ARCHIVE_RECORD.unpack_from(self._header)
+                if self._record[1]:
+                    continue
+            try:
+                path = self._header[ARCHIVE_RECORD.size:].decode()
+            except UnicodeDecodeError:
+                raise ProtocolError("Archive path is not valid UTF-8") from None
+            kind, _, size, mtime = self._record
+            self._header.clear()
+            self._record = None
+            self._start_entry(kind, path, size, mtime)
+
+    def _start_entry(self, kind, path, size, mtime):
+        if len(self.entries) == self.count:
+            raise ProtocolError("Received more entries than the session announced")
+        target = safe_join(self.root, path)
+        if kind == ARCHIVE_DIR:
+            entry = {"path": path, "size": 0, "dir": True}
+            os.makedirs(target, exist_ok=True)
+            self._folders.add(target)
+            self.parts.append((target, entry))
+            self.entries.append(entry)
+            return
+        if kind != ARCHIVE_FILE:
+            raise ProtocolError(f"Unknown archive entry kind {kind}")
+        entry = {"path": path, "size": size, "mtime": mtime}
+        folder = os.path.dirname(target)
+        if folder not in self._folders:
+            os.makedirs(folder, exist_ok=True)
+            self._folders.add(folder)
+        self.parts.append((target + ".part", entry))
+        self.entries.append(entry)
+        self._file = open(target + ".part", "wb")
+        if size >= ARCHIVE_SMALL_FILE_SIZE:
+            preallocate(self._file, size)
+        self._remaining = size
+        if not size:
+            self._close_file()
+
+    def _close_file(self):
+        f, self._file = self._file, None
+        self._sync_slots.acquire()  # Bounds the files held open for their sync
+        self._syncs.submit(self._sync_file, f)
+
+    def _sync_file(self, f):
+        try:
+            with f:
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            self.error = self.error or e
+        finally:
+            self._sync_slots.release()
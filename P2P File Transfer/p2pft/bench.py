@@ -0,0 +1,262 @@
+"""Loopback benchmarks of the transfer engine, behind p2pft bench"""
+import itertools
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from .engine import ConnectionPool, RateLimiter, Receiver, Sender
+from .identity import generate_certificates, get_cert_fingerprint
+from .protocol import COALESCE_SIZE, PROTOCOL_VERSION
+from .server import Catalog, TransferServer
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows; peak memory is not reported there
+
+BENCH_SIZES = ("1K", "1M", "100M")
+BENCH_SMALL_FILES = ("1000x4K",)
+AUTO_BUFFER = "auto"  # Buffer size of cases where the engine tunes frames and socket buffers itself
+FILL_BLOCK_SIZE = 16 * 1024 * 1024  # Generated files repeat a block this large, beyond any compressor's window
+SMALL_FILES_PER_DIR = 1000
+HANDSHAKE_SAMPLES = 5
+CONNECT_RETRY_TIMEOUT = 10  # Seconds a receiver keeps retrying while the sender starts listening
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+WORDS = ("peer", "file", "transfer", "chunk", "frame", "socket", "merkle", "delta", "swarm", "offer",
+         "receiver", "sender", "batch", "stream", "session", "catalog", "fingerprint", "packet")
+
+def parse_size(text):
+    """Bytes in a size such as 512, 4K, 100M or 10G (binary units)"""
+    text = text.strip().upper().removesuffix("B")
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+def parse_buffer_size(text):
+    """AUTO_BUFFER, or the bytes of a fixed data frame size"""
+    return AUTO_BUFFER if text.strip().lower() == AUTO_BUFFER else parse_size(text)
+
+def parse_workload(spec):
+    """(file count, file size) of "100M" (one file) or "1000x4K" (a tree of small files)"""
+    count, _, size = spec.rpartition("x")
+    return (int(count) if count else 1), parse_size(size)
+
+def fill_block(content):
+    if content == "random":
+        return os.urandom(FILL_BLOCK_SIZE)
+    rng = random.Random(0)
+    text = " ".join(rng.choice(WORDS) for _ in range(FILL_BLOCK_SIZE // 5)).encode()
+    return text[:FILL_BLOCK_SIZE]
+
+def make_workload(root, spec, content):
+    """Generate the files of a workload under root once, and return its path"""
+    path = os.path.join(root, f"{spec}-{content}")
+    if os.path.exists(path):
+        return path
+    count, size = parse_workload(spec)
+    block = fill_block(content)
+    partial = path + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    if count == 1 and "x" not in spec:
+        with open(partial, "wb") as f:
+            for offset in range(0, size, len(block)):
+                f.write(block[:min(len(block), size - offset)])
+    else:
+        for index in range(count):
+            folder = os.path.join(partial, f"{index // SMALL_FILES_PER_DIR:04d}")
+            if index % SMALL_FILES_PER_DIR == 0:
+                os.makedirs(folder)
+            # Each file starts at a different point of the block, so no two are alike
+            start = index * 4099 % max(len(block) - size, 1)
+            with open(os.path.join(folder, f"{index:07d}.bin"), "wb") as f:
+                f.write(block[start:start + size])
+    os.replace(partial, path)
+    return path
+
+def build_cases(workloads, content, buffer_sizes, rate_limits, compress, streams, key_types, repeat=1):
+    """Every combination of the swept settings, as dicts that name one run each"""
+    cases = []
+    for workload, buffer_size, rate_limit, compressed, stream_count, key_type, run in itertools.product(
+            workloads, buffer_sizes, rate_limits, compress, streams, key_types, range(repeat)):
+        cases.append({
+            "workload": workload, "content": content, "buffer_size": buffer_size, "rate_limit": rate_limit,
+            "compress": compressed, "streams": stream_count, "key_type": key_type, "run": run,
+        })
+    return cases
+
+def case_key(case):
+    """The settings of a case, without the repeat number, for matching runs across result files"""
+    return tuple(case[name] for name in ("workload", "content", "buffer_size", "rate_limit", "compress",
+                                         "streams", "key_type"))
+
+def run_benchmarks(cases, workdir, on_result=None):
+    """Run every case over localhost, each in a fresh process, and return their results.
+
+    A fresh process per case keeps the peak memory and CPU time of one
+    case from leaking into the next. CPU time covers the sender and the
+    receiver together, as both run in that process.
+    """
+    data_dir = os.path.join(workdir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    for content, workload in {(case["content"], case["workload"]) for case in cases}:
+        make_workload(data_dir, workload, content)
+    for key_type in {case["key_type"] for case in cases}:
+        generate_certificates(*identity_paths(workdir, key_type), key_type=key_type)
+
+    results = []
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        jobs = [dict(case, workdir=workdir) for case in cases]
+        for result in pool.imap(run_case, jobs):
+            results.append(result)
+            if on_result:
+                on_result(result)
+    return results
+
+def benchmark_report(results, label=None):
+    """The JSON document of a benchmark run, with what is needed to compare it to others"""
+    return {
+        "label": label,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "protocol_version": PROTOCOL_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+
+def compare_results(results, baseline):
+    """(case, MB/s, baseline MB/s) for each case also in the baseline, using the best of the repeats"""
+    def best(entries):
+        speeds = {}
+        for entry in entries:
+            if entry["status"] == "Completed":
+                key = case_key(entry)
+                speeds[key] = max(speeds.get(key, 0.0), entry["mb_per_s"])
+        return speeds
+    current, previous = best(results), best(baseline["results"])
+    return [(dict(zip(("workload", "content", "buffer_size", "rate_limit", "compress", "streams", "key_type"), key)),
+             speed, previous[key]) for key, speed in current.items() if key in previous]
+
+def identity_paths(workdir, key_type):
+    return os.path.join(workdir, f"{key_type}_cert.pem"), os.path.join(workdir, f"{key_type}_key.pem")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def retry_refused(function):
+    """Call function until the listener it connects to is up"""
+    deadline = time.monotonic() + CONNECT_RETRY_TIMEOUT
+    while True:
+        try:
+            return function()
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+def run_case(case):
+    """Run one case; called in the benchmark's worker process"""
+    scratch = tempfile.mkdtemp(prefix="case-", dir=case["workdir"])
+    os.chdir(scratch)  # The receiver's chunk store and anything else relative lands here
+    try:
+        result = dict(case, **_measure(case, scratch))
+    except Exception as e:
+        result = dict(case, status=f"Error: {e}")
+    finally:
+        os.chdir(case["workdir"])
+        shutil.rmtree(scratch, ignore_errors=True)
+    del result["workdir"]
+    return result
+
+def _measure(case, scratch):
+    cert_path, key_path = identity_paths(case["workdir"], case["key_type"])
+    fingerprint = get_cert_fingerprint(cert_path)
+    source = os.path.join(case["workdir"], "data", f"{case['workload']}-{case['content']}")
+    autotune = case["buffer_size"] == AUTO_BUFFER
+    options = dict(compress=case["compress"], rate_limiter=RateLimiter(case["rate_limit"] * 1024 * 1024),
+                   cert_path=cert_path, key_path=key_path, autotune=autotune,
+                   buffer_size=COALESCE_SIZE if autotune else case["buffer_size"])
+    full, resumed = _measure_handshakes(fingerprint, cert_path, key_path)
+
+    port = free_port()
+    stop = threading.Event()
+    if case["streams"] == 1:
+        sender = Sender([source], port=port, **options)
+        thread = threading.Thread(target=sender.send, daemon=True)
+    else:
+        server = TransferServer(Catalog.from_paths([source]), port=port, **options)
+        thread = threading.Thread(target=server.run, args=(stop,), daemon=True)
+    thread.start()
+
+    results = []
+    def receive(index):
+        receiver = Receiver("127.0.0.1", port, fingerprint, os.path.join(scratch, f"received-{index}"),
+                            pool=ConnectionPool(), autotune=autotune)
+        os.makedirs(receiver.save_path)
+        results.append(retry_refused(receiver.receive))
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    receivers = [threading.Thread(target=receive, args=(index,)) for index in range(case["streams"])]
+    for receiver in receivers:
+        receiver.start()
+    for receiver in receivers:
+        receiver.join()
+    seconds = time.perf_counter() - started
+    cpu_seconds = time.process_time() - cpu_started
+    stop.set()
+    thread.join(timeout=CONNECT_RETRY_TIMEOUT)
+
+    size = sum(result.size for result in results)
+    failed = [result.status for result in results if not result.ok]
+    return {
+        "status": failed[0] if failed else "Completed",
+        "bytes": size,
+        "seconds": round(seconds, 4),
+        "mb_per_s": round(size / (1024 * 1024) / seconds, 2),
+        "cpu_seconds_per_gb": round(cpu_seconds / (size / 1024 ** 3), 3) if size else None,
+        "handshake_ms": full,
+        "resumed_handshake_ms": resumed,
+        "peak_memory_mb": _peak_memory_mb(),
+    }
+
+def _measure_handshakes(fingerprint, cert_path, key_path):
+    """Median milliseconds of a full TLS handshake and of a resumed one, connect included"""
+    port = free_port()
+    stop = threading.Event()
+    server = TransferServer(Catalog(), port=port, cert_path=cert_path, key_path=key_path)
+    thread = threading.Thread(target=server.run, args=(stop,), daemon=True)
+    thread.start()
+    pool = ConnectionPool()
+    receiver = Receiver("127.0.0.1", port, fingerprint, None, pool=pool)
+    key = ("127.0.0.1", port, fingerprint)
+    samples = {"full": [], "resumed": []}
+    try:
+        for _ in range(HANDSHAKE_SAMPLES):
+            pool.clear()
+            for kind in ("full", "resumed"):
+                started = time.perf_counter()
+                framed = retry_refused(lambda: receiver._open(key))
+                samples[kind].append((time.perf_counter() - started) * 1000)
+                pool.remember_session(key, framed.sock)
+                framed.sock.close()
+    finally:
+        stop.set()
+        thread.join(timeout=CONNECT_RETRY_TIMEOUT)
+    return tuple(round(statistics.median(samples[kind]), 3) for kind in ("full", "resumed"))
+
+def _peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
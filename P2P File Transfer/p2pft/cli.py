@@ -0,0 +1,418 @@
+"""Command line front end: p2pft send / recv / serve / seed / join / discover / bench / identity"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from . import bench
+from .dedup import CHUNK_STORE_MAX_SIZE
+from .discovery import ANNOUNCE_INTERVAL, Discovery
+from .engine import (
+    DEFAULT_PORT, RATE_LIMIT_BYTES, RateLimiter, Receiver, Sender, TransferProgress,
+    format_size, local_ip, parse_connection_code,
+)
+from .identity import (
+    DEFAULT_KEY_TYPE, KEY_TYPES, generate_certificates, get_cert_fingerprint, identity_backup_suffix,
+    is_legacy_identity, rotate_identity,
+)
+from .metrics import METRICS_LOG, METRICS_PROMETHEUS_FILE, MetricsRecorder
+from .protocol import ProtocolError
+from .server import MAX_CONCURRENT_READS, Catalog, TransferServer
+from .settings import SecureSettings
+from .swarm import SwarmNode
+
+REPORT_INTERVAL = 1.0  # seconds between progress lines
+SETTINGS_COMMANDS = ("send", "serve", "recv", "seed", "join")  # Commands whose defaults come from the saved settings
+
+def report_progress(progress):
+    """Print progress to stderr about once a second until the transfer finishes"""
+    while not progress.finished:
+        time.sleep(REPORT_INTERVAL)
+        percent, done, speed, eta = progress.sample()
+        if progress.total and speed > 0:
+            eta_text = f", ETA {eta:.0f}s" if eta is not None else ""
+            print(f"\r{format_size(done)} of {format_size(progress.total)} ({percent:.0f}%) "
+                  f"at {speed / (1024 * 1024):.2f} MB/s{eta_text}   ", end="", file=sys.stderr)
+    print(file=sys.stderr)
+
+def watch(progress):
+    threading.Thread(target=report_progress, args=(progress,), daemon=True).start()
+
+def print_result(result, peer=None):
+    peer = peer or result.peer
+    peer_text = f" {peer}" if peer else ""
+    print(f"{result.status}{peer_text}: {result.name} ({format_size(result.size)})")
+
+def print_error(error):
+    print(f"Error: {error}", file=sys.stderr)
+
+def ensure_identity():
+    """Create this node's identity if there is none, and point out a legacy one"""
+    generate_certificates()
+    if is_legacy_identity():
+        print(f"Note: this node still uses a legacy RSA identity; 'p2pft identity --rotate' replaces it "
+              f"with {DEFAULT_KEY_TYPE.upper()}, which changes the fingerprint peers have saved", file=sys.stderr)
+
+def record_metrics(args, result, direction):
+    if args.metrics:
+        MetricsRecorder().record(result, direction)
+
+def prepare_sending(args):
+    missing = [path for path in args.paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"No such file or directory: {missing[0]}")
+    ensure_identity()
+    print(f"Connection code: {local_ip()}:{args.port}:{get_cert_fingerprint()[:8]}")
+    print(f"Fingerprint: {get_cert_fingerprint()}")
+    return dict(port=args.port, compress=args.compress, delta=args.delta, dedup=args.dedup,
+                rate_limiter=RateLimiter(args.rate_limit * 1024 * 1024), archive=args.archive)
+
+def start_announcing(args, offers):
+    """Announce this sender on the LAN unless --no-announce; returns the Discovery to close, or None"""
+    if not args.announce:
+        return None
+    discovery = Discovery(get_cert_fingerprint(), args.port, offers=offers)
+    try:
+        discovery.start()
+    except OSError as e:
+        print_error(f"LAN discovery unavailable: {e}")
+        return None
+    return discovery
+
+def stop_announcing(discovery):
+    if discovery:
+        discovery.close()
+
+def cmd_send(args):
+    sender = Sender(args.paths, **prepare_sending(args))
+    progress = TransferProgress()
+    watch(progress)
+    discovery = start_announcing(args, [os.path.basename(os.path.normpath(path)) for path in args.paths])
+    try:
+        result = sender.send(progress, on_error=print_error)
+    finally:
+        stop_announcing(discovery)
+    print_result(result)
+    record_metrics(args, result, "Sent")
+    return 0 if result.ok else 1
+
+def cmd_serve(args):
+    catalog = Catalog.from_paths(args.paths)
+    server = TransferServer(catalog, max_reads=args.max_reads, broadcast=args.broadcast,
+                            **prepare_sending(args))
+    stop = threading.Event()
+    names = [offer['name'] for offer in catalog.describe()]
+    print(f"Serving {', '.join(names)} on port {args.port}, press Ctrl+C to stop")
+    discovery = start_announcing(args, names)
+    
+    def on_result(result, peer):
+        print_result(result, peer)
+        record_metrics(args, result, "Sent")
+    
+    try:
+        server.run(stop, on_result=on_result, on_error=print_error)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        stop_announcing(discovery)
+    return 0
+
+def make_receiver(args):
+    if args.fingerprint:
+        host, port, fingerprint = args.peer, args.port, args.fingerprint
+    else:
+        host, port, fingerprint = parse_connection_code(args.peer)
+    return Receiver(host, port, fingerprint, args.dest, args.cache_size, offer=args.offer)
+
+def cmd_recv(args):
+    receiver = make_receiver(args)
+    if args.list:
+        for offer in receiver.list_offers():
+            print(f"{offer['name']}\t{offer['files']} file(s)\t{format_size(offer['size'])}")
+        return 0
+    if not args.dest:
+        raise ValueError("No destination given and no default save path in the settings")
+    os.makedirs(args.dest, exist_ok=True)
+    progress = TransferProgress()
+    watch(progress)
+    result = receiver.receive(progress)
+    print_result(result)
+    record_metrics(args, result, "Received")
+    return 0 if result.ok else 1
+
+def cmd_seed(args):
+    missing = [path for path in args.paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"No such file or directory: {missing[0]}")
+    ensure_identity()
+    node = SwarmNode.seed(args.paths, port=args.port, rate_limiter=RateLimiter(args.rate_limit * 1024 * 1024))
+    print(f"Connection code: {local_ip()}:{args.port}:{node.fingerprint[:8]}")
+    print(f"Seeding {node.store.descriptor.piece_count} pieces, press Ctrl+C to stop")
+    run_until_interrupted(node)
+    return 0
+
+def cmd_join(args):
+    ensure_identity()
+    host, port, fingerprint = parse_connection_code(args.peer)
+    os.makedirs(args.dest, exist_ok=True)
+    node = SwarmNode.join((host, port), fingerprint, args.dest, port=args.port,
+                          rate_limiter=RateLimiter(args.rate_limit * 1024 * 1024))
+    watch(node.progress)
+    stop = threading.Event()
+    if args.leave_when_done:
+        def leave():
+            node.completed.wait()
+            stop.set()
+        threading.Thread(target=leave, daemon=True).start()
+    run_until_interrupted(node, stop)
+    return 0 if node.completed.is_set() else 1
+
+def cmd_discover(args):
+    discovery = Discovery()
+    discovery.start()
+    try:
+        time.sleep(args.wait)
+        peers = discovery.peers()
+    finally:
+        discovery.close()
+    for peer in peers:
+        offers = ", ".join(peer["offers"])
+        if peer["offer_count"] > len(peer["offers"]):
+            offers += f" and {peer['offer_count'] - len(peer['offers'])} more"
+        print(f"{peer['name']}\t{peer['host']}:{peer['port']}:{peer['fingerprint'][:8]}\t{offers}")
+    if not peers:
+        print("No peers found", file=sys.stderr)
+    return 0
+
+def cmd_bench(args):
+    cases = bench.build_cases(args.sizes + args.small_files, args.content, args.buffer_sizes, args.rate_limits,
+                              args.compress, args.streams, args.key_types, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="p2pft-bench-")
+    print(f"Running {len(cases)} case(s) in {workdir}", file=sys.stderr)
+    
+    def report(result):
+        rate = f"{result['rate_limit']:g} MB/s" if result["rate_limit"] else "unlimited"
+        settings = (f"{result['workload']} {result['content']}, buffer {describe_buffer(result['buffer_size'])}, "
+                    f"rate {rate}, compress {'on' if result['compress'] else 'off'}, "
+                    f"{result['streams']} stream(s), {result['key_type']}")
+        if result["status"] != "Completed":
+            print(f"{settings}: {result['status']}")
+            return
+        print(f"{settings}: {result['mb_per_s']:.1f} MB/s, {result['cpu_seconds_per_gb']} CPU s/GB, "
+              f"handshake {result['handshake_ms']:.1f} ms ({result['resumed_handshake_ms']:.1f} ms resumed), "
+              f"peak memory {result['peak_memory_mb']} MB")
+    
+    try:
+        results = bench.run_benchmarks(cases, os.path.abspath(workdir), on_result=report)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, "w") as f:
+        json.dump(bench.benchmark_report(results, args.label), f, indent=2)
+    print(f"Results saved to {args.output}", file=sys.stderr)
+    
+    if baseline:
+        label = baseline.get("label") or baseline.get("date")
+        for case, speed, previous in bench.compare_results(results, baseline):
+            change = f" ({(speed / previous - 1) * 100:+.0f}%)" if previous else ""
+            print(f"{case['workload']} {case['content']}, buffer {describe_buffer(case['buffer_size'])}, "
+                  f"compress {'on' if case['compress'] else 'off'}, {case['streams']} stream(s), "
+                  f"{case['key_type']}: {speed:.1f} MB/s vs {previous:.1f} MB/s in {label}{change}")
+    return 0 if all(result["status"] == "Completed" for result in results) else 1
+
+def describe_buffer(buffer_size):
+    return buffer_size if buffer_size == bench.AUTO_BUFFER else format_size(buffer_size)
+
+def cmd_identity(args):
+    if args.rotate:
+        suffix = identity_backup_suffix()
+        old_fingerprint, fingerprint = rotate_identity(key_type=args.key_type)
+        if old_fingerprint:
+            print(f"Old fingerprint: {old_fingerprint} (kept with a {suffix} suffix)")
+            print("Peers that saved the old fingerprint need the new one before they can connect",
+                  file=sys.stderr)
+    else:
+        ensure_identity()
+        fingerprint = get_cert_fingerprint()
+    print(f"Fingerprint: {fingerprint}")
+    return 0
+
+def comma_list(convert):
+    """argparse type for comma-separated values"""
+    def parse(text):
+        return [convert(item) for item in text.split(",") if item.strip()]
+    return parse
+
+def on_off(text):
+    if text.strip().lower() not in ("on", "off"):
+        raise argparse.ArgumentTypeError(f"expected on or off, not {text!r}")
+    return text.strip().lower() == "on"
+
+def run_until_interrupted(node, stop=None):
+    stop = stop or threading.Event()
+    try:
+        node.run(stop)
+    except KeyboardInterrupt:
+        stop.set()
+
+def build_parser(settings, commands_action="parsers"):
+    """The p2pft argument parser, with defaults taken from settings"""
+    parser = argparse.ArgumentParser(
+        prog="p2pft",
+        description="Secure peer-to-peer file transfer without the GUI",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    commands = parser.add_subparsers(dest="command", required=True, action=commands_action)
+    
+    for name, help_text in (("send", "Send files to the next receiver that connects"),
+                            ("serve", "Serve files to any number of receivers at once until stopped")):
+        command = commands.add_parser(name, help=help_text,
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        command.add_argument('paths', nargs='+', help="Files and folders to send")
+        command.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                             help="Port to listen on")
+        command.add_argument('--rate-limit', type=float,
+                             default=settings.get("rate_limit", RATE_LIMIT_BYTES) / (1024 * 1024),
+                             help="Rate limit in MB/s (0 = unlimited)")
+        command.add_argument('--compress', action=argparse.BooleanOptionalAction,
+                             default=settings.get("compression", False), help="Compress data frames")
+        command.add_argument('--delta', action=argparse.BooleanOptionalAction,
+                             default=settings.get("delta_sync", True),
+                             help="Only send changes to files the receiver already has")
+        command.add_argument('--metrics', action='store_true',
+                             help=f"Record each transfer in {METRICS_LOG} and {METRICS_PROMETHEUS_FILE}")
+        command.add_argument('--announce', action=argparse.BooleanOptionalAction, default=True,
+                             help="Announce this sender to p2pft peers on the local network")
+        command.add_argument('--dedup', action=argparse.BooleanOptionalAction,
+                             default=settings.get("dedup", False),
+                             help="Skip chunks the receiver already has from earlier transfers")
+        command.add_argument('--archive', action=argparse.BooleanOptionalAction,
+                             default=settings.get("archive_mode", False),
+                             help="Stream folders as one archive, fastest for many small files "
+                                  "(replaces --delta and --dedup)")
+        command.set_defaults(func=cmd_send if name == "send" else cmd_serve)
+        if name == "serve":
+            command.add_argument('--max-reads', type=int, default=MAX_CONCURRENT_READS,
+                                 help="Disk reads in flight across all receivers")
+            command.add_argument('--broadcast', action='store_true',
+                                 help="Read each offer once for all receivers that fetch it together")
+    
+    recv = commands.add_parser("recv", help="Receive files from a sender",
+                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    recv.add_argument('peer', help="Connection code (ip:port:fingerprint), or the sender's address with --fingerprint")
+    recv.add_argument('-f', '--fingerprint', help="Sender's certificate fingerprint")
+    recv.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                      help="Sender's port when not using a connection code")
+    recv.add_argument('-d', '--dest', default=settings.get("default_save_path") or None,
+                      help="Directory to save into")
+    recv.add_argument('--cache-size', type=float,
+                      default=settings.get("chunk_cache_size", CHUNK_STORE_MAX_SIZE),
+                      help="Chunk cache size in bytes")
+    recv.add_argument('-o', '--offer', help="Name of the offer to fetch from a serving peer (default: all)")
+    recv.add_argument('-l', '--list', action='store_true', help="List a serving peer's offers and exit")
+    recv.add_argument('--metrics', action='store_true',
+                      help=f"Record the transfer in {METRICS_LOG} and {METRICS_PROMETHEUS_FILE}")
+    recv.set_defaults(func=cmd_recv)
+    
+    seed = commands.add_parser("seed", help="Start a swarm that distributes files to every peer that joins",
+                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    seed.add_argument('paths', nargs='+', help="Files and folders to distribute")
+    seed.set_defaults(func=cmd_seed)
+    
+    join = commands.add_parser("join", help="Join a swarm, fetching from and sharing with the other peers",
+                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    join.add_argument('peer', help="Connection code of the seeder")
+    join.add_argument('-d', '--dest', default=settings.get("default_save_path") or ".",
+                      help="Directory to save into")
+    join.add_argument('--leave-when-done', action='store_true',
+                      help="Stop sharing once every piece has arrived")
+    join.set_defaults(func=cmd_join)
+    
+    for command in (seed, join):
+        command.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                             help="Port to share pieces on")
+        command.add_argument('--rate-limit', type=float,
+                             default=settings.get("rate_limit", RATE_LIMIT_BYTES) / (1024 * 1024),
+                             help="Upload rate limit in MB/s (0 = unlimited)")
+    
+    discover = commands.add_parser("discover", help="List the p2pft senders announcing themselves on the local network",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    discover.add_argument('-w', '--wait', type=float, default=1.0,
+                          help=f"Seconds to listen; senders answer at once, and announce every {ANNOUNCE_INTERVAL}s")
+    discover.set_defaults(func=cmd_discover)
+    
+    bench_command = commands.add_parser("bench", help="Measure transfer throughput between a sender and receiver on localhost",
+                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    bench_command.add_argument('--sizes', type=comma_list(str.strip), default=list(bench.BENCH_SIZES),
+                               help="Sizes of single-file workloads, e.g. 1K,1M,100M,10G")
+    bench_command.add_argument('--small-files', type=comma_list(str.strip), default=list(bench.BENCH_SMALL_FILES),
+                               help="Many-file workloads as COUNTxSIZE, e.g. 200000x1K")
+    bench_command.add_argument('--content', choices=("random", "text"), default="random",
+                               help="Generate incompressible or compressible files")
+    bench_command.add_argument('--buffer-sizes', type=comma_list(bench.parse_buffer_size), default=[bench.AUTO_BUFFER],
+                               help="Data frame sizes to sweep, e.g. auto,64K,256K,1M; "
+                                    "auto lets the engine fit frames and socket buffers to the connection")
+    bench_command.add_argument('--rate-limits', type=comma_list(float), default=[0.0],
+                               help="Rate limits in MB/s to sweep (0 = unlimited)")
+    bench_command.add_argument('--compress', type=comma_list(on_off), default=[False],
+                               help="Compression settings to sweep: off, on or off,on")
+    bench_command.add_argument('--streams', type=comma_list(int), default=[1],
+                               help="Receivers fetching at once; above 1 they fetch from a TransferServer")
+    bench_command.add_argument('--key-types', type=comma_list(str.strip), default=[DEFAULT_KEY_TYPE],
+                               help=f"TLS identities to sweep: {', '.join(KEY_TYPES)}")
+    bench_command.add_argument('--repeat', type=int, default=1, help="Runs of every case")
+    bench_command.add_argument('--workdir',
+                               help="Directory for generated files, kept for later runs (default: a temporary one)")
+    bench_command.add_argument('--label', help="Name of this run in the results, e.g. a version")
+    bench_command.add_argument('-o', '--output', default=f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json",
+                               help="JSON file to save the results to")
+    bench_command.add_argument('--compare', help="Results of an earlier run to compare speeds with")
+    bench_command.set_defaults(func=cmd_bench)
+    
+    identity = commands.add_parser("identity", help="Show this node's certificate fingerprint, or replace its identity",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    identity.add_argument('--rotate', action='store_true',
+                          help="Generate a new identity; peers that saved the old fingerprint must be given the new one")
+    identity.add_argument('--key-type', choices=KEY_TYPES, default=DEFAULT_KEY_TYPE,
+                          help="Key type of the new identity")
+    identity.set_defaults(func=cmd_identity)
+    return parser
+
+class _CommandChosen(Exception):
+    def __init__(self, command):
+        super().__init__(command)
+        self.command = command
+
+class _StopAtCommand(argparse._SubParsersAction):
+    """Subcommand action that reports the command argparse picked instead of parsing the command's arguments"""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        raise _CommandChosen(values[0])
+
+def chosen_command(argv):
+    """The command argparse runs for argv, found without parsing that command's arguments or help"""
+    try:
+        build_parser({}, commands_action=_StopAtCommand).parse_args(argv)
+    except _CommandChosen as chosen:
+        return chosen.command
+    return None
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Defaults follow the GUI's saved settings; only the commands that use them open the settings store,
+    # so --help, discover, bench and identity leave no settings files behind
+    settings = SecureSettings().load_settings() if chosen_command(argv) in SETTINGS_COMMANDS else {}
+    args = build_parser(settings).parse_args(argv)
+    try:
+        sys.exit(args.func(args))
+    except (OSError, ValueError, ProtocolError) as e:
+        print_error(e)
+        sys.exit(1)
@@ -0,0 +1,134 @@
+"""Adaptive per-frame compression of data frames"""
+import math
+import time
+import zlib
+from collections import Counter
+
+from .protocol import FLAG_ZLIB, FLAG_ZSTD, MAX_FRAME_SIZE, ProtocolError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENTROPY_THRESHOLD = 7.5  # Bits per byte above which data is sent raw
+COMPRESSION_ADAPT_INTERVAL = 16  # Compressed frames between level adjustments
+COMPRESSION_BYPASS_FRAMES = 256  # Raw frames to send before probing compression again
+
+def available_codecs():
+    """Compression codecs this side can decode, best first"""
+    return ["zstd", "zlib"] if zstandard else ["zlib"]
+
+def byte_entropy(data, sample_size=4096):
+    """Estimate the Shannon entropy of data in bits per byte from evenly spaced samples"""
+    if len(data) > sample_size:
+        step = len(data) // 4
+        piece = sample_size // 4
+        sample = b"".join(bytes(data[i:i + piece]) for i in range(0, 4 * step, step))
+    else:
+        sample = bytes(data)
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in Counter(sample).values())
+
+def decompress_frame(flags, payload, limit=MAX_FRAME_SIZE):
+    """Undo the compression named by a data frame's flags"""
+    if flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise ProtocolError("Peer sent zstd data but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload, max_output_size=limit)
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(payload, limit)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ProtocolError("Compressed frame is larger than the maximum frame size")
+        return data
+    return payload
+
+class AdaptiveCompressor:
+    """Per-frame compression that adapts to the data and to the link.
+
+    Frames whose sampled entropy says they are already compressed (media,
+    archives) go out raw. For everything else the level is tuned by
+    comparing the time spent compressing a byte with the time the link
+    needs to send one: it climbs while compressing harder still saves
+    transfer time, and drops, eventually to raw, once the CPU becomes the
+    bottleneck.
+    """
+    LEVELS = {"zstd": (1, 12), "zlib": (1, 9)}
+    START_LEVELS = {"zstd": 3, "zlib": 1}
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.flag = FLAG_ZSTD if codec == "zstd" else FLAG_ZLIB
+        self.min_level, self.max_level = self.LEVELS[codec]
+        self.level = self.START_LEVELS[codec]
+        self.send_cost = None  # Seconds per byte on the wire
+        self.stats = {}  # Level -> [seconds per input byte, compression ratio]
+        self.frames_at_level = 0
+        self.bypass = 0
+        self._compressors = {}
+
+    def compress(self, data):
+        """Return (payload, flags) for the data frame carrying data"""
+        if self.bypass:
+            self.bypass -= 1
+            return data, 0
+        if byte_entropy(data) > ENTROPY_THRESHOLD:
+            return data, 0
+        
+        start = time.perf_counter()
+        compressed = self._compress(data)
+        elapsed = time.perf_counter() - start
+        self._record(elapsed / len(data), len(compressed) / len(data))
+        
+        if len(compressed) >= len(data):
+            return data, 0
+        return compressed, self.flag
+
+    def record_send(self, wire_bytes, seconds):
+        """Feed back how long a frame took to leave, including throttling"""
+        if wire_bytes:
+            self.send_cost = self._ewma(self.send_cost, seconds / wire_bytes)
+
+    def _compress(self, data):
+        if self.codec == "zlib":
+            return zlib.compress(data, self.level)
+        compressor = self._compressors.get(self.level)
+        if compressor is None:
+            compressor = self._compressors[self.level] = zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(data)
+
+    def _record(self, cpu_cost, ratio):
+        previous = self.stats.get(self.level, [None, None])
+        self.stats[self.level] = [self._ewma(previous[0], cpu_cost), self._ewma(previous[1], ratio)]
+        self.frames_at_level += 1
+        if self.frames_at_level >= COMPRESSION_ADAPT_INTERVAL and self.send_cost is not None:
+            self._adapt()
+
+    def _cost(self, level):
+        """Estimated seconds to compress and send one input byte at level"""
+        cpu_cost, ratio = self.stats[level]
+        return cpu_cost + ratio * self.send_cost
+
+    def _adapt(self):
+        self.frames_at_level = 0
+        cost = self._cost(self.level)
+        if cost >= self.send_cost:
+            # Compressing takes longer than sending the bytes raw would
+            if self.level > self.min_level:
+                self.level -= 1
+            else:
+                self.bypass = COMPRESSION_BYPASS_FRAMES
+            return
+        
+        lower, higher = self.level - 1, self.level + 1
+        if lower in self.stats and self._cost(lower) < cost:
+            self.level = lower
+        elif higher <= self.max_level and (higher not in self.stats or self._cost(higher) < cost):
+            self.level = higher
+
+    @staticmethod
+    def _ewma(previous, value, alpha=0.2):
+        return value if previous is None else previous + alpha * (value - previous)
@@ -0,0 +1,197 @@
+"""Content-defined chunking and the receiver's chunk store"""
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+import uuid
+import zlib
+
+from .protocol import RECIPE_RECORD, ProtocolError
+
+CDC_MIN_SIZE = 16 * 1024
+CDC_AVG_BITS = 16  # 64 KB average chunk
+CDC_MAX_SIZE = 256 * 1024
+CDC_READ_SIZE = 4 * 1024 * 1024
+DEDUP_MIN_SIZE = 64 * 1024  # Smaller files are always sent in full
+CHUNK_STORE_MAX_SIZE = 1024 * 1024 * 1024  # 1 GB
+CHUNK_PIN_TIMEOUT = 24 * 60 * 60  # Pins left behind by a receiver that died stop protecting chunks after this
+
+def _cache_dir():
+    """The per-user cache directory of the platform"""
+    if sys.platform == "win32":
+        return os.environ.get("LOCALAPPDATA") or os.path.expanduser(os.path.join("~", "AppData", "Local"))
+    if sys.platform == "darwin":
+        return os.path.expanduser(os.path.join("~", "Library", "Caches"))
+    return os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+
+CHUNK_STORE_DIR = os.path.join(_cache_dir(), "p2pft", "chunk_store")
+
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "big") for i in range(256)]
+CDC_SYMBOLS = bytes(g >> 31 for g in GEAR)  # One pseudo-random bit per byte value
+CDC_ANCHOR = bytes(g & 1 for g in GEAR[:10])  # Run of symbols that marks a candidate cut point
+CDC_WINDOW = 48  # Bytes ending at a candidate that decide whether it is a cut
+CDC_MASK_SMALL = (1 << (CDC_AVG_BITS - len(CDC_ANCHOR) + 2)) - 1  # Harder to match before the average size
+CDC_MASK_LARGE = (1 << (CDC_AVG_BITS - len(CDC_ANCHOR) - 2)) - 1  # Easier to match after it
+
+def cdc_cut(data, symbols, start, end):
+    """Length of the next content-defined chunk of data[start:end].
+
+    A rolling hash costs a Python step per byte, so candidates are found in
+    C instead: symbols is data translated through CDC_SYMBOLS, and
+    bytes.find locates runs that match CDC_ANCHOR. A candidate becomes a cut
+    when the CRC-32 of the CDC_WINDOW bytes ending there matches the mask,
+    so cut points depend only on nearby content. As in FastCDC, the search
+    starts at the minimum chunk size, and normalized chunking uses a
+    stricter mask before the average size and a looser one after it.
+    """
+    available = end - start
+    if available <= CDC_MIN_SIZE:
+        return available
+    normal = start + min(available, 1 << CDC_AVG_BITS)
+    limit = start + min(available, CDC_MAX_SIZE)
+    width = len(CDC_ANCHOR)
+    view = memoryview(data)
+    pos = start + CDC_MIN_SIZE - width
+    for mask, stop in ((CDC_MASK_SMALL, normal), (CDC_MASK_LARGE, limit)):
+        while True:
+            found = symbols.find(CDC_ANCHOR, pos, stop)
+            if found < 0:
+                break
+            cut = found + width
+            if not zlib.crc32(view[cut - CDC_WINDOW:cut]) & mask:
+                return cut - start
+            pos = found + 1
+        pos = stop - width + 1
+    return limit - start
+
+def file_recipe(path):
+    """Split path into content-defined chunks, returned as packed (SHA-256, length) records"""
+    return b"".join(recipe_pieces(path))
+
+def recipe_pieces(path):
+    """file_recipe one read at a time, so each piece can be sent while the rest is chunked"""
+    with open(path, "rb") as f:
+        buf = b""
+        while True:
+            data = f.read(CDC_READ_SIZE)
+            buf += data
+            symbols = buf.translate(CDC_SYMBOLS)
+            view = memoryview(buf)
+            records = bytearray()
+            start = 0
+            while len(buf) - start >= CDC_MAX_SIZE or (not data and start < len(buf)):
+                length = cdc_cut(buf, symbols, start, len(buf))
+                records += RECIPE_RECORD.pack(hashlib.sha256(view[start:start + length]).digest(), length)
+                start += length
+            buf = buf[start:]
+            if records:
+                yield bytes(records)
+            if not data:
+                return
+
+class ChunkStore:
+    """Content-addressed store of received chunks, bounded in size by LRU eviction.
+
+    Chunk data lives in one file per chunk under root, and a SQLite index
+    tracks sizes and last use so lookups never touch the chunk files.
+
+    Each receiver opens its own ChunkStore. The chunks wanted() reports as
+    held are pinned in the index until that store is closed, so a transfer
+    running alongside cannot evict them before they are read.
+    """
+
+    def __init__(self, root=CHUNK_STORE_DIR, max_size=CHUNK_STORE_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.owner = uuid.uuid4().hex  # Marks this store's pins
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, "index.db"))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (digest BLOB PRIMARY KEY, size INTEGER, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_last_used ON chunks (last_used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pins (digest BLOB, owner TEXT, created REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pins_digest ON pins (digest)")
+
+    def wanted(self, records):
+        """Bitmap (MSB first) of the recipe chunks the store does not hold"""
+        digests = [digest for digest, _ in RECIPE_RECORD.iter_unpack(records)]
+        present = set()
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            rows = self.db.execute(
+                f"SELECT digest FROM chunks WHERE digest IN ({','.join('?' * len(batch))})", batch
+            )
+            present.update(row[0] for row in rows)
+        
+        # Keep what this transfer will reuse from being evicted until it is done
+        now = time.time()
+        self.db.executemany("UPDATE chunks SET last_used = ? WHERE digest = ?", [(now, d) for d in present])
+        self.db.executemany("INSERT INTO pins VALUES (?, ?, ?)", [(d, self.owner, now) for d in present])
+        self.db.commit()
+        
+        bitmap = bytearray((len(digests) + 7) // 8)
+        for n, digest in enumerate(digests):
+            if digest not in present:
+                bitmap[n >> 3] |= 0x80 >> (n & 7)
+        return bitmap
+
+    def read(self, digest, length):
+        try:
+            with open(self._path(digest), "rb") as f:
+                data = f.read(length + 1)
+        except OSError:
+            data = b""
+        if len(data) != length or hashlib.sha256(data).digest() != digest:
+            self.db.execute("DELETE FROM chunks WHERE digest = ?", (digest,))
+            self.db.commit()
+            raise ProtocolError(f"Chunk {digest.hex()[:16]} is missing from the chunk store")
+        return data
+
+    def ingest(self, path, records):
+        """Store the chunks of a received file that are not already held"""
+        now = time.time()
+        with open(path, "rb") as f:
+            for digest, length in RECIPE_RECORD.iter_unpack(records):
+                data = f.read(length)
+                if hashlib.sha256(data).digest() != digest:
+                    raise IOError(f"{path} does not match its chunk recipe")
+                if self.db.execute("SELECT 1 FROM chunks WHERE digest = ?", (digest,)).fetchone():
+                    continue
+                chunk_path = self._path(digest)
+                os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                with open(chunk_path + ".tmp", "wb") as out:
+                    out.write(data)
+                os.replace(chunk_path + ".tmp", chunk_path)
+                self.db.execute("INSERT INTO chunks VALUES (?, ?, ?)", (digest, length, now))
+        self.db.commit()
+
+    def evict(self):
+        """Drop least recently used chunks until the store fits in max_size, sparing those other stores pinned"""
+        self.db.execute("DELETE FROM pins WHERE created < ?", (time.time() - CHUNK_PIN_TIMEOUT,))
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+        rows = self.db.execute(
+            "SELECT digest, size FROM chunks WHERE digest NOT IN (SELECT digest FROM pins WHERE owner != ?) "
+            "ORDER BY last_used", (self.owner,)
+        ).fetchall()
+        for digest, size in rows:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+            self.db.execute("DELETE FROM chunks WHERE digest = ?", (digest,))
+            total -= size
+        self.db.commit()
+
+    def close(self):
+        """Release this store's pins and close the index"""
+        self.db.execute("DELETE FROM pins WHERE owner = ?", (self.owner,))
+        self.db.commit()
+        self.db.close()
+
+    def _path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name)
@@ -0,0 +1,144 @@
+"""rsync-style delta encoding against the receiver's existing copy of a file"""
+import hashlib
+import zlib
+
+from .protocol import SIGNATURE_RECORD
+
+DELTA_MIN_SIZE = 256 * 1024  # Smaller files are always sent in full
+DELTA_MIN_BLOCK_SIZE = 4096
+DELTA_MAX_BLOCK_SIZE = 1024 * 1024
+DELTA_READ_SIZE = 4 * 1024 * 1024
+DELTA_LITERAL_SIZE = 256 * 1024  # Literal data is emitted in pieces of this size
+DELTA_MAX_FAILED_SEARCHES = 4  # Fruitless byte-by-byte searches before only aligned blocks are checked
+DELTA_SEARCH_RETRY_BLOCKS = 64  # Aligned misses between searches after that
+
+def delta_block_size(file_size):
+    """Pick a signature block size of roughly sqrt(file_size), as rsync does"""
+    block_size = DELTA_MIN_BLOCK_SIZE
+    while block_size * block_size < file_size and block_size < DELTA_MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+def file_signature(path, block_size):
+    """Weak (Adler-32) and strong (BLAKE2b) hashes of every full block of path"""
+    return b"".join(signature_pieces(path, block_size))
+
+def signature_pieces(path, block_size):
+    """file_signature one read at a time, so each piece can be sent while the rest is hashed"""
+    read_size = max(block_size, DELTA_READ_SIZE - DELTA_READ_SIZE % block_size)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(read_size)
+            view = memoryview(data)
+            full = len(data) - len(data) % block_size
+            if full:
+                yield b"".join(
+                    SIGNATURE_RECORD.pack(zlib.adler32(view[start:start + block_size]),
+                                          hashlib.blake2b(view[start:start + block_size], digest_size=16).digest())
+                    for start in range(0, full, block_size))
+            if len(data) < read_size:
+                return
+
+class DeltaEncoder:
+    """Express a file as literal data plus copies of blocks the receiver has.
+
+    Block boundaries are first checked with a C-speed Adler-32 of the
+    aligned window. On a miss the window is rolled one byte at a time for
+    up to one block to find shifted data (insertions and deletions), and
+    after repeated fruitless searches the encoder only checks aligned
+    windows, retrying a search now and then, so unrelated files do not pay
+    for a per-byte scan in Python.
+    """
+    MOD = 65521
+
+    def __init__(self, block_size, records):
+        self.block_size = block_size
+        self.table = {}
+        for index, (weak, strong) in enumerate(SIGNATURE_RECORD.iter_unpack(records)):
+            self.table.setdefault(weak, {}).setdefault(strong, index)
+
+    def encode(self, f, size, hasher):
+        """Yield ("data", bytes) and ("copy", (offset, length)) operations for the next size bytes of f"""
+        bs = self.block_size
+        buf = bytearray()
+        pos = lit = 0
+        consumed = 0
+        copy = None
+        a = b = 0
+        search_left = 0
+        failed_searches = 0
+        aligned_misses = 0
+        
+        while True:
+            if len(buf) - pos <= bs and consumed < size:
+                # Drop what has been emitted and read the next piece
+                del buf[:lit]
+                pos -= lit
+                lit = 0
+                chunk = f.read(min(DELTA_READ_SIZE, size - consumed))
+                if not chunk:
+                    raise IOError(f"{f.name} changed size during transfer")
+                hasher.update(chunk)
+                buf += chunk
+                consumed += len(chunk)
+                continue
+            if len(buf) - pos < bs:
+                break
+            
+            if not search_left:
+                weak = zlib.adler32(buf[pos:pos + bs])
+                a, b = weak & 0xffff, weak >> 16
+            else:
+                weak = (b << 16) | a
+            block = self._lookup(weak, buf, pos)
+            
+            if block is not None:
+                offset = block * bs
+                if pos > lit or copy is None or copy[0] + copy[1] != offset:
+                    if copy:
+                        yield "copy", tuple(copy)
+                    if pos > lit:
+                        yield "data", bytes(buf[lit:pos])
+                    copy = [offset, 0]
+                copy[1] += bs
+                pos += bs
+                lit = pos
+                search_left = 0
+                failed_searches = 0
+                continue
+            
+            if not search_left:
+                aligned_misses += 1
+                if failed_searches < DELTA_MAX_FAILED_SEARCHES or aligned_misses % DELTA_SEARCH_RETRY_BLOCKS == 0:
+                    search_left = bs
+            if search_left:
+                if pos + bs >= len(buf):
+                    break  # Nothing left to roll in
+                # Roll the weak hash forward by one byte
+                out_byte, in_byte = buf[pos], buf[pos + bs]
+                a = (a - out_byte + in_byte) % self.MOD
+                b = (b - bs * out_byte + a - 1) % self.MOD
+                pos += 1
+                search_left -= 1
+                failed_searches += not search_left
+            else:
+                pos += bs
+            
+            if pos - lit >= DELTA_LITERAL_SIZE:
+                if copy:
+                    yield "copy", tuple(copy)
+                    copy = None
+                yield "data", bytes(buf[lit:pos])
+                lit = pos
+        
+        if copy:
+            yield "copy", tuple(copy)
+        if len(buf) > lit:
+            yield "data", bytes(buf[lit:])
+
+    def _lookup(self, weak, buf, pos):
+        candidates = self.table.get(weak)
+        if not candidates:
+            return None
+        strong = hashlib.blake2b(buf[pos:pos + self.block_size], digest_size=16).digest()
+        return candidates.get(strong)
@@ -0,0 +1,177 @@
+"""Zero-configuration peer discovery on the local network over UDP multicast"""
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+DISCOVERY_GROUP = "239.255.84.70"  # Administratively scoped, so announcements stay on the site network
+DISCOVERY_PORT = 8442
+DISCOVERY_VERSION = 1
+ANNOUNCE_INTERVAL = 5  # Seconds between announcements
+PEER_TTL = 3 * ANNOUNCE_INTERVAL  # A peer is forgotten after missing this long of announcements
+QUERY_REPLY_INTERVAL = 1.0  # Least time between announcements sent in answer to queries
+MAX_ANNOUNCE_SIZE = 1200  # Bytes; fits one datagram on any network, offers beyond it are left out
+MAX_NAME_LENGTH = 64
+
+class Discovery:
+    """Announces this node's listeners on the LAN and keeps a table of the nodes it hears.
+
+    For every port it listens on, a node multicasts a small JSON
+    announcement with its name, the port, its certificate fingerprint and
+    the names of the offers there every interval, and listeners keep each
+    peer for ttl seconds after its last one. A node that starts listening
+    sends a query, which every node answers at once, and a listener that
+    stops says so, so the table is current within a round trip instead of
+    an interval. Listeners are the port and offers given here, if any, and
+    those added with announce() while a sender or server is actually up;
+    without a fingerprint or listeners the node only listens.
+
+    Announcements are not authenticated. The fingerprint they carry is
+    the one the Receiver pins, so a forged announcement can only point at
+    a peer that then fails the TLS handshake.
+    """
+
+    def __init__(self, fingerprint=None, port=None, name=None, offers=(), group=DISCOVERY_GROUP,
+                 discovery_port=DISCOVERY_PORT, interval=ANNOUNCE_INTERVAL, ttl=PEER_TTL):
+        self.fingerprint = fingerprint
+        self.name = (name or socket.gethostname())[:MAX_NAME_LENGTH]
+        self.group = group
+        self.discovery_port = discovery_port
+        self.interval = interval
+        self.ttl = ttl
+        self._listeners = {port: list(offers)} if fingerprint and port else {}  # Port -> offer names
+        self._id = os.urandom(8).hex()  # Tells this node's own announcements apart when they loop back
+        self._lock = threading.Lock()
+        self._peers = {}  # (fingerprint, port) -> (expiry, peer)
+        self._last_reply = 0.0
+        self._stop = threading.Event()
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        """Join the multicast group, announce this node and ask the others to announce themselves"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                # Lets several nodes on one host listen at once
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(("", self.discovery_port))
+            membership = struct.pack("4s4s", socket.inet_aton(self.group), socket.inet_aton("0.0.0.0"))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._send("query")
+        self._thread = threading.Thread(target=self._run, name="discovery", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Tell the other nodes this one is leaving and stop listening"""
+        if self._sock is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        for port in list(self._listeners):
+            self._send("bye", port)
+        self._sock.close()
+        self._sock = None
+
+    def announce(self, port, offers=()):
+        """Announce a listener on port with these offer names, or change its offers, right away"""
+        if not self.fingerprint:
+            raise ValueError("Only a node with a fingerprint can announce listeners")
+        self._listeners[port] = list(offers)
+        if self._sock is not None:
+            self._send("announce", port)
+
+    def withdraw(self, port):
+        """Stop announcing the listener on port, telling the other nodes right away"""
+        if self._listeners.pop(port, None) is not None and self._sock is not None:
+            self._send("bye", port)
+
+    def peers(self):
+        """The nodes heard within the last ttl seconds, as dicts of host, port, fingerprint, name and offers"""
+        now = time.monotonic()
+        with self._lock:
+            for key, (expiry, _) in list(self._peers.items()):
+                if expiry <= now:
+                    del self._peers[key]
+            return sorted((dict(peer) for _, peer in self._peers.values()), key=lambda peer: peer["name"].lower())
+
+    def _run(self):
+        next_announce = 0.0
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_announce:
+                self._announce_all()
+                next_announce = now + self.interval
+            self._sock.settimeout(min(max(next_announce - now, 0.05), 0.5))
+            try:
+                data, (host, _) = self._sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stop.is_set():
+                    return
+                continue
+            self._handle(data, host)
+
+    def _handle(self, data, host):
+        try:
+            message = json.loads(data)
+            if message.get("p2pft") != DISCOVERY_VERSION or message.get("id") == self._id:
+                return
+            kind = message.get("type")
+            if kind == "query":
+                now = time.monotonic()
+                if self._listeners and now - self._last_reply >= QUERY_REPLY_INTERVAL:
+                    self._last_reply = now
+                    self._announce_all()
+                return
+            key = (str(message["fingerprint"]).lower(), int(message["port"]))
+            if kind == "bye":
+                with self._lock:
+                    self._peers.pop(key, None)
+                return
+            if kind != "announce" or len(key[0]) != 64 or not 0 < key[1] < 65536:
+                return
+            peer = {
+                "host": host,
+                "port": key[1],
+                "fingerprint": key[0],
+                "name": str(message.get("name") or host)[:MAX_NAME_LENGTH],
+                "offers": [str(offer) for offer in message.get("offers", [])],
+                "offer_count": int(message.get("offer_count", 0)),
+            }
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return  # Not one of ours
+        with self._lock:
+            self._peers[key] = (time.monotonic() + self.ttl, peer)
+
+    def _announce_all(self):
+        for port in list(self._listeners):
+            self._send("announce", port)
+
+    def _send(self, kind, port=None):
+        message = {"p2pft": DISCOVERY_VERSION, "type": kind, "id": self._id}
+        if kind != "query":
+            message.update(fingerprint=self.fingerprint, port=port)
+        if kind == "announce":
+            offers = list(self._listeners.get(port, ()))
+            message.update(name=self.name, offers=offers, offer_count=len(offers))
+            data = json.dumps(message).encode()
+            while len(data) > MAX_ANNOUNCE_SIZE and offers:
+                offers.pop()
+                data = json.dumps(message).encode()
+        else:
+            data = json.dumps(message).encode()
+        try:
+            self._sock.sendto(data, (self.group, self.discovery_port))
+        except OSError:
+            pass  # No route to the group right now; the next announcement tries again
@@ -0,0 +1,709 @@
+"""Sender and receiver sessions, independent of any user interface"""
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+
+from .batch import (
+    ArchiveWriter, BatchWriter, archive_size, build_manifest, read_archive, read_batch, read_stream_range, safe_join,
+    stream_starts,
+)
+from .compression import AdaptiveCompressor, available_codecs, decompress_frame
+from .dedup import CHUNK_STORE_MAX_SIZE, DEDUP_MIN_SIZE, ChunkStore, recipe_pieces
+from .delta import delta_block_size, signature_pieces
+from .identity import CERT_FILE, KEY_FILE, fingerprint_matches
+from .merkle import VERIFY_CHUNK_SIZE, LeafChecker, MerkleHasher, merkle_root
+from .metrics import TimedHasher, TransferMetrics
+from .protocol import (
+    COALESCE_SIZE, COPY_INSTRUCTION, FRAME_CHUNK, FRAME_CONTROL, FRAME_COPY, FRAME_DATA,
+    FRAME_LEAF, FRAME_TRAILER, FRAME_WANT, LEAF_HEADER, MAX_FRAME_SIZE, RECIPE_RECORD, FramedSocket,
+    ProtocolError,
+)
+from .tuning import PathTuner
+
+DEFAULT_PORT = 8443
+RATE_LIMIT_BYTES = 1024 * 1024 * 10  # 10 MB/s
+TRANSFER_TIMEOUT = 30  # seconds
+MAX_RETRIES = 3
+KEEPALIVE_TIMEOUT = 20  # Seconds a pooled connection stays idle, below the server's TRANSFER_TIMEOUT
+
+class RateLimiter:
+    """Token bucket shared by every transfer in the process.
+
+    Tokens refill continuously from a monotonic clock. acquire() reserves a
+    whole buffer at once, letting the bucket go into debt, and sleeps
+    exactly as long as it takes to pay that back, so concurrent senders
+    queue up for one budget instead of bursting at the start of each
+    second. A rate of 0 means unlimited, and set_rate() applies to
+    transfers already running.
+    """
+
+    def __init__(self, rate_limit_bytes, burst_seconds=0.1):
+        self._lock = threading.Lock()
+        self.burst_seconds = burst_seconds
+        self.rate_limit = 0
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate_limit_bytes)
+        self._tokens = self.burst
+
+    def set_rate(self, rate_limit_bytes):
+        with self._lock:
+            self._refill()
+            self.rate_limit = max(0, rate_limit_bytes)
+            self.burst = self.rate_limit * self.burst_seconds
+            self._tokens = min(self._tokens, self.burst)
+
+    def acquire(self, bytes_count):
+        """Reserve bytes_count bytes of budget, sleeping until it is available; returns the seconds slept"""
+        wait = self.reserve(bytes_count)
+        if wait > 0:
+            time.sleep(wait)
+        return max(wait, 0)
+
+    def reserve(self, bytes_count):
+        """Reserve bytes_count bytes of budget and return how long to wait before sending them"""
+        with self._lock:
+            if not self.rate_limit:
+                return 0
+            self._refill()
+            self._tokens -= bytes_count
+            return -self._tokens / self.rate_limit
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate_limit:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate_limit)
+        self._last = now
+
+class TransferProgress:
+    """Transfer counters written by a worker thread and sampled by the UI.
+
+    The worker only adds to plain integers, so reporting progress costs it
+    nothing; the UI polls sample() on a timer and gets a smoothed speed and
+    ETA instead of one callback per chunk.
+    """
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.finished = False
+        self.start(0)
+
+    def start(self, total):
+        """Reset the counters for a new attempt of total bytes"""
+        self.total = total
+        self.done = 0
+        self.speed = 0.0
+        self._last_time = time.monotonic()
+        self._last_done = 0
+
+    def add(self, count):
+        self.done += count
+
+    def finish(self):
+        self.finished = True
+
+    def sample(self):
+        """Return (percent, bytes done, speed in bytes/s, ETA in seconds or None)"""
+        now = time.monotonic()
+        done = self.done
+        elapsed = now - self._last_time
+        if elapsed > 0:
+            instant = (done - self._last_done) / elapsed
+            self.speed = instant if not self.speed else self.speed + self.smoothing * (instant - self.speed)
+            self._last_time = now
+            self._last_done = done
+        percent = done / self.total * 100 if self.total else 0
+        eta = (self.total - done) / self.speed if self.speed > 0 else None
+        return percent, done, self.speed, eta
+
+class TransferResult:
+    """Outcome of one transfer, as shown in the history"""
+
+    def __init__(self, name, size, status="Completed", peer=None, metrics=None):
+        self.name = name
+        self.size = size
+        self.status = status
+        self.peer = peer  # Address of the other side, once a connection was made
+        self.metrics = metrics  # TransferMetrics of the session, once one ran
+
+    @property
+    def ok(self):
+        return self.status == "Completed"
+
+def describe_batch(entries):
+    """Short name for a batch in the history view"""
+    files = [entry for entry in entries if not entry.get("dir")]
+    if len(files) == 1:
+        return os.path.basename(files[0]["path"])
+    return f"{len(files)} files"
+
+def format_size(size_bytes):
+    # Convert bytes to human-readable format
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size_bytes < 1024 or unit == 'GB':
+            return f"{size_bytes:.2f} {unit}"
+        size_bytes /= 1024
+
+def local_ip():
+    """Address other machines on the LAN can reach us at"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+    except Exception:
+        return "127.0.0.1"
+    finally:
+        s.close()
+
+def parse_connection_code(code):
+    """Split an "ip:port:fingerprint" connection code into its parts"""
+    parts = code.strip().split(":")
+    if len(parts) != 3:
+        raise ValueError("Invalid connection code format")
+    ip, port, fingerprint = parts
+    return ip, int(port), fingerprint
+
+def server_context(cert_path=CERT_FILE, key_path=KEY_FILE):
+    """TLS context for accepting connections, shared while the certificate is unchanged.
+
+    Sharing it keeps the key of the session tickets it issues, so peers
+    reconnecting to this process can resume instead of a full handshake.
+    """
+    return _server_context(cert_path, key_path, os.path.getmtime(cert_path))
+
+@functools.lru_cache(maxsize=None)
+def _server_context(cert_path, key_path, cert_mtime):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    # Force TLS 1.3, whose suites all use ephemeral key exchange and AEAD ciphers with any key type
+    context.minimum_version = ssl.TLSVersion.TLSv1_3
+    return context
+
+@functools.lru_cache(maxsize=None)
+def client_context():
+    """TLS context for connecting to senders, shared by the whole process"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE  # Pinned by fingerprint in Receiver.connect()
+    # Force TLS 1.3, whose suites all use ephemeral key exchange and AEAD ciphers with any key type
+    context.minimum_version = ssl.TLSVersion.TLSv1_3
+    return context
+
+class ConnectionPool:
+    """Authenticated connections kept open between transfers to the same peer.
+
+    Peers are keyed by (host, port, fingerprint). A server that says it
+    keeps connections alive gets its connection back in the pool after a
+    transfer, so the next one to it starts with a single request round
+    trip. Idle connections are dropped after idle_timeout or as soon as
+    the peer closes them. The pool also remembers the last TLS session of
+    each peer, so new connections resume it instead of a full handshake.
+    """
+
+    def __init__(self, idle_timeout=KEEPALIVE_TIMEOUT, max_idle=4):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle  # Idle connections kept per peer
+        self._lock = threading.Lock()
+        self._idle = {}  # Peer key -> [(time returned, FramedSocket)], most recent last
+        self._sessions = {}  # Peer key -> ssl.SSLSession to resume
+
+    def checkout(self, key):
+        """Take a live idle connection to the peer, or None"""
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                returned, framed = idle.pop()
+            if time.monotonic() - returned < self.idle_timeout and not _readable(framed.sock):
+                return framed
+            framed.sock.close()  # Idled out, or the peer hung up
+
+    def checkin(self, key, framed):
+        """Keep a connection that finished its transfer cleanly for the next one"""
+        self.remember_session(key, framed.sock)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            idle.append((time.monotonic(), framed))
+            while len(idle) > self.max_idle:
+                idle.pop(0)[1].sock.close()
+
+    def session(self, key):
+        with self._lock:
+            return self._sessions.get(key)
+
+    def remember_session(self, key, ssock):
+        # The session gains its resumption ticket once the first data has been read
+        if ssock.session is not None:
+            with self._lock:
+                self._sessions[key] = ssock.session
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            self._sessions.clear()
+        for connections in idle.values():
+            for _, framed in connections:
+                framed.sock.close()
+
+def _readable(sock):
+    # An idle connection has nothing to read unless the peer closed it
+    return sock.pending() or select.select([sock], [], [], 0)[0]
+
+CONNECTION_POOL = ConnectionPool()
+
+class Sender:
+    """Serves a selection of files and folders to receivers that connect to us.
+
+    send() waits for a single receiver and retries failed attempts, which is
+    what the GUI's "Start Transfer" does. Clearing resume_event pauses the
+    data stream at the next frame. With autotune, buffer_size is only the
+    first frame size, and a PathTuner fits frames and socket buffers to the
+    connection as it runs. With archive, the selection goes out as one
+    read_archive() stream that the receiver unpacks as it arrives, which
+    suits folders of many small files; it replaces delta and dedup, and
+    receivers that do not support it get the usual batch. To keep serving
+    many receivers at once, use p2pft.server.TransferServer instead.
+    """
+
+    def __init__(self, paths, port=DEFAULT_PORT, compress=False, delta=False, dedup=False,
+                 rate_limiter=None, resume_event=None, cert_path=CERT_FILE, key_path=KEY_FILE,
+                 buffer_size=COALESCE_SIZE, autotune=True, archive=False):
+        self.paths = list(paths)
+        self.port = port
+        self.compress = compress
+        self.delta = delta
+        self.dedup = dedup
+        self.rate_limiter = rate_limiter or RateLimiter(0)
+        if resume_event is None:
+            resume_event = threading.Event()
+            resume_event.set()
+        self.resume_event = resume_event
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self.buffer_size = buffer_size  # Payload bytes per data frame, at most MAX_FRAME_SIZE
+        self.autotune = autotune
+        self.archive = archive
+
+    def listen(self, backlog=1):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', self.port))
+        sock.listen(backlog)
+        return sock
+
+    def send(self, progress=None, on_error=None):
+        """Send the selection to the first receiver that connects, retrying up to MAX_RETRIES times"""
+        progress = progress or TransferProgress()
+        try:
+            for attempt in range(MAX_RETRIES):
+                try:
+                    with self.listen() as sock:
+                        sock.settimeout(TRANSFER_TIMEOUT)
+                        conn, addr = sock.accept()
+                    result = self.serve_connection(conn, progress)
+                    result.peer = addr[0]
+                    result.metrics.count("retries", attempt)
+                    return result
+                except Exception as e:
+                    if on_error:
+                        on_error(e)
+            name = ", ".join(os.path.basename(path) for path in self.paths)
+            return TransferResult(name, 0, "Failed")
+        finally:
+            progress.finish()
+
+    def serve_connection(self, conn, progress):
+        """Run one sender session over an accepted plain TCP connection"""
+        conn.settimeout(TRANSFER_TIMEOUT)
+        metrics = TransferMetrics()
+        
+        # Walk the selection once per session so every receiver sees fresh sizes
+        mark = time.perf_counter()
+        manifest = build_manifest(self.paths)
+        entries = [entry for _, entry in manifest]
+        progress.start(sum(entry["size"] for entry in entries))
+        mark = metrics.lap("scan", mark)
+        
+        with server_context(self.cert_path, self.key_path).wrap_socket(conn, server_side=True) as ssock:
+            framed = FramedSocket(ssock)
+            framed.handshake()
+            mark = metrics.lap("handshake", mark)
+            
+            # The receiver says what it supports before anything else
+            hello = framed.recv_json(FRAME_CONTROL)
+            archive = self.archive and hello.get("archive", False)
+            delta = self.delta and not archive
+            dedup = self.dedup and not archive
+            
+            # Tell the receiver which features this session uses
+            session = {"type": "session", "delta": delta, "dedup": dedup}
+            if archive:
+                # The entries arrive inside the stream instead of a manifest
+                stream_size = archive_size(entries)
+                session["archive"] = {"entries": len(entries), "size": stream_size,
+                                      "files_size": sum(entry["size"] for entry in entries)}
+                progress.start(stream_size)
+            framed.send_json(FRAME_CONTROL, session)
+            
+            # Send the manifest; the Merkle root follows in the trailer
+            if not archive:
+                framed.send_manifest(entries)
+            
+            # Pick a codec both sides support, if compression is enabled
+            codec = next((c for c in available_codecs() if c in hello.get("codecs", [])), None)
+            compressor = AdaptiveCompressor(codec) if self.compress and codec else None
+            
+            # Fit frames and socket buffers to the path, starting from the RTT the receiver measured
+            tuner = PathTuner(ssock, self.buffer_size, metrics, hello.get("rtt")) if self.autotune else None
+            
+            # The receiver answers the manifest with signatures of files it already has
+            signatures = framed.recv_signatures() if delta else {}
+            
+            # Then with the chunks of the other large files that its chunk store holds.
+            # Each recipe goes out as it is chunked, so the receiver is not left waiting
+            recipes = {}
+            if dedup:
+                for index, (source, entry) in enumerate(manifest):
+                    if index not in signatures and not entry.get("dir") and entry["size"] >= DEDUP_MIN_SIZE:
+                        recipes[index] = framed.send_recipe(index, recipe_pieces(source))
+                framed.send_json(FRAME_CONTROL, {"type": "recipes_done"})
+                for index, records in recipes.items():
+                    chunks = len(records) // RECIPE_RECORD.size
+                    recipes[index] = (records, framed.recv_blob(FRAME_WANT, (chunks + 7) // 8))
+            
+            # Stream every file back to back, publishing chunk hashes as we go
+            hasher = MerkleHasher()
+            timed_hasher = TimedHasher(hasher, metrics)
+            leaves_sent = 0
+            bytes_sent = 0
+            buf = framed.data_buffer(MAX_FRAME_SIZE if tuner else self.buffer_size)
+            frame_size = (lambda: tuner.read_size) if tuner else None
+            mark = metrics.lap("negotiate", mark)
+            if archive:
+                stream = read_archive(manifest, buf, timed_hasher, frame_size)
+            else:
+                stream = read_batch(manifest, buf, timed_hasher, signatures, recipes, frame_size)
+            for op, value in stream:
+                mark = metrics.lap("read", mark)
+                
+                # Block here while the transfer is paused
+                if not self.resume_event.is_set():
+                    self.resume_event.wait()
+                    mark = metrics.lap("paused", mark, stall=True)
+                
+                if op == "copy":
+                    # The receiver already has these bytes
+                    framed.send_frame(FRAME_COPY, COPY_INSTRUCTION.pack(*value))
+                    length = value[1]
+                    metrics.count("copied_bytes", length)
+                elif op == "chunk":
+                    framed.send_frame(FRAME_CHUNK, RECIPE_RECORD.pack(*value))
+                    length = value[1]
+                    metrics.count("deduplicated_bytes", length)
+                else:
+                    length = value
+                    chunk = buf[:length]
+                    if compressor:
+                        payload, flags = compressor.compress(chunk)
+                        mark = metrics.lap("compress", mark)
+                    else:
+                        payload, flags = chunk, 0
+                    send_start = mark
+                    
+                    # Rate limiting applies to what actually goes on the wire
+                    if self.rate_limiter.acquire(len(payload)):
+                        mark = metrics.lap("rate_limit", mark, stall=True)
+                    
+                    if flags:
+                        framed.send_frame(FRAME_DATA, payload, flags)
+                    else:
+                        framed.send_data(length)
+                    if compressor:
+                        compressor.record_send(len(payload), time.perf_counter() - send_start)
+                    metrics.count("wire_bytes", len(payload))
+                bytes_sent += length
+                progress.add(length)
+                leaves_sent = framed.send_leaves(hasher.leaves, leaves_sent)
+                if tuner:
+                    tuner.sample(metrics.counters["wire_bytes"])
+                mark = metrics.lap("send", mark)
+            # Hashing happened inside the reads and was charged to its own phase
+            mark = metrics.lap("read", mark)
+            metrics.phases["read"] -= timed_hasher.seconds
+            
+            framed.send_leaves(hasher.finish(), leaves_sent)
+            framed.send_json(FRAME_TRAILER, {"size": bytes_sent, "root": merkle_root(hasher.leaves).hex()})
+            
+            # Send chunks that failed verification again until the receiver is satisfied
+            result = framed.recv_json(FRAME_CONTROL)
+            while result.get("type") == "retransmit":
+                resend_chunks(framed, manifest, result["chunks"])
+                metrics.count("retransmitted_chunks", len(result["chunks"]))
+                result = framed.recv_json(FRAME_CONTROL)
+            metrics.lap("verify", mark)
+        
+        metrics.finish()
+        status = "Completed" if result.get("ok") else "Failed (Checksum)"
+        # An archive stream also carries the entries' records
+        size = session["archive"]["files_size"] if archive else bytes_sent
+        return TransferResult(describe_batch(entries), size, status, metrics=metrics)
+
+def resend_chunks(framed, manifest, indices, chunk_size=VERIFY_CHUNK_SIZE):
+    """Send verification chunks of the batch stream again, read straight from disk"""
+    starts = stream_starts(entry for _, entry in manifest)
+    buf = framed.data_buffer(COALESCE_SIZE)
+    for index in indices:
+        offset = index * chunk_size
+        size = max(0, min(chunk_size, starts[-1] - offset))
+        framed.send_json(FRAME_CONTROL, {"type": "resend", "index": index, "size": size})
+        for start in range(offset, offset + size, len(buf)):
+            framed.send_data(read_stream_range(manifest, starts, start, buf[:min(len(buf), offset + size - start)]))
+
+class Receiver:
+    """Fetches a batch from a sender into save_path.
+
+    The sender's certificate is self-signed, so instead of a CA chain it is
+    authenticated by its fingerprint: either the full SHA-256 or the short
+    prefix carried in connection codes. With autotune, the receive buffer
+    grows to fit the connection as a PathTuner measures it. Senders may
+    send an archive stream instead of a manifest and batch, which is
+    unpacked by an ArchiveWriter as it arrives.
+    """
+
+    def __init__(self, host, port, fingerprint, save_path, chunk_cache_size=CHUNK_STORE_MAX_SIZE, offer=None,
+                 pool=CONNECTION_POOL, rate_limiter=None, autotune=True):
+        self.host = host
+        self.port = port
+        self.fingerprint = fingerprint
+        self.save_path = save_path
+        self.chunk_cache_size = chunk_cache_size
+        self.offer = offer  # Catalog entry to fetch from a TransferServer, None for everything
+        self.pool = pool
+        # Reading slower than the sender writes throttles it through TCP flow control
+        self.rate_limiter = rate_limiter or RateLimiter(0)
+        self.autotune = autotune
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Yield a verified FramedSocket to the sender, reusing a pooled one when possible.
+
+        The connection goes back to the pool afterwards if the session
+        set its keepalive flag, and is closed otherwise.
+        """
+        key = (self.host, self.port, self.fingerprint)
+        framed = self.pool.checkout(key) or self._open(key)
+        framed.keepalive = False
+        try:
+            yield framed
+        except BaseException:
+            framed.sock.close()
+            raise
+        if framed.keepalive:
+            self.pool.checkin(key, framed)
+        else:
+            self.pool.remember_session(key, framed.sock)
+            framed.sock.close()
+
+    def _open(self, key):
+        started = time.monotonic()
+        sock = socket.create_connection((self.host, self.port), timeout=TRANSFER_TIMEOUT)
+        # The TCP handshake takes one round trip, which is all platforms without TCP_INFO have to go on
+        rtt = time.monotonic() - started
+        try:
+            ssock = client_context().wrap_socket(sock, session=self.pool.session(key))
+        except BaseException:
+            sock.close()
+            raise
+        try:
+            # Verify fingerprint; a resumed session still carries the peer's certificate
+            cert = ssock.getpeercert(binary_form=True)
+            if not fingerprint_matches(hashlib.sha256(cert).hexdigest(), self.fingerprint):
+                raise ValueError("Certificate fingerprint does not match")
+            framed = FramedSocket(ssock)
+            framed.rtt = rtt
+            framed.handshake()
+            return framed
+        except BaseException:
+            ssock.close()
+            raise
+
+    def receive(self, progress=None):
+        """Receive one batch; a batch that fails verification comes back as a failed result"""
+        progress = progress or TransferProgress()
+        metrics = TransferMetrics()
+        try:
+            mark = time.perf_counter()
+            with self.connect() as framed:
+                # Next to nothing when a pooled connection was reused
+                metrics.lap("handshake", mark)
+                result = self._receive_batch(framed, progress, metrics)
+            result.peer = self.host
+            return result
+        finally:
+            progress.finish()
+
+    def list_offers(self):
+        """Ask a TransferServer for its catalog: a list of {"name", "files", "size"}"""
+        with self.connect() as framed:
+            framed.send_json(FRAME_CONTROL, {"type": "list"})
+            reply = framed.recv_json(FRAME_CONTROL)
+            if reply.get("type") != "catalog":
+                raise ProtocolError("Sender does not serve a catalog")
+            framed.keepalive = reply.get("keepalive", False)
+            return reply["offers"]
+
+    def _repair(self, framed, writer, checker, metrics):
+        """Fetch chunks that failed verification again; returns whether every chunk now matches"""
+        for attempt in range(MAX_RETRIES):
+            bad = checker.bad_chunks()
+            if not bad:
+                return True
+            framed.send_json(FRAME_CONTROL, {"type": "retransmit", "chunks": bad})
+            metrics.count("retransmitted_chunks", len(bad))
+            for _ in bad:
+                header = framed.recv_json(FRAME_CONTROL)
+                data = framed.recv_blob(FRAME_DATA, header["size"])
+                if checker.accept(header["index"], data):
+                    writer.rewrite(header["index"] * checker.hasher.chunk_size, data)
+        return not checker.bad_chunks()
+
+    def _receive_batch(self, framed, progress, metrics):
+        mark = time.perf_counter()
+        framed.send_json(FRAME_CONTROL, {
+            "type": "hello", "codecs": available_codecs(), "offer": self.offer, "rtt": framed.rtt, "archive": True,
+        })
+        
+        # The sender says which features this session uses
+        session = framed.recv_json(FRAME_CONTROL)
+        if session.get("type") == "error":
+            raise ProtocolError(session["message"])
+        
+        # Receive the manifest and prepare the target files
+        archive = session.get("archive")
+        if archive:
+            # Files are created as their records arrive, and entries fills in with them
+            writer = ArchiveWriter(self.save_path, archive["entries"], archive["files_size"])
+            entries = writer.entries
+            progress.start(archive["size"])
+        else:
+            entries = framed.recv_manifest()
+            writer = BatchWriter(self.save_path, entries)
+            progress.start(writer.total_size)
+        
+        # Offer the sender signatures of the copies we already have
+        if session.get("delta"):
+            for index, target in writer.delta_candidates():
+                block_size = delta_block_size(os.path.getsize(target))
+                framed.send_signature(index, block_size, signature_pieces(target, block_size))
+                writer.use_basis(index)
+            framed.send_json(FRAME_CONTROL, {"type": "signatures_done"})
+        
+        # Tell the sender which chunks our chunk store is missing
+        recipes = framed.recv_recipes() if session.get("dedup") else {}
+        store = None
+        if recipes:
+            store = ChunkStore(max_size=self.chunk_cache_size)
+            for records in recipes.values():
+                framed.send_blob(FRAME_WANT, store.wanted(records))
+        
+        # Receive file contents until the trailer arrives, checking each chunk against its leaf
+        checker = LeafChecker()
+        hasher = checker.hasher
+        tuner = PathTuner(framed.sock, None, metrics, framed.rtt, socket.SO_RCVBUF) if self.autotune else None
+        mark = metrics.lap("negotiate", mark)
+        try:
+            bytes_received = 0
+            while True:
+                frame_type, flags, payload = framed.recv_frame()
+                mark = metrics.lap("receive", mark)
+                if frame_type == FRAME_TRAILER:
+                    trailer = json.loads(bytes(payload))
+                    break
+                if frame_type == FRAME_COPY:
+                    # Rebuilding from the existing copy counts as writing, hashing included
+                    offset, length = COPY_INSTRUCTION.unpack(payload)
+                    for start in range(0, length, COALESCE_SIZE):
+                        data = writer.read_basis(offset + start, min(COALESCE_SIZE, length - start))
+                        writer.write(data)
+                        hasher.update(data)
+                    bytes_received += length
+                    metrics.count("copied_bytes", length)
+                    mark = metrics.lap("write", mark)
+                elif frame_type == FRAME_CHUNK:
+                    if store is None:
+                        raise ProtocolError("Chunk reference in a session without chunk recipes")
+                    digest, length = RECIPE_RECORD.unpack(payload)
+                    data = store.read(digest, length)
+                    writer.write(data)
+                    hasher.update(data)
+                    bytes_received += length
+                    metrics.count("deduplicated_bytes", length)
+                    mark = metrics.lap("write", mark)
+                elif frame_type == FRAME_DATA:
+                    metrics.count("wire_bytes", len(payload))
+                    if tuner:
+                        tuner.sample(metrics.counters["wire_bytes"])
+                    if self.rate_limiter.acquire(len(payload)):
+                        mark = metrics.lap("rate_limit", mark, stall=True)
+                    if flags:
+                        payload = decompress_frame(flags, payload)
+                        mark = metrics.lap("decompress", mark)
+                    writer.write(payload)
+                    mark = metrics.lap("write", mark)
+                    hasher.update(payload)
+                    mark = metrics.lap("hash", mark)
+                    bytes_received += len(payload)
+                elif frame_type == FRAME_LEAF:
+                    checker.add_expected(LEAF_HEADER.unpack_from(payload)[0], payload[LEAF_HEADER.size:])
+                else:
+                    raise ProtocolError(f"Unexpected frame type {frame_type} during file data")
+                progress.done = bytes_received
+            writer.close()
+            mark = metrics.lap("disk_write", mark, stall=True)
+            # An archive's records cannot be rewritten in place, so its chunks are not repaired
+            verified = (writer.complete() and bytes_received == trailer["size"]
+                        and checker.root_matches(trailer["root"])
+                        and (not checker.bad_chunks() if archive else self._repair(framed, writer, checker, metrics)))
+            mark = metrics.lap("verify", mark)
+            if verified:
+                writer.commit()
+                mark = metrics.lap("commit", mark)
+        except BaseException:
+            writer.discard()
+            if store:
+                store.close()
+            raise
+        finally:
+            # Time write() spent waiting for the write-behind thread was disk, not work
+            metrics.phases["write"] -= writer.stall_seconds
+            metrics.add_stall("disk_write", writer.stall_seconds)
+            metrics.background["write_behind"] += writer.disk_seconds
+        
+        framed.send_json(FRAME_CONTROL, {"type": "result", "ok": verified})
+        framed.keepalive = session.get("keepalive", False)
+        if not verified:
+            writer.discard()
+            if store:
+                store.close()
+            metrics.finish()
+            return TransferResult(describe_batch(entries), writer.total_size, "Failed (Checksum)", metrics=metrics)
+        
+        # Remember the chunks of verified files for later transfers
+        if store:
+            try:
+                for index, records in recipes.items():
+                    store.ingest(safe_join(self.save_path, entries[index]["path"]), records)
+                store.evict()
+            finally:
+                store.close()
+            metrics.lap("commit", mark)
+        metrics.finish()
+        return TransferResult(describe_batch(entries), writer.total_size, metrics=metrics)
@@ -0,0 +1,142 @@
+"""One-to-many sending of a batch from a single read of its files"""
+import asyncio
+
+from .batch import read_stream_range, stream_starts
+from .merkle import MerkleHasher
+from .protocol import COALESCE_SIZE
+
+FANOUT_SLOTS = 64  # Chunks kept in the ring, the lag window of a receiver (16 MB)
+FANOUT_MAX_STALL = 0.25  # Seconds the reader waits on the slowest receiver before leaving it behind
+
+class FanOut:
+    """A single pass over a batch, shared by every receiver that joins it.
+
+    One reader task reads the stream in chunks of chunk_size into a ring
+    of FANOUT_SLOTS slots and hashes it into Merkle leaves once. Each receiver copies chunks
+    out of the ring at its own pace. When the ring is full and a receiver
+    is waiting for the next chunk, the reader waits up to max_stall for
+    the receivers at its tail; after that it moves on, and a receiver that
+    fell out of the ring reads the chunks it missed from disk until it
+    catches up again. Disk reads stay at one
+    pass plus what the stragglers miss, however many receivers there are.
+
+    A pass can only be joined while its first chunks are still in the
+    ring. Callers should start a new pass once joinable is False. The
+    reader stops once every member has left, so a receiver should join as
+    soon as it is handed the pass rather than when it starts reading.
+    """
+
+    def __init__(self, manifest, reads, chunk_size=COALESCE_SIZE, slots=FANOUT_SLOTS,
+                 max_stall=FANOUT_MAX_STALL):
+        self.manifest = manifest
+        self.starts = stream_starts(entry for _, entry in manifest)
+        self.total_size = self.starts[-1]
+        self.chunk_size = chunk_size
+        self.chunk_count = -(-self.total_size // chunk_size)
+        self.max_stall = max_stall
+        self.hasher = MerkleHasher()
+        self.complete = False
+        self.closed = False
+        self.disk_reads = 0  # Chunks read from disk, by the reader and by catch-up reads
+        self._reads = reads  # Semaphore shared with the server's other disk reads
+        self._ring = [bytearray(chunk_size) for _ in range(slots)]
+        self._lengths = [0] * slots
+        self._scratch = bytearray(chunk_size)
+        self._head = 0  # Chunks produced so far
+        self._positions = {}  # Receiver token -> next chunk it needs
+        self._changed = asyncio.Condition()
+        self._reader = None
+        self._error = None
+
+    @property
+    def joinable(self):
+        return not self.closed and self._head < len(self._ring)
+
+    def join(self):
+        """Register a receiver starting at the first chunk; returns its token"""
+        token = object()
+        self._positions[token] = 0
+        if self._reader is None:
+            self._reader = asyncio.get_running_loop().create_task(self._read_all())
+        return token
+
+    async def leave(self, token):
+        del self._positions[token]
+        await self._notify()
+
+    async def read(self, token, index, buf):
+        """Copy chunk index into buf and return its length"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: index < self._head or self.closed)
+            if index >= self._head:
+                raise IOError(f"Broadcast read failed: {self._error or 'reader stopped'}")
+            if index >= self._head - len(self._ring):
+                slot = index % len(self._ring)
+                length = self._lengths[slot]
+                buf[:length] = memoryview(self._ring[slot])[:length]
+                self._positions[token] = index + 1
+                self._changed.notify_all()
+                return length
+
+        # Fell out of the ring: catch up from disk
+        async with self._reads:
+            length = await asyncio.get_running_loop().run_in_executor(None, self._read_chunk, index, buf)
+        self._positions[token] = index + 1
+        await self._notify()
+        return length
+
+    async def result(self):
+        """Wait for the pass to finish and return the Merkle leaves of the whole stream"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.closed)
+        if not self.complete:
+            raise IOError(f"Broadcast read failed: {self._error or 'reader stopped'}")
+        return self.hasher.leaves
+
+    async def _read_all(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._head < self.chunk_count:
+                async with self._changed:
+                    # Stragglers only get left behind while they hold back a receiver waiting at the head
+                    await self._changed.wait_for(lambda: self._has_room() or self._head in self._positions.values())
+                    if not self._has_room():
+                        try:
+                            await asyncio.wait_for(self._changed.wait_for(self._has_room), self.max_stall)
+                        except asyncio.TimeoutError:
+                            pass  # The receivers at the tail will catch up from disk
+                    if not self._positions:
+                        break
+                async with self._reads:
+                    length = await loop.run_in_executor(None, self._read_chunk, self._head, self._scratch)
+                self.hasher.update(memoryview(self._scratch)[:length])
+
+                # Swap the new chunk in on the event loop, so readers never see it half written
+                slot = self._head % len(self._ring)
+                self._ring[slot], self._scratch = self._scratch, self._ring[slot]
+                self._lengths[slot] = length
+                self._head += 1
+                await self._notify()
+            else:
+                self.hasher.finish()
+                self.complete = True
+        except Exception as e:
+            self._error = e
+        finally:
+            self.closed = True
+            await self._notify()
+
+    def _has_room(self):
+        # Producing the next chunk evicts the oldest one from the ring
+        evicted = self._head - len(self._ring)
+        return evicted < 0 or evicted not in self._positions.values()
+
+    def _read_chunk(self, index, buf):
+        offset = index * self.chunk_size
+        length = min(self.chunk_size, self.total_size - offset)
+        self.disk_reads += 1
+        return read_stream_range(self.manifest, self.starts, offset, memoryview(buf)[:length])
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
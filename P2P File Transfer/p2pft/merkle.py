@@ -0,0 +1,85 @@
+"""Merkle tree over fixed-size chunks of the batch stream"""
+import hashlib
+
+from .protocol import ProtocolError
+
+VERIFY_CHUNK_SIZE = 1024 * 1024  # Bytes of stream covered by each leaf
+
+def leaf_hash(data):
+    return hashlib.sha256(b"\x00" + bytes(data)).digest()
+
+def merkle_root(leaves):
+    """Root of a binary Merkle tree; an odd node out is carried up a level unchanged"""
+    level = list(leaves) or [hashlib.sha256(b"\x00").digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(b"\x01" + level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+class MerkleHasher:
+    """Drop-in for a hashlib object that also keeps the hash of every chunk.
+
+    Leaves are appended to self.leaves as soon as their chunk is complete,
+    so the sender can publish them while it is still streaming and the
+    receiver can check each chunk as it lands.
+    """
+
+    def __init__(self, chunk_size=VERIFY_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.leaves = []
+        self._current = hashlib.sha256(b"\x00")
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            length = min(len(view), self.chunk_size - self._filled)
+            self._current.update(view[:length])
+            self._filled += length
+            view = view[length:]
+            if self._filled == self.chunk_size:
+                self._close_leaf()
+
+    def finish(self):
+        """Close the last, partial chunk; returns the list of leaves"""
+        if self._filled:
+            self._close_leaf()
+        return self.leaves
+
+    def hexdigest(self):
+        return merkle_root(self.finish()).hex()
+
+    def _close_leaf(self):
+        self.leaves.append(self._current.digest())
+        self._current = hashlib.sha256(b"\x00")
+        self._filled = 0
+
+class LeafChecker:
+    """Receiver side: compares the leaves it computed with those the sender published"""
+
+    def __init__(self, chunk_size=VERIFY_CHUNK_SIZE):
+        self.hasher = MerkleHasher(chunk_size)
+        self.expected = {}
+
+    def add_expected(self, first, digests):
+        for offset in range(0, len(digests), 32):
+            self.expected[first + offset // 32] = bytes(digests[offset:offset + 32])
+
+    def bad_chunks(self):
+        """Indices of the chunks whose data did not match the sender's leaf"""
+        leaves = self.hasher.finish()
+        return [index for index, leaf in enumerate(leaves) if self.expected.get(index) != leaf]
+
+    def root_matches(self, root):
+        """Whether the published leaves add up to the root announced in the trailer"""
+        expected = [self.expected.get(index) for index in range(len(self.hasher.finish()))]
+        return None not in expected and len(self.expected) == len(expected) and merkle_root(expected).hex() == root
+
+    def accept(self, index, data):
+        """Check retransmitted data for a chunk; returns whether it matched"""
+        if not 0 <= index < len(self.hasher.leaves):
+            raise ProtocolError(f"Peer resent chunk {index}, outside the stream")
+        if leaf_hash(data) != self.expected.get(index):
+            return False
+        self.hasher.leaves[index] = self.expected[index]
+        return True
@@ -0,0 +1,180 @@
+"""Per-transfer timings and counters, exported as JSON lines and Prometheus text"""
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+METRICS_LOG = "transfer_metrics.jsonl"
+METRICS_LOG_MAX_SIZE = 10 * 1024 * 1024  # The log is rotated to "<name>.1" beyond this
+METRICS_PROMETHEUS_FILE = "p2pft.prom"  # For node_exporter's textfile collector or any scraper of local files
+
+PROMETHEUS_HELP = {
+    "p2pft_transfers_total": "Transfers finished, by direction and outcome",
+    "p2pft_transfer_bytes_total": "Bytes of files transferred successfully",
+    "p2pft_transfer_phase_seconds_total": "Time spent in each phase of a transfer",
+    "p2pft_transfer_stall_seconds_total": "Time transfers spent waiting, by cause",
+    "p2pft_transfer_retries_total": "Connection attempts that failed and were retried",
+    "p2pft_transfer_retransmitted_chunks_total": "Verification chunks sent again after failing their check",
+    "p2pft_transfer_wire_bytes_total": "Data frame payload bytes on the wire, after compression",
+    "p2pft_last_transfer_duration_seconds": "Duration of the most recent transfer",
+    "p2pft_last_transfer_throughput_bytes_per_second": "Average speed of the most recent transfer",
+}
+
+class TransferMetrics:
+    """Where the time of one transfer went.
+
+    Phases are stretches of the session thread's own time, so they add up
+    to roughly the whole transfer: "scan", "handshake", "negotiate",
+    "read", "hash", "compress", "send" and "verify" on the sending side,
+    "handshake", "negotiate", "receive", "decompress", "hash", "write",
+    "verify" and "commit" on the receiving side. "send" includes TLS
+    encryption, which Python's ssl module does inside the socket write.
+    Stalls are time spent waiting on something other than the transfer
+    itself: the rate limiter, a pause, or the receiver's disk falling
+    behind. Background time, such as the receiver's write-behind thread,
+    overlaps the phases and is kept apart. tuning lists the changes a
+    PathTuner made to the connection, with the measurements behind them.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.duration = 0.0
+        self.phases = defaultdict(float)
+        self.stalls = defaultdict(float)
+        self.background = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.tuning = []
+
+    def lap(self, name, mark, stall=False):
+        """Charge the time since the perf_counter() mark to a phase or a stall; returns the new mark"""
+        now = time.perf_counter()
+        (self.stalls if stall else self.phases)[name] += now - mark
+        return now
+
+    def add_stall(self, cause, seconds):
+        if seconds > 0:
+            self.stalls[cause] += seconds
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def finish(self):
+        self.duration = time.time() - self.started
+
+    def as_dict(self):
+        def rounded(times):
+            return {name: round(seconds, 6) for name, seconds in sorted(times.items())}
+        return {
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="milliseconds"),
+            "duration": round(self.duration, 6),
+            "phases": rounded(self.phases),
+            "stalls": rounded(self.stalls),
+            "background": rounded(self.background),
+            "counters": dict(sorted(self.counters.items())),
+            "tuning": self.tuning,
+        }
+
+class TimedHasher:
+    """Wraps a MerkleHasher to charge the time spent hashing to a "hash" phase"""
+
+    def __init__(self, hasher, metrics):
+        self.hasher = hasher
+        self.metrics = metrics
+        self.seconds = 0.0  # Hashing done so far, for callers that time the reads around it
+
+    def update(self, data):
+        started = time.perf_counter()
+        self.hasher.update(data)
+        elapsed = time.perf_counter() - started
+        self.seconds += elapsed
+        self.metrics.phases["hash"] += elapsed
+
+class MetricsRecorder:
+    """Appends finished transfers to a JSON-lines log and keeps a Prometheus text file of totals.
+
+    The Prometheus file is rewritten atomically after every transfer, and
+    its totals are read back when a recorder starts, so counters carry on
+    across runs instead of resetting.
+    """
+
+    def __init__(self, log_path=METRICS_LOG, prometheus_path=METRICS_PROMETHEUS_FILE):
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self._totals = _read_prometheus(prometheus_path)  # (metric, labels) -> value
+        self._last = {}  # (metric, labels) -> gauge value
+
+    def record(self, result, direction, timestamp=None):
+        """Log the TransferResult of a finished transfer; direction is "Sent" or "Received" as in the history"""
+        metrics = result.metrics.as_dict() if result.metrics else None
+        entry = {
+            "timestamp": timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "direction": direction, "name": result.name, "peer": result.peer, "status": result.status,
+            "size": result.size, "metrics": metrics,
+        }
+        side = direction.lower()
+        with self._lock:
+            self._append_log(entry)
+            self._add(("p2pft_transfers_total", (("direction", side), ("status", "completed" if result.ok else "failed"))), 1)
+            self._add(("p2pft_transfer_bytes_total", (("direction", side),)), result.size if result.ok else 0)
+            if metrics:
+                for name, seconds in metrics["phases"].items():
+                    self._add(("p2pft_transfer_phase_seconds_total", (("direction", side), ("phase", name))), seconds)
+                for name, seconds in metrics["stalls"].items():
+                    self._add(("p2pft_transfer_stall_seconds_total", (("direction", side), ("cause", name))), seconds)
+                for name in ("retries", "retransmitted_chunks", "wire_bytes"):
+                    self._add((f"p2pft_transfer_{name}_total", (("direction", side),)), metrics["counters"].get(name, 0))
+                self._last[("p2pft_last_transfer_duration_seconds", (("direction", side),))] = metrics["duration"]
+                self._last[("p2pft_last_transfer_throughput_bytes_per_second", (("direction", side),))] = (
+                    result.size / metrics["duration"] if metrics["duration"] else 0)
+            self._write_prometheus()
+
+    def _add(self, key, amount):
+        self._totals[key] = self._totals.get(key, 0) + amount
+
+    def _append_log(self, entry):
+        try:
+            if os.path.getsize(self.log_path) > METRICS_LOG_MAX_SIZE:
+                os.replace(self.log_path, self.log_path + ".1")
+        except OSError:
+            pass  # No log yet
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _write_prometheus(self):
+        lines = []
+        for kind, values in (("counter", self._totals), ("gauge", self._last)):
+            for metric in sorted({metric for metric, _ in values}):
+                lines.append(f"# HELP {metric} {PROMETHEUS_HELP.get(metric, metric)}")
+                lines.append(f"# TYPE {metric} {kind}")
+                for (name, labels), value in sorted(values.items()):
+                    if name == metric:
+                        label_text = ",".join(f'{label}="{text}"' for label, text in labels)
+                        lines.append(f"{metric}{{{label_text}}} {value}" if isinstance(value, int)
+                                     else f"{metric}{{{label_text}}} {value:.6f}")
+        partial = self.prometheus_path + ".tmp"
+        with open(partial, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(partial, self.prometheus_path)
+
+_SAMPLE = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+_LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+def _read_prometheus(path):
+    """Counter totals from a file this module wrote earlier"""
+    totals = {}
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return totals
+    counters = {line.split()[2] for line in lines if line.startswith("# TYPE ") and line.endswith(" counter")}
+    for line in lines:
+        match = _SAMPLE.match(line)
+        if match and match.group(1) in counters:
+            value = float(match.group(3))
+            totals[(match.group(1), tuple(_LABEL.findall(match.group(2))))] = int(value) if value.is_integer() else value
+    return totals
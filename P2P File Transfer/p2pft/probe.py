@@ -0,0 +1,86 @@
+"""Background checks of whether saved peers are reachable"""
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PROBE_INTERVAL = 10  # Seconds between probes of a peer that is online
+PROBE_TIMEOUT = 0.5  # Seconds a probe waits for the connection
+PROBE_MAX_BACKOFF = 300  # Longest wait between probes of a peer that stays offline
+PROBE_WORKERS = 32  # Probes in flight at once
+
+class _ProbeState:
+    def __init__(self):
+        self.online = None  # Unknown until the first probe finishes
+        self.failures = 0
+        self.next_probe = 0.0
+        self.probing = False
+
+class PeerProber:
+    """Probes peers with a TCP connect on worker threads, never on the caller's.
+
+    poll() is cheap enough to call from a UI timer: it starts probes for
+    the peers that are due, all at once, and returns only the peers whose
+    status changed since the previous poll. Online peers are probed every
+    interval; a peer that stays offline waits twice as long after each
+    failed probe, up to max_backoff. hint() moves a peer's next probe
+    forward, so other signals can speed a probe up without deciding the
+    status themselves.
+    """
+
+    def __init__(self, interval=PROBE_INTERVAL, timeout=PROBE_TIMEOUT, max_backoff=PROBE_MAX_BACKOFF,
+                 workers=PROBE_WORKERS):
+        self.interval = interval
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="peer-probe")
+        self._lock = threading.Lock()
+        self._states = {}  # (host, port) -> _ProbeState
+        self._changes = {}  # (host, port) -> online, since the last poll
+
+    def poll(self, addresses):
+        """Probe the (host, port) addresses that are due; returns {address: online} for changes"""
+        addresses = set(addresses)
+        now = time.monotonic()
+        with self._lock:
+            for address in list(self._states):
+                if address not in addresses:
+                    del self._states[address]
+            for address in addresses:
+                state = self._states.setdefault(address, _ProbeState())
+                if not state.probing and now >= state.next_probe:
+                    state.probing = True
+                    self._executor.submit(self._probe, address, state)
+            changes, self._changes = self._changes, {}
+        return {address: online for address, online in changes.items() if address in addresses}
+
+    def hint(self, address):
+        """Probe an address at the next poll instead of its next turn, such as when the peer was just heard from"""
+        with self._lock:
+            state = self._states.get(address)
+            if state:
+                state.next_probe = 0.0
+
+    def status(self, address):
+        """Last known status of an address: True, False, or None if not probed yet"""
+        with self._lock:
+            state = self._states.get(address)
+            return state and state.online
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _probe(self, address, state):
+        try:
+            with socket.create_connection(address, timeout=self.timeout):
+                online = True
+        except (OSError, ValueError):
+            online = False
+        with self._lock:
+            state.probing = False
+            state.failures = 0 if online else state.failures + 1
+            delay = self.interval if online else min(self.interval * 2 ** (state.failures - 1), self.max_backoff)
+            state.next_probe = time.monotonic() + delay
+            if online != state.online:
+                state.online = online
+                self._changes[address] = online
@@ -0,0 +1,228 @@
+"""Framed wire protocol spoken between sender and receiver"""
+import json
+import struct
+
+# Wire protocol
+PROTOCOL_MAGIC = b"P2PF"
+PROTOCOL_VERSION = 3
+BUFFER_SIZE = 4096
+MAX_FRAME_SIZE = 1024 * 1024  # 1 MB
+COALESCE_SIZE = 256 * 1024  # Small files are packed into data frames of this size
+MANIFEST_FRAME_SIZE = 256 * 1024  # Manifest entries are batched into header frames of this size
+
+# Frame types
+FRAME_HEADER = 1   # File metadata (JSON)
+FRAME_DATA = 2     # Raw file bytes
+FRAME_TRAILER = 3  # End of file with checksum (JSON)
+FRAME_CONTROL = 4  # Session messages (JSON)
+FRAME_SIGNATURE = 5  # Block signatures of the receiver's existing copy
+FRAME_COPY = 6  # Copy a range of the receiver's existing copy
+FRAME_RECIPE = 7  # Content-defined chunk list of a file
+FRAME_WANT = 8  # Bitmap of recipe chunks the receiver needs
+FRAME_CHUNK = 9  # Reuse a chunk from the receiver's chunk store
+FRAME_PIECE = 10  # A swarm piece: index followed by its data
+FRAME_PIECE_HASHES = 11  # SHA-256 of every piece of a swarm batch
+FRAME_LEAF = 12  # Merkle leaves of the batch stream: first index followed by digests
+
+# Data frame flags
+FLAG_ZLIB = 0x01  # Payload is a zlib stream
+FLAG_ZSTD = 0x02  # Payload is a zstd frame
+
+SIGNATURE_RECORD = struct.Struct("!I16s")  # Adler-32, BLAKE2b-128
+COPY_INSTRUCTION = struct.Struct("!QQ")  # Offset, length
+RECIPE_RECORD = struct.Struct("!32sI")  # SHA-256, length
+PIECE_HEADER = struct.Struct("!I")  # Piece index
+LEAF_HEADER = struct.Struct("!I")  # Index of the first leaf in the frame
+ARCHIVE_RECORD = struct.Struct("!BHQd")  # Entry kind, path length, size, mtime; the path and contents follow
+
+# Archive record kinds
+ARCHIVE_FILE = 0
+ARCHIVE_DIR = 1
+
+class ProtocolError(Exception):
+    pass
+
+class FramedSocket:
+    """Typed, length-prefixed frames over a stream socket.
+
+    Every frame is a 6-byte prefix (type, flags, payload length) followed by
+    the payload, so message boundaries no longer depend on how TCP/TLS
+    happens to split the stream. Frames are received with recv_into into a
+    reusable buffer, and data frames are read from disk straight into the
+    send buffer, so payloads are never copied in Python.
+    """
+    PREFIX = struct.Struct("!BBI")
+
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self.peer_version = None
+        self.rtt = None  # Seconds, when the connecting side timed its connect
+        self._prefix = bytearray(self.PREFIX.size)
+        self._in = memoryview(bytearray(max_frame_size))
+        self._out = bytearray(self.PREFIX.size + max_frame_size)
+
+    def handshake(self):
+        """Exchange protocol preambles and check that the peer speaks our version"""
+        self.sock.sendall(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]))
+        preamble = bytearray(len(PROTOCOL_MAGIC) + 1)
+        self._recv_exact(memoryview(preamble))
+        return self._check_preamble(preamble)
+
+    def _check_preamble(self, preamble):
+        if bytes(preamble[:-1]) != PROTOCOL_MAGIC:
+            raise ProtocolError("Peer is not a P2P file transfer endpoint")
+        if preamble[-1] != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {preamble[-1]}")
+        self.peer_version = preamble[-1]
+        return self.peer_version
+
+    def send_frame(self, frame_type, payload=b"", flags=0):
+        if len(payload) > self.max_frame_size:
+            raise ProtocolError(f"Frame of {len(payload)} bytes exceeds the maximum frame size")
+        self.sock.sendall(self.PREFIX.pack(frame_type, flags, len(payload)) + payload)
+
+    def send_json(self, frame_type, message):
+        self.send_frame(frame_type, json.dumps(message).encode())
+
+    def data_buffer(self, size=BUFFER_SIZE):
+        """Return a writable view for the payload of the next data frame"""
+        size = min(size, self.max_frame_size)
+        return memoryview(self._out)[self.PREFIX.size:self.PREFIX.size + size]
+
+    def send_data(self, length, flags=0):
+        """Send the first length bytes of data_buffer() as a data frame"""
+        self.PREFIX.pack_into(self._out, 0, FRAME_DATA, flags, length)
+        self.sock.sendall(memoryview(self._out)[:self.PREFIX.size + length])
+
+    def recv_frame(self):
+        """Receive the next frame as (type, flags, payload).
+
+        The payload is a view into an internal buffer and is only valid
+        until the next call.
+        """
+        self._recv_exact(memoryview(self._prefix))
+        frame_type, flags, length = self.PREFIX.unpack(self._prefix)
+        if length > self.max_frame_size:
+            raise ProtocolError(f"Peer sent a frame of {length} bytes, above the maximum frame size")
+        payload = self._in[:length]
+        self._recv_exact(payload)
+        return frame_type, flags, payload
+
+    def send_manifest(self, entries):
+        """Send manifest entries as one or more header frames"""
+        batch = []
+        batch_size = 0
+        for entry in entries:
+            entry_size = len(json.dumps(entry)) + 2
+            if batch and batch_size + entry_size > MANIFEST_FRAME_SIZE:
+                self.send_json(FRAME_HEADER, {"files": batch, "more": True})
+                batch = []
+                batch_size = 0
+            batch.append(entry)
+            batch_size += entry_size
+        self.send_json(FRAME_HEADER, {"files": batch, "more": False})
+
+    def recv_manifest(self):
+        entries = []
+        while True:
+            header = self.recv_json(FRAME_HEADER)
+            entries.extend(header["files"])
+            if not header.get("more"):
+                return entries
+
+    def send_signature(self, index, block_size, pieces):
+        """Send the block signatures of the receiver's copy of manifest entry index.
+
+        pieces is an iterable of packed records, each sent as soon as it is
+        produced, so the sender keeps hearing from us while a large file is
+        still being hashed instead of timing out.
+        """
+        self.send_json(FRAME_CONTROL, {"type": "signature", "index": index, "block_size": block_size})
+        per_frame = self.max_frame_size - self.max_frame_size % SIGNATURE_RECORD.size
+        for records in pieces:
+            view = memoryview(records)
+            for start in range(0, len(view), per_frame):
+                self.send_frame(FRAME_SIGNATURE, view[start:start + per_frame])
+
+    def recv_signatures(self):
+        """Collect signatures until the receiver is done; returns {index: (block_size, records)}"""
+        signatures = {}
+        current = None
+        while True:
+            frame_type, _, payload = self.recv_frame()
+            if frame_type == FRAME_SIGNATURE and current is not None:
+                current += payload
+                continue
+            if frame_type != FRAME_CONTROL:
+                raise ProtocolError(f"Unexpected frame type {frame_type} in signatures")
+            message = json.loads(bytes(payload))
+            if message["type"] == "signatures_done":
+                return signatures
+            current = bytearray()
+            signatures[message["index"]] = (message["block_size"], current)
+
+    def send_leaves(self, leaves, first):
+        """Send the Merkle leaves from index first on; returns the number of leaves sent so far"""
+        if first < len(leaves):
+            per_frame = (self.max_frame_size - LEAF_HEADER.size) // 32
+            for start in range(first, len(leaves), per_frame):
+                self.send_frame(FRAME_LEAF, LEAF_HEADER.pack(start) + b"".join(leaves[start:start + per_frame]))
+        return len(leaves)
+
+    def send_blob(self, frame_type, data):
+        """Send binary data of a length the peer already knows, split into frames"""
+        view = memoryview(data)
+        for start in range(0, len(view), self.max_frame_size):
+            self.send_frame(frame_type, view[start:start + self.max_frame_size])
+
+    def recv_blob(self, frame_type, length):
+        data = bytearray()
+        while len(data) < length:
+            received_type, _, payload = self.recv_frame()
+            if received_type != frame_type:
+                raise ProtocolError(f"Expected frame type {frame_type}, got {received_type}")
+            data += payload
+        if len(data) != length:
+            raise ProtocolError("Peer sent more data than announced")
+        return data
+
+    def send_recipe(self, index, pieces):
+        """Send the chunk recipe of manifest entry index, one piece at a time as it is produced; returns the whole recipe"""
+        self.send_json(FRAME_CONTROL, {"type": "recipe", "index": index})
+        records = bytearray()
+        for piece in pieces:
+            self.send_blob(FRAME_RECIPE, piece)
+            records += piece
+        return records
+
+    def recv_recipes(self):
+        """Collect recipes until the sender is done; returns {index: records}"""
+        recipes = {}
+        current = None
+        while True:
+            frame_type, _, payload = self.recv_frame()
+            if frame_type == FRAME_RECIPE and current is not None:
+                current += payload
+                continue
+            if frame_type != FRAME_CONTROL:
+                raise ProtocolError(f"Unexpected frame type {frame_type} in recipes")
+            if current is not None and len(current) % RECIPE_RECORD.size:
+                raise ProtocolError("Recipe ends in a partial record")
+            message = json.loads(bytes(payload))
+            if message["type"] == "recipes_done":
+                return recipes
+            current = recipes[message["index"]] = bytearray()
+
+    def recv_json(self, expected_type):
+        frame_type, _, payload = self.recv_frame()
+        if frame_type != expected_type:
+            raise ProtocolError(f"Expected frame type {expected_type}, got {frame_type}")
+        return json.loads(bytes(payload))
+
+    def _recv_exact(self, view):
+        while view:
+            received = self.sock.recv_into(view)
+            if not received:
+                raise ConnectionError("Connection closed by peer")
+            view = view[received:]
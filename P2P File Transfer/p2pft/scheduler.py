@@ -0,0 +1,318 @@
+"""Queue of transfers run a few at a time, sharing one bandwidth budget by priority"""
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+from .engine import DEFAULT_PORT, RateLimiter, Receiver, Sender, TransferProgress, TransferResult
+
+PRIORITIES = ("Low", "Normal", "High", "Urgent")  # Each level gets twice the bandwidth share of the one below
+DEFAULT_PRIORITY = 1
+MAX_CONCURRENT_TRANSFERS = 3
+FAIR_SHARE_IDLE = 0.5  # Seconds without sending after which a transfer's share goes to the others
+FINISHED_STATES = ("completed", "failed", "cancelled")
+
+class FairShare:
+    """Splits one bandwidth budget between transfers in proportion to their weights.
+
+    Each transfer gets its own limiter, a RateLimiter whose rate is its
+    weight's share of the budget among the transfers that are sending.
+    One that has not sent for idle_after seconds, because it waits for a
+    peer, reads a slow disk or is paused, drops out until it sends again,
+    so the others take up its share and the budget stays in use. A rate
+    of 0 means unlimited, and then transfers share the link as TCP does.
+    """
+
+    def __init__(self, rate_limit_bytes, idle_after=FAIR_SHARE_IDLE):
+        self._lock = threading.Lock()
+        self.rate_limit = max(0, rate_limit_bytes)
+        self.idle_after = idle_after
+        self._limiters = []
+
+    def limiter(self, weight=1):
+        """A limiter for one more transfer; give it back with release() when the transfer ends"""
+        limiter = ShareLimiter(self, weight)
+        with self._lock:
+            self._limiters.append(limiter)
+        return limiter
+
+    def release(self, limiter):
+        with self._lock:
+            if limiter in self._limiters:
+                self._limiters.remove(limiter)
+            self._rebalance()
+
+    def set_rate(self, rate_limit_bytes):
+        with self._lock:
+            self.rate_limit = max(0, rate_limit_bytes)
+            self._rebalance()
+
+    def set_weight(self, limiter, weight):
+        with self._lock:
+            limiter.weight = weight
+            self._rebalance()
+
+    def _touch(self, limiter):
+        now = time.monotonic()
+        with self._lock:
+            changed = not limiter.active
+            limiter.active = True
+            limiter.last_active = now
+            for other in self._limiters:
+                if other.active and now - other.last_active > self.idle_after:
+                    other.active = False
+                    changed = True
+            if changed:
+                self._rebalance()
+
+    def _rebalance(self):
+        total = sum(limiter.weight for limiter in self._limiters if limiter.active)
+        for limiter in self._limiters:
+            if limiter.active and self.rate_limit:
+                limiter.bucket.set_rate(self.rate_limit * limiter.weight / total)
+            else:
+                # Idle limiters are rebalanced before their next send
+                limiter.bucket.set_rate(self.rate_limit)
+
+class ShareLimiter:
+    """One transfer's share of a FairShare, usable wherever a RateLimiter is"""
+
+    def __init__(self, fair_share, weight):
+        self.fair_share = fair_share
+        self.weight = weight
+        self.bucket = RateLimiter(fair_share.rate_limit)
+        self.active = False
+        self.last_active = 0.0
+
+    def acquire(self, bytes_count):
+        self.fair_share._touch(self)
+        return self.bucket.acquire(bytes_count)
+
+    def reserve(self, bytes_count):
+        self.fair_share._touch(self)
+        return self.bucket.reserve(bytes_count)
+
+class TransferJob:
+    """A queued transfer. kind is "send" or "receive"; options are the Sender or Receiver arguments.
+
+    Send options hold "paths" and the Sender flags; receive options hold
+    "host", "port", "fingerprint" and "save_path" and any other Receiver
+    arguments. Only the fields of to_dict() are saved.
+    """
+
+    def __init__(self, kind, name, options, priority=DEFAULT_PRIORITY, job_id=None, state="queued", created=None,
+                 status=None, port=None):
+        self.id = job_id or os.urandom(8).hex()
+        self.kind = kind
+        self.name = name
+        self.options = options
+        self.priority = priority
+        self.state = state
+        self.created = created or datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        self.status = status  # Result status once finished
+        self.port = port  # Port a running send listens on
+        self.progress = TransferProgress()
+        self.limiter = None
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def to_dict(self):
+        return {
+            "id": self.id, "kind": self.kind, "name": self.name, "options": self.options,
+            "priority": self.priority, "state": self.state, "created": self.created, "status": self.status,
+            "port": self.port,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["kind"], data["name"], data["options"], data["priority"], data["id"], data["state"],
+                   data["created"], data.get("status"), data.get("port"))
+
+def queue_order(job):
+    """Sort key: running first, then queued by priority and age, then finished"""
+    rank = 0 if job.state == "running" else 1 if job.state == "queued" else 2
+    return rank, -job.priority, job.created
+
+class TransferScheduler:
+    """Runs queued transfers in priority order, at most max_concurrent at a time.
+
+    Jobs of the same priority run in the order they were queued, and the
+    running ones split the rate limit by FairShare, each priority level
+    weighing twice the one below, so an urgent small transfer is not held
+    up behind a large backup while the link stays fully used. Sends listen
+    on the lowest port from DEFAULT_PORT up that is free to bind, so
+    several can wait for their receivers at once; job.port tells which. With a store such as SecureSettings the queue
+    survives restarts; transfers that were running start over.
+
+    Callbacks run on the transfer's worker thread.
+    """
+
+    def __init__(self, store=None, max_concurrent=MAX_CONCURRENT_TRANSFERS, rate_limit_bytes=0, resume_event=None,
+                 on_change=None, on_finish=None, on_error=None):
+        self.store = store
+        self.max_concurrent = max_concurrent
+        self.bandwidth = FairShare(rate_limit_bytes)
+        if resume_event is None:
+            resume_event = threading.Event()
+            resume_event.set()
+        self.resume_event = resume_event
+        self.on_change = on_change  # Called with a job whenever its state changes
+        self.on_finish = on_finish  # Called with a job and its TransferResult
+        self.on_error = on_error  # Called with a job and each error it hits
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._running = {}
+        for data in store.jobs() if store else []:
+            job = TransferJob.from_dict(data)
+            if job.state == "running":
+                job.state = "queued"  # Interrupted by a restart
+                job.port = None
+            self._jobs[job.id] = job
+
+    def start(self):
+        """Start the saved jobs; call once the callbacks are ready"""
+        self._dispatch()
+
+    def submit(self, kind, name, options, priority=DEFAULT_PRIORITY):
+        """Queue a transfer and start it if a slot is free; returns its TransferJob"""
+        job = TransferJob(kind, name, options, priority)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._save(job)
+        self._dispatch()
+        return job
+
+    def jobs(self):
+        """Every job, in queue_order()"""
+        with self._lock:
+            return sorted(self._jobs.values(), key=queue_order)
+
+    def job(self, job_id):
+        return self._jobs.get(job_id)
+
+    def set_priority(self, job_id, priority):
+        """Move a job in the queue, and change its bandwidth share if it is running"""
+        job = self._jobs.get(job_id)
+        if job is None or job.finished:
+            return
+        job.priority = max(0, min(priority, len(PRIORITIES) - 1))
+        if job.limiter:
+            self.bandwidth.set_weight(job.limiter, weight(job.priority))
+        self._save(job)
+
+    def cancel(self, job_id):
+        """Take a queued job off the queue; returns False for jobs that already started"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != "queued":
+                return False
+            job.state = "cancelled"
+            job.progress.finish()
+        self._save(job)
+        return True
+
+    def clear_finished(self):
+        with self._lock:
+            finished = [job for job in self._jobs.values() if job.finished]
+            for job in finished:
+                del self._jobs[job.id]
+        if self.store:
+            for job in finished:
+                self.store.remove_job(job.id)
+
+    def set_max_concurrent(self, max_concurrent):
+        self.max_concurrent = max(1, max_concurrent)
+        self._dispatch()
+
+    def set_rate_limit(self, rate_limit_bytes):
+        self.bandwidth.set_rate(rate_limit_bytes)
+
+    def _dispatch(self):
+        starting, failed = [], []
+        with self._lock:
+            for job in sorted((job for job in self._jobs.values() if job.state == "queued"), key=queue_order):
+                if len(self._running) >= self.max_concurrent:
+                    break
+                if job.kind == "send":
+                    # Before the job takes a slot, so one that cannot listen does not hold it
+                    try:
+                        job.port = self._free_port()
+                    except OSError as e:
+                        job.state = "failed"
+                        job.status = "Failed"
+                        job.progress.finish()
+                        failed.append((job, e))
+                        continue
+                job.state = "running"
+                job.limiter = self.bandwidth.limiter(weight(job.priority))
+                self._running[job.id] = job
+                starting.append(job)
+        for job, error in failed:
+            self._error(job, error)
+            self._save(job)
+            if self.on_finish:
+                self.on_finish(job, TransferResult(job.name, 0, "Failed"))
+        for job in starting:
+            self._save(job)
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _free_port(self):
+        ports = {job.port for job in self._running.values() if job.kind == "send"}
+        for port in range(DEFAULT_PORT, 65536):
+            # A running send may not be listening yet, and other programs hold ports too
+            if port not in ports and port_available(port):
+                return port
+        raise OSError("No free port to listen on")
+
+    def _run(self, job):
+        options = dict(job.options)
+        try:
+            if job.kind == "send":
+                sender = Sender(options.pop("paths"), port=job.port, rate_limiter=job.limiter,
+                                resume_event=self.resume_event, **options)
+                result = sender.send(job.progress, on_error=lambda error: self._error(job, error))
+            else:
+                receiver = Receiver(options.pop("host"), options.pop("port"), options.pop("fingerprint"),
+                                    options.pop("save_path"), rate_limiter=job.limiter, **options)
+                result = receiver.receive(job.progress)
+        except Exception as e:
+            self._error(job, e)
+            result = TransferResult(job.name, 0, "Failed", peer=job.options.get("host"))
+        finally:
+            self.bandwidth.release(job.limiter)
+        with self._lock:
+            del self._running[job.id]
+            job.state = "completed" if result.ok else "failed"
+            job.status = result.status
+            job.limiter = None
+        self._save(job)
+        if self.on_finish:
+            self.on_finish(job, result)
+        self._dispatch()
+
+    def _error(self, job, error):
+        if self.on_error:
+            self.on_error(job, error)
+
+    def _save(self, job):
+        if self.store:
+            self.store.save_job(job.to_dict())
+        if self.on_change:
+            self.on_change(job)
+
+def port_available(port):
+    """Whether a Sender could listen on port right now"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # As in Sender.listen(), so connections still in TIME_WAIT do not count
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("0.0.0.0", port))
+        except OSError:
+            return False
+    return True
+
+def weight(priority):
+    return 2 ** priority
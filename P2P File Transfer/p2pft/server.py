@@ -0,0 +1,487 @@
+"""Asyncio server that keeps listening and serves many receivers at once"""
+import asyncio
+import json
+import os
+import threading
+import time
+
+from .batch import archive_size, build_manifest, read_archive, read_batch
+from .compression import AdaptiveCompressor, available_codecs
+from .dedup import DEDUP_MIN_SIZE, recipe_pieces
+from .engine import (
+    DEFAULT_PORT, TRANSFER_TIMEOUT, RateLimiter, TransferProgress, TransferResult,
+    describe_batch, resend_chunks, server_context,
+)
+from .fanout import FanOut
+from .identity import CERT_FILE, KEY_FILE
+from .merkle import MerkleHasher, merkle_root
+from .metrics import TimedHasher, TransferMetrics
+from .protocol import (
+    COALESCE_SIZE, COPY_INSTRUCTION, FRAME_CHUNK, FRAME_CONTROL, FRAME_COPY, FRAME_DATA,
+    FRAME_RECIPE, FRAME_SIGNATURE, FRAME_TRAILER, FRAME_WANT, MAX_FRAME_SIZE, PROTOCOL_MAGIC,
+    PROTOCOL_VERSION, RECIPE_RECORD, FramedSocket, ProtocolError,
+)
+from .tuning import PathTuner
+
+MAX_CONCURRENT_READS = 4  # Disk reads in flight across all sessions
+WRITE_HIGH_WATER = 4 * 1024 * 1024  # Bytes buffered per connection before its session waits for the peer
+STOP_POLL_INTERVAL = 1.0  # How often a running server checks whether it should stop
+
+class Catalog:
+    """Named offers shared by every session of a server.
+
+    Offers can be added and removed while the server runs; each session
+    walks its offer's paths when it starts, so receivers always see the
+    current files.
+    """
+
+    def __init__(self, offers=None):
+        self._lock = threading.Lock()
+        self._offers = {}
+        for name, paths in (offers or {}).items():
+            self.add(name, paths)
+
+    @classmethod
+    def from_paths(cls, paths):
+        """One offer per path, named after it"""
+        return cls({os.path.basename(os.path.abspath(path)): [path] for path in paths})
+
+    def add(self, name, paths):
+        with self._lock:
+            self._offers[name] = list(paths)
+
+    def remove(self, name):
+        with self._lock:
+            self._offers.pop(name, None)
+
+    def paths(self, name=None):
+        """Paths of one offer, or of every offer when name is None"""
+        with self._lock:
+            if name is None:
+                return [path for paths in self._offers.values() for path in paths]
+            if name not in self._offers:
+                raise KeyError(name)
+            return list(self._offers[name])
+
+    def describe(self):
+        with self._lock:
+            offers = dict(self._offers)
+        listing = []
+        for name, paths in offers.items():
+            files = [entry for _, entry in build_manifest(paths) if not entry.get("dir")]
+            listing.append({"name": name, "files": len(files), "size": sum(entry["size"] for entry in files)})
+        return listing
+
+class _WriterSink:
+    """Lets FramedSocket's send methods write into an asyncio StreamWriter"""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def sendall(self, data):
+        # The frame buffers are reused, so the writer gets its own copy
+        self.writer.write(bytes(data))
+
+class AsyncFramedStream(FramedSocket):
+    """FramedSocket over asyncio streams.
+
+    Sending reuses FramedSocket as is: frames are queued in the
+    StreamWriter and the session awaits drain() for flow control. The
+    receiving methods are coroutines.
+    """
+
+    def __init__(self, reader, writer, max_frame_size=MAX_FRAME_SIZE, timeout=TRANSFER_TIMEOUT):
+        self.sock = _WriterSink(writer)
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.max_frame_size = max_frame_size
+        self.peer_version = None
+        self._out = bytearray(self.PREFIX.size + max_frame_size)
+
+    async def handshake(self):
+        self.sock.sendall(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]))
+        return self._check_preamble(await self._recv_exact(len(PROTOCOL_MAGIC) + 1))
+
+    async def drain(self):
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def recv_frame(self):
+        frame_type, flags, length = self.PREFIX.unpack(await self._recv_exact(self.PREFIX.size))
+        if length > self.max_frame_size:
+            raise ProtocolError(f"Peer sent a frame of {length} bytes, above the maximum frame size")
+        return frame_type, flags, await self._recv_exact(length)
+
+    async def recv_json(self, expected_type):
+        frame_type, _, payload = await self.recv_frame()
+        if frame_type != expected_type:
+            raise ProtocolError(f"Expected frame type {expected_type}, got {frame_type}")
+        return json.loads(payload)
+
+    async def recv_signatures(self):
+        signatures = {}
+        current = None
+        while True:
+            frame_type, _, payload = await self.recv_frame()
+            if frame_type == FRAME_SIGNATURE and current is not None:
+                current += payload
+                continue
+            if frame_type != FRAME_CONTROL:
+                raise ProtocolError(f"Unexpected frame type {frame_type} in signatures")
+            message = json.loads(payload)
+            if message["type"] == "signatures_done":
+                return signatures
+            current = bytearray()
+            signatures[message["index"]] = (message["block_size"], current)
+
+    async def recv_blob(self, frame_type, length):
+        data = bytearray()
+        while len(data) < length:
+            received_type, _, payload = await self.recv_frame()
+            if received_type != frame_type:
+                raise ProtocolError(f"Expected frame type {frame_type}, got {received_type}")
+            data += payload
+        if len(data) != length:
+            raise ProtocolError("Peer sent more data than announced")
+        return data
+
+    async def _recv_exact(self, length):
+        try:
+            return await asyncio.wait_for(self.reader.readexactly(length), self.timeout)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed by peer")
+
+class TransferServer:
+    """Serves the offers of a Catalog to any number of concurrent receivers.
+
+    Each TLS session runs as a task on one event loop. Sessions share the
+    rate limiter and a cap on concurrent disk reads, which run in worker
+    threads, and each connection only buffers WRITE_HIGH_WATER bytes before
+    its session waits for that peer, so a slow receiver never holds up the
+    others. Receivers speak the same protocol as with Sender; the offer
+    named in their hello picks what they get, and without one they get the
+    whole catalog.
+
+    With broadcast set, receivers that arrive together share one FanOut
+    pass over their offer instead of each reading it from disk, unless
+    delta sync or dedup leaves them needing only part of it.
+
+    With autotune, each session has a PathTuner fitting its frames and
+    socket buffer to its receiver's path; broadcast frames keep the size
+    of their shared pass.
+
+    With archive, receivers that support it get their offer as one
+    read_archive() stream instead of a manifest and batch, without delta
+    sync, dedup or broadcast.
+    """
+
+    def __init__(self, catalog, port=DEFAULT_PORT, compress=False, delta=False, dedup=False,
+                 rate_limiter=None, resume_event=None, max_reads=MAX_CONCURRENT_READS,
+                 broadcast=False, cert_path=CERT_FILE, key_path=KEY_FILE, buffer_size=COALESCE_SIZE,
+                 autotune=True, archive=False):
+        self.catalog = catalog
+        self.port = port
+        self.compress = compress
+        self.delta = delta
+        self.dedup = dedup
+        self.rate_limiter = rate_limiter or RateLimiter(0)
+        if resume_event is None:
+            resume_event = threading.Event()
+            resume_event.set()
+        self.resume_event = resume_event
+        self.max_reads = max_reads
+        self.broadcast = broadcast
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self.buffer_size = buffer_size  # Payload bytes per data frame, at most MAX_FRAME_SIZE
+        self.autotune = autotune
+        self.archive = archive
+        self.sessions = {}  # Peer address -> TransferProgress of sessions in flight
+
+    def run(self, stop_event, on_result=None, on_error=None):
+        """Serve on a fresh event loop until stop_event is set"""
+        asyncio.run(self.serve(stop_event, on_result, on_error))
+
+    async def serve(self, stop_event, on_result=None, on_error=None):
+        self._reads = asyncio.Semaphore(self.max_reads)
+        self._fanouts = {}  # Offer name -> FanOut pass new receivers join
+        self._fanouts_lock = asyncio.Lock()
+        connections = {}  # Handler task -> its StreamWriter
+
+        async def handle(reader, writer):
+            addr = writer.get_extra_info("peername")
+            connections[asyncio.current_task()] = writer
+            try:
+                async for result in self.serve_connection(reader, writer, addr):
+                    if on_result:
+                        on_result(result, addr)
+            except Exception as e:
+                if on_error:
+                    on_error(e)
+            finally:
+                connections.pop(asyncio.current_task(), None)
+                writer.close()
+
+        server = await asyncio.start_server(
+            handle, "0.0.0.0", self.port, ssl=server_context(self.cert_path, self.key_path),
+            ssl_handshake_timeout=TRANSFER_TIMEOUT, reuse_address=True,
+        )
+        async with server:
+            while not stop_event.is_set():
+                await asyncio.sleep(STOP_POLL_INTERVAL)
+
+        # Close kept-alive connections so their handlers end before the loop does
+        for writer in connections.values():
+            writer.close()
+        await asyncio.gather(*connections, return_exceptions=True)
+
+    async def serve_connection(self, reader, writer, addr):
+        """Serve every request of one connection, yielding the result of each batch sent.
+
+        Receivers may keep the connection open after a request and send
+        another hello on it; it is closed once they hang up or leave it
+        idle for TRANSFER_TIMEOUT.
+        """
+        writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+        framed = AsyncFramedStream(reader, writer)
+        await framed.handshake()
+        while True:
+            # The receiver says hello to start each request, naming what it wants
+            try:
+                hello = await framed.recv_json(FRAME_CONTROL)
+            except (ConnectionError, asyncio.TimeoutError):
+                return
+            result = await self.serve_request(framed, hello, addr)
+            if result:
+                yield result
+
+    async def serve_request(self, framed, hello, addr):
+        """Answer one hello; returns the result of the batch sent, or None if there was none"""
+        loop = asyncio.get_running_loop()
+        if hello.get("type") == "list":
+            offers = await loop.run_in_executor(None, self.catalog.describe)
+            framed.send_json(FRAME_CONTROL, {"type": "catalog", "offers": offers, "keepalive": True})
+            await framed.drain()
+            return None
+        try:
+            paths = self.catalog.paths(hello.get("offer"))
+        except KeyError:
+            framed.send_json(FRAME_CONTROL, {"type": "error", "message": f"No offer named {hello['offer']!r}"})
+            await framed.drain()
+            return None
+        metrics = TransferMetrics()
+        mark = time.perf_counter()
+        archive = self.archive and hello.get("archive", False)
+        delta = self.delta and not archive
+        dedup = self.dedup and not archive
+        if self.broadcast and not archive:
+            fanout, member = await self._fanout(hello.get("offer"), paths)
+            manifest = fanout.manifest
+        else:
+            fanout = member = None
+            manifest = await loop.run_in_executor(None, build_manifest, paths)
+        entries = [entry for _, entry in manifest]
+        progress = self.sessions[addr] = TransferProgress()
+        files_size = sum(entry["size"] for entry in entries)
+        session = {"type": "session", "delta": delta, "dedup": dedup, "keepalive": True}
+        if archive:
+            session["archive"] = {"entries": len(entries), "size": archive_size(entries), "files_size": files_size}
+        progress.start(session["archive"]["size"] if archive else files_size)
+        mark = metrics.lap("scan", mark)
+
+        try:
+            framed.send_json(FRAME_CONTROL, session)
+            if not archive:
+                framed.send_manifest(entries)
+            await framed.drain()
+
+            codec = next((c for c in available_codecs() if c in hello.get("codecs", [])), None)
+            compressor = AdaptiveCompressor(codec) if self.compress and codec else None
+
+            signatures = await framed.recv_signatures() if delta else {}
+
+            recipes = {}
+            if dedup:
+                for index, (source, entry) in enumerate(manifest):
+                    if index not in signatures and not entry.get("dir") and entry["size"] >= DEDUP_MIN_SIZE:
+                        recipes[index] = await self._send_recipe(framed, index, source)
+                framed.send_json(FRAME_CONTROL, {"type": "recipes_done"})
+                await framed.drain()
+                for index, records in recipes.items():
+                    chunks = len(records) // RECIPE_RECORD.size
+                    recipes[index] = (records, await framed.recv_blob(FRAME_WANT, (chunks + 7) // 8))
+
+            metrics.lap("negotiate", mark)
+
+            # Receivers that need the whole stream share one read of it
+            broadcast = fanout and not signatures and _wants_everything(recipes)
+            tuner = None
+            if self.autotune:
+                tuner = PathTuner(framed.writer.get_extra_info("socket"), None if broadcast else self.buffer_size,
+                                  metrics, hello.get("rtt"))
+            if broadcast:
+                bytes_sent, leaves = await self._send_broadcast(framed, fanout, member, progress, metrics, tuner)
+            else:
+                bytes_sent, leaves = await self._send_batch(framed, manifest, signatures, recipes, compressor,
+                                                            progress, metrics, tuner, archive)
+
+            mark = time.perf_counter()
+            framed.send_json(FRAME_TRAILER, {"size": bytes_sent, "root": merkle_root(leaves).hex()})
+            await framed.drain()
+            result = await framed.recv_json(FRAME_CONTROL)
+            while result.get("type") == "retransmit":
+                # Retransmissions are rare, so their chunks are read on the event loop
+                for index in result["chunks"]:
+                    resend_chunks(framed, manifest, [index])
+                    await framed.drain()
+                metrics.count("retransmitted_chunks", len(result["chunks"]))
+                result = await framed.recv_json(FRAME_CONTROL)
+            metrics.lap("verify", mark)
+        finally:
+            if fanout:
+                await fanout.leave(member)
+            progress.finish()
+            del self.sessions[addr]
+
+        metrics.finish()
+        status = "Completed" if result.get("ok") else "Failed (Checksum)"
+        return TransferResult(describe_batch(entries), files_size if archive else bytes_sent, status, metrics=metrics)
+
+    async def _send_recipe(self, framed, index, source):
+        """Chunk source off the loop and send its recipe a piece at a time; returns the whole recipe"""
+        loop = asyncio.get_running_loop()
+        pieces = recipe_pieces(source)
+        framed.send_json(FRAME_CONTROL, {"type": "recipe", "index": index})
+        records = bytearray()
+        while True:
+            async with self._reads:
+                piece = await loop.run_in_executor(None, next, pieces, None)
+            if piece is None:
+                return records
+            framed.send_blob(FRAME_RECIPE, piece)
+            records += piece
+            await framed.drain()
+
+    async def _send_batch(self, framed, manifest, signatures, recipes, compressor, progress, metrics, tuner=None,
+                          archive=False):
+        """Read, encode and send the batch, or with archive its archive stream, for this receiver alone"""
+        loop = asyncio.get_running_loop()
+        hasher = MerkleHasher()
+        timed_hasher = TimedHasher(hasher, metrics)
+        leaves_sent = 0
+        bytes_sent = 0
+        buf = framed.data_buffer(MAX_FRAME_SIZE if tuner else self.buffer_size)
+        frame_size = (lambda: tuner.read_size) if tuner else None
+        if archive:
+            ops = read_archive(manifest, buf, timed_hasher, frame_size)
+        else:
+            ops = read_batch(manifest, buf, timed_hasher, signatures, recipes, frame_size)
+
+        def next_op():
+            # Reading, delta encoding and compression all happen off the event loop
+            mark = time.perf_counter()
+            op, value = next(ops, (None, None))
+            mark = metrics.lap("read", mark)
+            if op == "data":
+                payload, flags = compressor.compress(buf[:value]) if compressor else (None, 0)
+                if compressor:
+                    metrics.lap("compress", mark)
+                return op, value, payload, flags
+            return op, value, None, 0
+
+        while True:
+            await self._wait_resumed(metrics)
+            waiting = self._reads.locked()
+            mark = time.perf_counter()
+            async with self._reads:
+                if waiting:
+                    metrics.lap("disk_read_slot", mark, stall=True)
+                op, value, payload, flags = await loop.run_in_executor(None, next_op)
+            if op is None:
+                break
+
+            if op == "copy":
+                framed.send_frame(FRAME_COPY, COPY_INSTRUCTION.pack(*value))
+                length = value[1]
+                metrics.count("copied_bytes", length)
+            elif op == "chunk":
+                framed.send_frame(FRAME_CHUNK, RECIPE_RECORD.pack(*value))
+                length = value[1]
+                metrics.count("deduplicated_bytes", length)
+            else:
+                length = value
+                send_start = time.perf_counter()
+                wire_bytes = len(payload) if flags else length
+                await self._send_data(framed, metrics, length, payload, flags)
+                if compressor:
+                    compressor.record_send(wire_bytes, time.perf_counter() - send_start)
+                metrics.count("wire_bytes", wire_bytes)
+            bytes_sent += length
+            progress.add(length)
+            leaves_sent = framed.send_leaves(hasher.leaves, leaves_sent)
+            if tuner:
+                tuner.sample(metrics.counters["wire_bytes"])
+        # Hashing happened inside the reads and was charged to its own phase
+        metrics.phases["read"] -= timed_hasher.seconds
+        framed.send_leaves(hasher.finish(), leaves_sent)
+        return bytes_sent, hasher.leaves
+
+    async def _send_broadcast(self, framed, fanout, member, progress, metrics, tuner=None):
+        """Send the batch from a shared FanOut pass as member; data goes out uncompressed"""
+        buf = framed.data_buffer(fanout.chunk_size)
+        leaves_sent = 0
+        for index in range(fanout.chunk_count):
+            await self._wait_resumed(metrics)
+            mark = time.perf_counter()
+            length = await fanout.read(member, index, buf)
+            metrics.lap("read", mark)
+            await self._send_data(framed, metrics, length)
+            metrics.count("wire_bytes", length)
+            progress.add(length)
+            leaves_sent = framed.send_leaves(fanout.hasher.leaves, leaves_sent)
+            if tuner:
+                tuner.sample(metrics.counters["wire_bytes"])
+        leaves = await fanout.result()
+        framed.send_leaves(leaves, leaves_sent)
+        return fanout.total_size, leaves
+
+    async def _fanout(self, offer, paths):
+        """Join the pass over an offer that a new receiver can still join, starting one if needed.
+
+        Returns the pass and the member token. The receiver is a member from
+        here on, while it still negotiates, so the pass keeps going for it;
+        it must leave the pass whether or not it ends up reading from it.
+        """
+        async with self._fanouts_lock:
+            fanout = self._fanouts.get(offer)
+            if fanout is None or not fanout.joinable:
+                manifest = await asyncio.get_running_loop().run_in_executor(None, build_manifest, paths)
+                fanout = self._fanouts[offer] = FanOut(manifest, self._reads, min(self.buffer_size, MAX_FRAME_SIZE))
+            return fanout, fanout.join()
+
+    async def _send_data(self, framed, metrics, length, payload=None, flags=0):
+        """Send a data frame, raw from data_buffer() unless flags says payload is compressed"""
+        wait = self.rate_limiter.reserve(len(payload) if flags else length)
+        await asyncio.sleep(max(0, wait))
+        metrics.add_stall("rate_limit", wait)
+        mark = time.perf_counter()
+        if flags:
+            framed.send_frame(FRAME_DATA, payload, flags)
+        else:
+            framed.send_data(length)
+        await framed.drain()
+        metrics.lap("send", mark)
+
+    async def _wait_resumed(self, metrics):
+        if not self.resume_event.is_set():
+            mark = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(None, self.resume_event.wait)
+            metrics.lap("paused", mark, stall=True)
+
+def _wants_everything(recipes):
+    """Whether the receiver's chunk store had none of the recipe chunks"""
+    for records, wanted in recipes.values():
+        for n in range(len(records) // RECIPE_RECORD.size):
+            if not wanted[n >> 3] & (0x80 >> (n & 7)):
+                return False
+    return True
@@ -0,0 +1,214 @@
+"""Encrypted storage for settings, saved peers, queued transfers and history"""
+import base64
+import json
+import os
+import sqlite3
+import threading
+
+SETTINGS_KEY_FILE = "settings.key"
+SETTINGS_DB = "settings.db"
+LEGACY_SETTINGS_FILE = "settings.enc"  # Single Fernet token of everything, as earlier versions wrote it
+HISTORY_MAX_ENTRIES = 100000  # Oldest transfers are dropped beyond this
+HISTORY_SEARCH_FIELDS = ("timestamp", "filename", "peer", "status", "direction")
+
+class SecureSettings:
+    """Settings, saved peers, the transfer queue and history, encrypted at rest.
+
+    Every setting, peer, queued transfer and history entry is its own
+    Fernet-encrypted row in a SQLite database, so changing one setting or
+    recording a transfer writes a single row instead of re-encrypting
+    everything. Settings, peers and jobs are decrypted once when the store
+    is opened and served from memory. History is read a page at a time,
+    decrypting only the rows shown; the first search decrypts it all into
+    an in-memory search index that later additions keep up to date. Only
+    setting names, job ids and history timestamps are stored in the clear.
+    """
+
+    def __init__(self, path=SETTINGS_DB, key_path=SETTINGS_KEY_FILE):
+        # Imported here so that importing p2pft does not load cryptography
+        from cryptography.fernet import Fernet
+        self.key = self._get_or_create_key(key_path)
+        self.cipher = Fernet(self.key)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS peers (id INTEGER PRIMARY KEY, value BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, value BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, timestamp TEXT, value BLOB)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp)")
+        self.db.commit()
+
+        self._settings = {name: self._decrypt(value) for name, value in self.db.execute("SELECT name, value FROM settings")}
+        self._peers = {}  # Name -> (row id, peer), in the order they were added
+        for row_id, value in self.db.execute("SELECT id, value FROM peers ORDER BY id"):
+            peer = self._decrypt(value)
+            self._peers[peer["name"]] = (row_id, peer)
+        self._jobs = {job_id: self._decrypt(value)
+                      for job_id, value in self.db.execute("SELECT id, value FROM jobs ORDER BY rowid")}
+        self._history = None  # [(search text, entry)], oldest first, built by the first search
+
+        if os.path.exists(LEGACY_SETTINGS_FILE) and not self._settings and not self._peers:
+            self._migrate(LEGACY_SETTINGS_FILE)
+
+    def _get_or_create_key(self, key_file):
+        if os.path.exists(key_file):
+            with open(key_file, "rb") as f:
+                return f.read()
+        else:
+            key = base64.urlsafe_b64encode(os.urandom(32))  # Same as Fernet.generate_key()
+            with open(key_file, "wb") as f:
+                f.write(key)
+            return key
+
+    def save_settings(self, data):
+        """Store every setting in data, leaving the others as they are"""
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                [(name, self._encrypt(value)) for name, value in data.items()],
+            )
+            self.db.commit()
+            self._settings.update(data)
+
+    def load_settings(self):
+        return dict(self._settings)
+
+    def peers(self):
+        return [peer for _, peer in self._peers.values()]
+
+    def peer(self, name):
+        """The saved peer called name, or None"""
+        entry = self._peers.get(name)
+        return entry and entry[1]
+
+    def save_peer(self, peer):
+        """Add a peer, or replace the saved peer of the same name"""
+        with self._lock:
+            value = self._encrypt(peer)
+            if peer["name"] in self._peers:
+                row_id = self._peers[peer["name"]][0]
+                self.db.execute("UPDATE peers SET value = ? WHERE id = ?", (value, row_id))
+            else:
+                row_id = self.db.execute("INSERT INTO peers (value) VALUES (?)", (value,)).lastrowid
+            self.db.commit()
+            self._peers[peer["name"]] = (row_id, dict(peer))
+
+    def remove_peer(self, name):
+        with self._lock:
+            entry = self._peers.pop(name, None)
+            if entry:
+                self.db.execute("DELETE FROM peers WHERE id = ?", (entry[0],))
+                self.db.commit()
+
+    def jobs(self):
+        """Queued and recently finished transfers, in the order they were first saved"""
+        return [dict(job) for job in self._jobs.values()]
+
+    def save_job(self, job):
+        """Add a transfer job, or update the saved job with the same id"""
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO jobs VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET value = excluded.value",
+                (job["id"], self._encrypt(job)),
+            )
+            self.db.commit()
+            self._jobs[job["id"]] = dict(job)
+
+    def remove_job(self, job_id):
+        with self._lock:
+            if self._jobs.pop(job_id, None) is not None:
+                self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                self.db.commit()
+
+    def history_count(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def history_page(self, offset, limit):
+        """Up to limit entries, newest first, after skipping the offset newest ones"""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT value FROM history ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset)
+            ).fetchall()
+        return [self._decrypt(value) for value, in rows]
+
+    def search_history(self, text="", status=None):
+        """Entries, newest first, containing every word of text and with the given status if any.
+
+        The first search decrypts the whole history, so callers with a UI
+        should run it on a worker thread.
+        """
+        words = text.lower().split()
+        history = self._load_history()
+        with self._lock:
+            return [
+                entry for haystack, entry in reversed(history)
+                if (status is None or entry.get("status") == status) and all(word in haystack for word in words)
+            ]
+
+    def add_history(self, entry):
+        """Record one transfer, dropping the oldest beyond HISTORY_MAX_ENTRIES"""
+        with self._lock:
+            row_id = self.db.execute(
+                "INSERT INTO history (timestamp, value) VALUES (?, ?)", (entry["timestamp"], self._encrypt(entry))
+            ).lastrowid
+            self.db.execute("DELETE FROM history WHERE id <= ?", (row_id - HISTORY_MAX_ENTRIES,))
+            self.db.commit()
+            if self._history is not None:
+                self._history.append(_search_entry(dict(entry)))
+                del self._history[:-HISTORY_MAX_ENTRIES]
+
+    def clear_history(self):
+        with self._lock:
+            self.db.execute("DELETE FROM history")
+            self.db.commit()
+            self._history = []
+
+    def close(self):
+        self.db.close()
+
+    def _load_history(self):
+        # Decrypt without holding the lock, so recording transfers does not wait for it
+        with self._lock:
+            if self._history is not None:
+                return self._history
+            rows = self.db.execute("SELECT id, value FROM history ORDER BY id").fetchall()
+        history = [_search_entry(self._decrypt(value)) for _, value in rows]
+        with self._lock:
+            if self._history is None:
+                # Pick up what was added in the meantime
+                newer = self.db.execute("SELECT value FROM history WHERE id > ? ORDER BY id", (rows[-1][0] if rows else 0,))
+                history += [_search_entry(self._decrypt(value)) for value, in newer]
+                self._history = history[-HISTORY_MAX_ENTRIES:]
+            return self._history
+
+    def _migrate(self, legacy_path):
+        """Import the single encrypted blob of earlier versions, then set it aside"""
+        try:
+            with open(legacy_path, "rb") as f:
+                data = json.loads(self.cipher.decrypt(f.read()))
+        except Exception:
+            return  # Unreadable, as load_settings() used to treat it
+        peers = data.pop("saved_peers", [])
+        history = data.pop("transfer_history", [])[-HISTORY_MAX_ENTRIES:]
+        self.save_settings(data)
+        for peer in peers:
+            self.save_peer(peer)
+        with self._lock:
+            self.db.executemany(
+                "INSERT INTO history (timestamp, value) VALUES (?, ?)",
+                [(entry["timestamp"], self._encrypt(entry)) for entry in history],
+            )
+            self.db.commit()
+        os.replace(legacy_path, legacy_path + ".migrated")
+
+    def _encrypt(self, value):
+        return self.cipher.encrypt(json.dumps(value).encode())
+
+    def _decrypt(self, token):
+        return json.loads(self.cipher.decrypt(token))
+
+def _search_entry(entry):
+    """Pair a history entry with the lowercase text searches match against"""
+    return " ".join(str(entry.get(field, "")) for field in HISTORY_SEARCH_FIELDS).lower(), entry
@@ -0,0 +1,424 @@
+"""LAN swarm: receivers fetch verified pieces from each other, rarest first"""
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+from .batch import build_manifest, preallocate, read_stream_range, safe_join, stream_starts, write_stream_range
+from .engine import (
+    DEFAULT_PORT, TRANSFER_TIMEOUT, RateLimiter, Receiver, TransferProgress, server_context,
+)
+from .identity import CERT_FILE, KEY_FILE, get_cert_fingerprint
+from .protocol import (
+    FRAME_CONTROL, FRAME_PIECE, FRAME_PIECE_HASHES, PIECE_HEADER, FramedSocket, ProtocolError,
+)
+
+SWARM_PIECE_SIZE = 512 * 1024
+SWARM_MAX_PEERS = 8  # Peers a node fetches from at once
+SWARM_UPDATE_INTERVAL = 2.0  # Seconds between refreshes of a peer's pieces and the peer list
+
+class SwarmDescriptor:
+    """What a swarm distributes: the manifest and the SHA-256 of every piece.
+
+    The stream of the batch is cut into pieces of piece_size. Joiners get
+    the descriptor from the seeder, whom they pin by fingerprint, so pieces
+    fetched from any other peer can be checked against it and those peers
+    need no trust of their own.
+    """
+
+    def __init__(self, entries, piece_size, hashes):
+        self.entries = entries
+        self.piece_size = piece_size
+        self.hashes = bytes(hashes)
+        self.starts = stream_starts(entries)
+        self.total_size = self.starts[-1]
+        self.piece_count = len(self.hashes) // 32
+        self.swarm_id = hashlib.sha256(
+            json.dumps([entries, piece_size]).encode() + self.hashes).hexdigest()
+
+    @classmethod
+    def from_paths(cls, paths, piece_size=SWARM_PIECE_SIZE):
+        """Hash the pieces of a selection; returns (descriptor, manifest)"""
+        manifest = build_manifest(paths)
+        starts = stream_starts(entry for _, entry in manifest)
+        buf = bytearray(piece_size)
+        hashes = bytearray()
+        for offset in range(0, starts[-1], piece_size):
+            length = read_stream_range(manifest, starts, offset, memoryview(buf)[:min(piece_size, starts[-1] - offset)])
+            hashes += hashlib.sha256(memoryview(buf)[:length]).digest()
+        return cls([entry for _, entry in manifest], piece_size, hashes), manifest
+
+    def piece_length(self, index):
+        return min(self.piece_size, self.total_size - index * self.piece_size)
+
+    def send(self, framed):
+        framed.send_json(FRAME_CONTROL, {"type": "descriptor", "piece_size": self.piece_size, "pieces": self.piece_count})
+        framed.send_manifest(self.entries)
+        framed.send_blob(FRAME_PIECE_HASHES, self.hashes)
+
+    @classmethod
+    def recv(cls, framed):
+        message = framed.recv_json(FRAME_CONTROL)
+        if message.get("type") != "descriptor":
+            raise ProtocolError("Peer is not seeding a swarm")
+        entries = framed.recv_manifest()
+        hashes = framed.recv_blob(FRAME_PIECE_HASHES, message["pieces"] * 32)
+        return cls(entries, message["piece_size"], hashes)
+
+class PieceStore:
+    """The pieces of a swarm batch on local disk and the bitmap of those present.
+
+    A receiving store writes into "<name>.part" files, preallocated to
+    their final size, and renames them once every piece is verified.
+    """
+
+    def __init__(self, descriptor, manifest, complete):
+        self.descriptor = descriptor
+        self._manifest = manifest
+        self._lock = threading.Lock()
+        self.have = bytearray((descriptor.piece_count + 7) // 8)
+        self.missing = 0 if complete else descriptor.piece_count
+        if complete:
+            for index in range(descriptor.piece_count):
+                self.have[index >> 3] |= 0x80 >> (index & 7)
+
+    @classmethod
+    def seeding(cls, descriptor, manifest):
+        return cls(descriptor, manifest, complete=True)
+
+    @classmethod
+    def receiving(cls, descriptor, root):
+        manifest = []
+        for entry in descriptor.entries:
+            target = safe_join(root, entry["path"])
+            if entry.get("dir"):
+                os.makedirs(target, exist_ok=True)
+                manifest.append((target, entry))
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target + ".part", "wb") as f:
+                f.truncate(entry["size"])
+                preallocate(f, entry["size"])
+            manifest.append((target + ".part", entry))
+        store = cls(descriptor, manifest, complete=descriptor.piece_count == 0)
+        if store.complete:
+            store._finish()
+        return store
+
+    @property
+    def complete(self):
+        return not self.missing
+
+    def has(self, index):
+        return bool(self.have[index >> 3] & (0x80 >> (index & 7)))
+
+    def read_piece(self, index, buf):
+        """Read a piece this store has into buf; returns its length"""
+        length = self.descriptor.piece_length(index)
+        with self._lock:
+            if not self.has(index):
+                raise ProtocolError(f"Piece {index} is not available here")
+            return read_stream_range(self._manifest, self.descriptor.starts, index * self.descriptor.piece_size,
+                                     memoryview(buf)[:length])
+
+    def write_piece(self, index, data):
+        """Store a piece if it matches the descriptor; returns False for bad data"""
+        expected = self.descriptor.hashes[index * 32:index * 32 + 32]
+        if len(data) != self.descriptor.piece_length(index) or hashlib.sha256(data).digest() != expected:
+            return False
+        write_stream_range(self._manifest, self.descriptor.starts, index * self.descriptor.piece_size, data)
+        with self._lock:
+            if not self.has(index):
+                self.have[index >> 3] |= 0x80 >> (index & 7)
+                self.missing -= 1
+                if not self.missing:
+                    self._finish()
+        return True
+
+    def _finish(self):
+        manifest = []
+        for source, entry in self._manifest:
+            if not entry.get("dir"):
+                # The pieces must be on disk before the file appears complete under its real name
+                with open(source, "rb+") as f:
+                    os.fsync(f.fileno())
+                target = source[:-len(".part")]
+                os.replace(source, target)
+                if "mtime" in entry:
+                    os.utime(target, (entry["mtime"], entry["mtime"]))
+                source = target
+            manifest.append((source, entry))
+        self._manifest = manifest
+
+class _PieceBucket:
+    """A set of piece indices that can also pick a random member in constant time"""
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, index):
+        if index not in self.positions:
+            self.positions[index] = len(self.items)
+            self.items.append(index)
+
+    def discard(self, index):
+        position = self.positions.pop(index, None)
+        if position is not None:
+            last = self.items.pop()
+            if last != index:
+                self.items[position] = last
+                self.positions[last] = position
+
+class SwarmNode:
+    """One member of a swarm: serves the pieces it holds and fetches the rest.
+
+    The seeder also acts as the tracker: every node keeps a connection to
+    it and learns the other members from it. Each node fetches from up to
+    SWARM_MAX_PEERS peers at once, always asking a peer for the piece that
+    is rarest among the peers it knows of, so new pieces spread through
+    the swarm instead of everyone queueing on the seeder's uplink.
+    Joined nodes keep serving after they finish until stop_event is set.
+    """
+
+    def __init__(self, store, port=DEFAULT_PORT, rate_limiter=None, progress=None,
+                 cert_path=CERT_FILE, key_path=KEY_FILE):
+        self.store = store
+        self.port = port
+        self.rate_limiter = rate_limiter or RateLimiter(0)
+        self.progress = progress or TransferProgress()
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self.fingerprint = get_cert_fingerprint(cert_path)
+        self.completed = threading.Event()
+        if store.complete:
+            self.completed.set()
+        self.tracker = None
+        self._lock = threading.Lock()
+        self._members = {}  # (host, port) -> (fingerprint, connection) on the tracker, while connected
+        self._peers = {}  # (host, port) -> fingerprint of the peers we know of
+        self._fetching = set()  # Peers with a fetch worker running
+        self._peer_have = {}  # Peer -> its piece bitmap
+        self._counts = [0] * store.descriptor.piece_count  # Peers holding each piece
+        self._wanted = {}  # Peer -> {count: _PieceBucket} of its pieces we still need, by how many peers hold them
+        self._in_flight = set()
+
+    @classmethod
+    def seed(cls, paths, piece_size=SWARM_PIECE_SIZE, **kwargs):
+        descriptor, manifest = SwarmDescriptor.from_paths(paths, piece_size)
+        return cls(PieceStore.seeding(descriptor, manifest), **kwargs)
+
+    @classmethod
+    def join(cls, seeder, fingerprint, save_path, **kwargs):
+        """Fetch the descriptor from the seeder at (host, port) and prepare to receive into save_path"""
+        with Receiver(*seeder, fingerprint, save_path).connect() as framed:
+            framed.send_json(FRAME_CONTROL, {"type": "swarm_hello", "swarm": None})
+            descriptor = SwarmDescriptor.recv(framed)
+        node = cls(PieceStore.receiving(descriptor, save_path), **kwargs)
+        node.tracker = tuple(seeder)
+        node._peers[node.tracker] = fingerprint
+        return node
+
+    def run(self, stop_event):
+        """Serve and fetch until stop_event is set"""
+        self.progress.start(self.store.descriptor.total_size)
+        if self.store.complete:
+            self.progress.done = self.store.descriptor.total_size
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('0.0.0.0', self.port))
+        listener.listen(16)
+        listener.settimeout(SWARM_UPDATE_INTERVAL)
+        context = server_context(self.cert_path, self.key_path)
+        try:
+            while not stop_event.is_set():
+                self._start_workers(stop_event)
+                try:
+                    conn, addr = listener.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self._serve_peer, args=(context, conn, addr), daemon=True).start()
+        finally:
+            listener.close()
+            self.progress.finish()
+
+    def _start_workers(self, stop_event):
+        with self._lock:
+            # Once complete, only the tracker connection is kept, so the tracker keeps listing us
+            candidates = [peer for peer in self._peers if peer not in self._fetching
+                          and (peer == self.tracker or not self.store.complete)]
+            # Always keep fetching from the tracker, it is how we learn about new members
+            candidates.sort(key=lambda peer: peer != self.tracker)
+            for peer in candidates[:SWARM_MAX_PEERS - len(self._fetching)]:
+                self._fetching.add(peer)
+                threading.Thread(target=self._fetch_from, args=(peer, stop_event), daemon=True).start()
+
+    def _serve_peer(self, context, conn, addr):
+        try:
+            conn.settimeout(TRANSFER_TIMEOUT)
+            with context.wrap_socket(conn, server_side=True) as ssock:
+                framed = FramedSocket(ssock)
+                framed.handshake()
+                hello = framed.recv_json(FRAME_CONTROL)
+                if hello.get("swarm") is None:
+                    # A joiner asking the seeder what the swarm distributes
+                    self.store.descriptor.send(framed)
+                    return
+                if hello["swarm"] != self.store.descriptor.swarm_id:
+                    raise ProtocolError("Peer belongs to a different swarm")
+                member = (addr[0], hello["port"])
+                if self.tracker is None:
+                    with self._lock:
+                        self._members[member] = (hello["fingerprint"], conn)
+                try:
+                    self._serve_requests(framed, member)
+                finally:
+                    # A member that reconnected has replaced this connection and stays listed
+                    with self._lock:
+                        if self._members.get(member, (None, None))[1] is conn:
+                            del self._members[member]
+        except (OSError, ProtocolError):
+            pass  # The peer will find the pieces elsewhere
+
+    def _serve_requests(self, framed, member):
+        buf = bytearray(PIECE_HEADER.size + self.store.descriptor.piece_size)
+        while True:
+            try:
+                message = framed.recv_json(FRAME_CONTROL)
+            except ConnectionError:
+                return
+            if message["type"] == "request":
+                index = message["piece"]
+                PIECE_HEADER.pack_into(buf, 0, index)
+                length = self.store.read_piece(index, memoryview(buf)[PIECE_HEADER.size:])
+                self.rate_limiter.acquire(length)
+                framed.send_frame(FRAME_PIECE, memoryview(buf)[:PIECE_HEADER.size + length])
+            elif message["type"] == "update":
+                framed.send_json(FRAME_CONTROL, self._status(member))
+            else:
+                raise ProtocolError(f"Unexpected swarm message {message['type']!r}")
+
+    def _status(self, member):
+        """Our piece bitmap, and the other members if we are the tracker"""
+        with self._lock:
+            peers = [{"host": host, "port": port, "fingerprint": fingerprint}
+                     for (host, port), (fingerprint, _) in self._members.items() if (host, port) != member]
+            return {"type": "status", "have": self.store.have.hex(), "peers": peers}
+
+    def _fetch_from(self, peer, stop_event):
+        host, port = peer
+        try:
+            with Receiver(host, port, self._peers[peer], None).connect() as framed:
+                framed.send_json(FRAME_CONTROL, {
+                    "type": "swarm_hello", "swarm": self.store.descriptor.swarm_id,
+                    "port": self.port, "fingerprint": self.fingerprint,
+                })
+                last_update = 0
+                while not stop_event.is_set() and (peer == self.tracker or not self.store.complete):
+                    if time.monotonic() - last_update >= SWARM_UPDATE_INTERVAL:
+                        framed.send_json(FRAME_CONTROL, {"type": "update"})
+                        self._update_peer(peer, framed.recv_json(FRAME_CONTROL))
+                        last_update = time.monotonic()
+                    index = self._pick(peer)
+                    if index is None:
+                        time.sleep(SWARM_UPDATE_INTERVAL / 4)
+                        continue
+                    try:
+                        framed.send_json(FRAME_CONTROL, {"type": "request", "piece": index})
+                        frame_type, _, payload = framed.recv_frame()
+                        if frame_type != FRAME_PIECE or PIECE_HEADER.unpack_from(payload)[0] != index:
+                            raise ProtocolError("Peer answered with the wrong piece")
+                        if not self.store.write_piece(index, payload[PIECE_HEADER.size:]):
+                            raise ProtocolError(f"Piece {index} from {host}:{port} failed verification")
+                    finally:
+                        with self._lock:
+                            self._in_flight.discard(index)
+                            if not self.store.has(index):
+                                self._file(index)  # Ask another peer for it
+                    self.progress.add(self.store.descriptor.piece_length(index))
+                    if self.store.complete:
+                        self.completed.set()
+        except (OSError, ValueError, ProtocolError):
+            pass  # Try again with the tracker on the next round; other peers come back if it still lists them
+        finally:
+            with self._lock:
+                self._fetching.discard(peer)
+                self._set_peer_have(peer, None)
+                if peer != self.tracker:
+                    self._peers.pop(peer, None)
+
+    def _update_peer(self, peer, status):
+        have = bytes.fromhex(status["have"])
+        if len(have) != len(self.store.have):
+            raise ProtocolError("Peer sent a piece bitmap of the wrong size")
+        with self._lock:
+            self._set_peer_have(peer, have)
+            listed = {(member["host"], member["port"]): member["fingerprint"] for member in status["peers"]}
+            if peer == self.tracker:
+                # Forget the members that left the swarm; those we fetch from go when their connection closes
+                for address in [address for address in self._peers if address not in listed]:
+                    if address != self.tracker and address not in self._fetching:
+                        del self._peers[address]
+            for address, fingerprint in listed.items():
+                if address not in self._peers:
+                    self._peers[address] = fingerprint
+
+    def _set_peer_have(self, peer, have):
+        """Replace a peer's bitmap, updating the counts and buckets of only the pieces that changed"""
+        old = self._peer_have.get(peer)
+        bits = 8 * len(self.store.have)
+        changed = int.from_bytes(old or b"", "big") ^ int.from_bytes(have or b"", "big")
+        current = self._peer_have[peer] = bytearray(old or bytes(len(self.store.have)))
+        while changed:
+            bit = changed.bit_length() - 1
+            changed ^= 1 << bit
+            index = bits - 1 - bit
+            if index >= len(self._counts):
+                continue  # Padding at the end of the bitmap
+            needed = index not in self._in_flight and not self.store.has(index)
+            if needed:
+                self._unfile(index)
+            current[index >> 3] ^= 0x80 >> (index & 7)
+            self._counts[index] += 1 if current[index >> 3] & (0x80 >> (index & 7)) else -1
+            if needed:
+                self._file(index)
+        if have is None:
+            del self._peer_have[peer]
+            self._wanted.pop(peer, None)
+
+    def _holders(self, index):
+        bit = 0x80 >> (index & 7)
+        return [peer for peer, have in self._peer_have.items() if have[index >> 3] & bit]
+
+    def _file(self, index):
+        """Put a piece we need in the bucket of its count for every peer that has it"""
+        count = self._counts[index]
+        for peer in self._holders(index):
+            self._wanted.setdefault(peer, {}).setdefault(count, _PieceBucket()).add(index)
+
+    def _unfile(self, index):
+        count = self._counts[index]
+        for peer in self._holders(index):
+            buckets = self._wanted.get(peer, {})
+            bucket = buckets.get(count)
+            if bucket is not None:
+                bucket.discard(index)
+                if not bucket:
+                    del buckets[count]
+
+    def _pick(self, peer):
+        """Rarest piece that peer has and we neither have nor are already fetching"""
+        with self._lock:
+            buckets = self._wanted.get(peer)
+            if not buckets:
+                return None
+            index = random.choice(buckets[min(buckets)].items)
+            self._unfile(index)
+            self._in_flight.add(index)
+            return index
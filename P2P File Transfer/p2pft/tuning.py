@@ -0,0 +1,152 @@
+"""Read sizes and socket buffers fitted to the measured path: round-trip time and throughput"""
+import socket
+import struct
+import sys
+import time
+
+from .protocol import MAX_FRAME_SIZE
+
+TUNE_INTERVAL = 0.5  # Seconds of transfer between tuning decisions
+MIN_READ_SIZE = 64 * 1024
+FRAME_SECONDS = 0.002  # A data frame carries at least this long of traffic, keeping per-frame costs small
+MAX_SOCKET_BUFFER = 64 * 1024 * 1024
+BUFFER_HEADROOM = 1.25  # A socket buffer is only grown when the target is this much above its size
+TCP_INFO_RTT = struct.Struct("=II")  # tcpi_rtt, tcpi_rttvar in microseconds
+TCP_INFO_RTT_OFFSET = 68  # In Linux's struct tcp_info
+TCP_INFO_SIZE = 104
+KERNEL_BUFFER_LIMITS = {  # Linux caps buffers set by applications at these, and doubles what it grants
+    socket.SO_SNDBUF: "/proc/sys/net/core/wmem_max",
+    socket.SO_RCVBUF: "/proc/sys/net/core/rmem_max",
+}
+
+def tcp_rtt(sock):
+    """The kernel's smoothed round-trip time of a connected TCP socket in seconds, or None where unavailable"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+    except (OSError, AttributeError):
+        return None
+    if len(info) < TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size:
+        return None
+    rtt, _ = TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)
+    return rtt / 1e6 if rtt else None
+
+def kernel_buffer_limit(option):
+    """Largest buffer an application may set for option, or None if the kernel does not say"""
+    try:
+        with open(KERNEL_BUFFER_LIMITS[option]) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def power_of_two(size, low, high):
+    """size rounded down to a power of two, within [low, high]"""
+    return max(low, min(high, 1 << max(int(size), 1).bit_length() - 1))
+
+class PathTuner:
+    """Fits one connection's read size and socket buffer to its bandwidth-delay product.
+
+    The RTT comes from the kernel (TCP_INFO on Linux) or, elsewhere, from
+    the time the receiver took to connect; the lowest seen is used, as a
+    loaded connection's RTT includes its own queueing. Throughput is
+    measured every interval, and the BDP is the best throughput times
+    that RTT. A connection held back by its window sends about one window
+    per RTT, so aiming the buffer at twice the BDP doubles it each
+    interval until the path itself is the limit.
+
+    The socket buffer (SO_SNDBUF on the sending side, SO_RCVBUF on the
+    receiving one) is only ever grown, and only when the kernel would
+    grant more than it already has: setting a buffer turns off the
+    kernel's own autotuning, which on Linux often goes further than the
+    administrator's cap on set buffers. Data frames carry an eighth of the
+    BDP, or FRAME_SECONDS of traffic if that is more, and on the sending
+    side TCP_NOTSENT_LOWAT keeps about two frames waiting in the kernel,
+    so a large buffer holds data in flight rather than a queue that
+    pausing and priorities cannot reach. With read_size None the frame
+    size is left alone.
+
+    Every change is recorded in metrics.tuning with the measurements
+    behind it.
+    """
+
+    def __init__(self, sock, read_size=None, metrics=None, rtt=None, buffer_option=socket.SO_SNDBUF,
+                 interval=TUNE_INTERVAL):
+        self.sock = sock
+        self.read_size = read_size
+        self.metrics = metrics
+        self.buffer_option = buffer_option
+        self.interval = interval
+        self.min_rtt = tcp_rtt(sock) or rtt
+        self.max_throughput = 0.0
+        self.started = time.monotonic()
+        self._last_time = self.started
+        self._last_bytes = 0
+        self._next = self.started + interval
+        self._limit = kernel_buffer_limit(buffer_option)
+        self._lowat = getattr(socket, "TCP_NOTSENT_LOWAT", None) if buffer_option == socket.SO_SNDBUF else None
+        self.notsent_lowat = None
+        initial = {"read_size": read_size} if read_size else {}
+        initial.update(self._set_lowat())
+        self._record(initial)
+
+    def sample(self, bytes_done):
+        """Note bytes_done so far; returns True when this call changed a setting"""
+        now = time.monotonic()
+        if now < self._next:
+            return False
+        throughput = (bytes_done - self._last_bytes) / (now - self._last_time)
+        self._last_time, self._last_bytes = now, bytes_done
+        self._next = now + self.interval
+        self.max_throughput = max(self.max_throughput, throughput)
+        rtt = tcp_rtt(self.sock)
+        if rtt and (self.min_rtt is None or rtt < self.min_rtt):
+            self.min_rtt = rtt
+        if self.min_rtt is None or not self.max_throughput:
+            return False
+        bdp = self.max_throughput * self.min_rtt
+
+        changes = {}
+        if self.read_size is not None:
+            wanted = max(bdp / 8, self.max_throughput * FRAME_SECONDS)
+            read_size = power_of_two(wanted, MIN_READ_SIZE, MAX_FRAME_SIZE)
+            if read_size != self.read_size:
+                self.read_size = changes["read_size"] = read_size
+                changes.update(self._set_lowat())
+        changes.update(self._grow_buffer(2 * bdp))
+        if changes:
+            self._record(dict(changes, throughput=round(throughput), bdp=round(bdp)))
+        return bool(changes)
+
+    def _grow_buffer(self, target):
+        target = int(min(target, MAX_SOCKET_BUFFER))
+        try:
+            current = self.sock.getsockopt(socket.SOL_SOCKET, self.buffer_option)
+            granted = 2 * min(target, self._limit) if self._limit else target
+            if granted <= current * BUFFER_HEADROOM:
+                return {}  # Big enough already, possibly thanks to kernel autotuning
+            self.sock.setsockopt(socket.SOL_SOCKET, self.buffer_option, target)
+            size = self.sock.getsockopt(socket.SOL_SOCKET, self.buffer_option)
+        except OSError:
+            return {}
+        name = "send_buffer" if self.buffer_option == socket.SO_SNDBUF else "receive_buffer"
+        return {name: size, name + "_requested": target}
+
+    def _set_lowat(self):
+        if self._lowat is None or self.read_size is None:
+            return {}
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, self._lowat, 2 * self.read_size)
+        except OSError:
+            self._lowat = None  # Not supported on this socket; stop trying
+            return {}
+        self.notsent_lowat = 2 * self.read_size
+        return {"notsent_lowat": self.notsent_lowat}
+
+    def _record(self, decision):
+        if self.metrics is None:
+            return
+        entry = {"at": round(time.monotonic() - self.started, 3),
+                 "rtt_ms": round(self.min_rtt * 1000, 3) if self.min_rtt else None}
+        entry.update(decision)
+        self.metrics.tuning.append(entry)
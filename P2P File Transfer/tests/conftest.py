@@ -0,0 +1,74 @@
+"""Shared fixtures: a throwaway identity and one-shot loopback sessions"""
+import socket
+import threading
+import time
+
+import pytest
+
+from p2pft.engine import ConnectionPool, Receiver, Sender, TransferProgress
+from p2pft.identity import generate_certificates, get_cert_fingerprint
+from p2pft.protocol import FramedSocket
+
+@pytest.fixture(scope="session")
+def identity(tmp_path_factory):
+    """Certificate path, key path and fingerprint of an identity made for the test run"""
+    root = tmp_path_factory.mktemp("identity")
+    cert_path, key_path = str(root / "cert.pem"), str(root / "key.pem")
+    generate_certificates(cert_path, key_path)
+    return cert_path, key_path, get_cert_fingerprint(cert_path)
+
+class Clock:
+    """Stand-in for time.monotonic that only moves when a test sets now"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+@pytest.fixture
+def framed_pair():
+    """Two FramedSockets joined by a socket pair"""
+    left, right = socket.socketpair()
+    with left, right:
+        yield FramedSocket(left), FramedSocket(right)
+
+@pytest.fixture
+def free_port():
+    """Returns a function giving a localhost port nothing is listening on"""
+    def pick():
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            return probe.getsockname()[1]
+    return pick
+
+@pytest.fixture
+def loopback(identity):
+    """Send paths to dest over one localhost session; returns the sender's and receiver's TransferResults"""
+    cert_path, key_path, fingerprint = identity
+
+    def run(paths, dest, receiver_options=None, **sender_options):
+        sender = Sender(paths, port=0, cert_path=cert_path, key_path=key_path, **sender_options)
+        listener = sender.listen()
+        sent = []
+
+        def serve():
+            with listener:
+                conn, _ = listener.accept()
+            sent.append(sender.serve_connection(conn, TransferProgress()))
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        receiver = Receiver("127.0.0.1", listener.getsockname()[1], fingerprint, str(dest),
+                            pool=ConnectionPool(), **(receiver_options or {}))
+        received = receiver.receive()
+        thread.join(30)
+        return sent[0] if sent else None, received
+
+    return run
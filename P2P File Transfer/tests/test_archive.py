@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+from p2pft import batch
+from p2pft.batch import ArchiveWriter, archive_size, build_manifest, read_archive
+from p2pft.merkle import MerkleHasher
+from p2pft.protocol import ARCHIVE_DIR, ARCHIVE_FILE, ARCHIVE_RECORD, ProtocolError
+
+MTIME = 1000000000.0
+
+@pytest.fixture
+def many_files(tmp_path):
+    """A folder of small files with one large file, an empty file and an empty folder"""
+    tree = tmp_path / "src" / "many"
+    (tree / "empty").mkdir(parents=True)
+    for n in range(300):
+        folder = tree / f"d{n % 7}"
+        folder.mkdir(exist_ok=True)
+        (folder / f"{n}.txt").write_bytes(b"%d\n" % n * (n % 13))
+    (tree / "large.bin").write_bytes(os.urandom(batch.ARCHIVE_SMALL_FILE_SIZE + 17))
+    for folder, _, files in os.walk(tree):
+        for name in files:
+            os.utime(os.path.join(folder, name), (MTIME, MTIME))
+    return tree
+
+def files_of(root):
+    found = {}
+    for folder, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(folder, name)
+            if os.path.isdir(path):
+                found[os.path.relpath(path, root)] = None
+            else:
+                with open(path, "rb") as f:
+                    found[os.path.relpath(path, root)] = f.read()
+    return found
+
+def pack(manifest, frame_size=64 * 1024):
+    buf = memoryview(bytearray(frame_size))  # As FramedSocket.data_buffer() gives it
+    data = bytearray()
+    for _, length in read_archive(manifest, buf, MerkleHasher()):
+        data += buf[:length]
+    return bytes(data)
+
+def record(kind, path, size=0, contents=b""):
+    return ARCHIVE_RECORD.pack(kind, len(path.encode()), size, MTIME) + path.encode() + contents
+
+def test_archive_unpacks_into_the_same_tree(tmp_path, many_files):
+    manifest = build_manifest([str(many_files)])
+    entries = [entry for _, entry in manifest]
+    stream = pack(manifest)
+    assert len(stream) == archive_size(entries)
+
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    writer = ArchiveWriter(str(dest), len(entries), sum(entry["size"] for entry in entries), queue_depth=2)
+    for start in range(0, len(stream), 4093):  # Records and files straddle every write
+        writer.write(stream[start:start + 4093])
+    writer.close()
+    assert writer.complete()
+    assert writer.entries == entries
+    assert not os.path.exists(dest / "many" / "d0" / "0.txt")  # Only as a .part until commit
+
+    writer.commit()
+    assert files_of(dest / "many") == files_of(many_files)
+    assert os.stat(dest / "many" / "d3" / "3.txt").st_mtime == MTIME
+
+def test_truncated_archive_is_incomplete_and_discarded(tmp_path, many_files):
+    manifest = build_manifest([str(many_files)])
+    stream = pack(manifest)
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    (dest / "many" / "d1").mkdir(parents=True)
+    (dest / "many" / "d1" / "1.txt").write_bytes(b"old")
+
+    writer = ArchiveWriter(str(dest), len(manifest), 0)
+    writer.write(stream[:len(stream) // 2])
+    writer.close()
+    assert not writer.complete()
+    writer.discard()
+    assert (dest / "many" / "d1" / "1.txt").read_bytes() == b"old"
+    assert not [name for _, _, files in os.walk(dest) for name in files if name.endswith(".part")]
+
+@pytest.mark.parametrize("stream", [
+    record(ARCHIVE_FILE, "../escape", 1, b"x"),
+    record(ARCHIVE_DIR, "a") + record(ARCHIVE_DIR, "b"),
+    record(7, "odd"),
+])
+def test_bad_records_fail_the_writer(tmp_path, stream):
+    writer = ArchiveWriter(str(tmp_path), 1, 1)
+    writer.write(stream)
+    with pytest.raises(ProtocolError):
+        writer.close()
+    writer.discard()
+    assert not os.path.exists(tmp_path.parent / "escape")
+
+def test_loopback_archive_of_many_files(tmp_path, loopback, many_files):
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    sent, received = loopback([str(many_files)], dest, archive=True)
+
+    assert sent.ok and received.ok
+    assert files_of(dest / "many") == files_of(many_files)
+    assert os.stat(dest / "many" / "large.bin").st_mtime == MTIME
+
+def test_loopback_archive_replaces_existing_files(tmp_path, loopback, many_files):
+    dest = tmp_path / "dest"
+    (dest / "many").mkdir(parents=True)
+    (dest / "many" / "large.bin").write_bytes(b"old")
+
+    _, received = loopback([str(many_files)], dest, archive=True, compress=True)
+
+    assert received.ok
+    assert (dest / "many" / "large.bin").read_bytes() == (many_files / "large.bin").read_bytes()
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from p2pft.batch import BatchWriter
+from p2pft.protocol import ProtocolError
+
+ENTRIES = [
+    {"path": "folder/a.bin", "size": 10, "mtime": 1000000000.0},
+    {"path": "folder/empty", "size": 0, "dir": True},
+    {"path": "folder/zero", "size": 0, "mtime": 1000000000.0},
+    {"path": "b.bin", "size": 5, "mtime": 1000000000.0},
+]
+STREAM = b"0123456789abcde"
+
+def test_stream_is_split_into_files_that_appear_on_commit(tmp_path):
+    (tmp_path / "b.bin").write_bytes(b"old")
+    writer = BatchWriter(str(tmp_path), ENTRIES, queue_depth=1)
+    for start in range(0, len(STREAM), 4):
+        writer.write(memoryview(STREAM)[start:start + 4])
+    writer.close()
+    assert writer.complete()
+    assert not (tmp_path / "folder" / "a.bin").exists()
+    assert (tmp_path / "b.bin").read_bytes() == b"old"  # Untouched until commit
+
+    writer.commit()
+    assert (tmp_path / "folder" / "a.bin").read_bytes() == STREAM[:10]
+    assert (tmp_path / "folder" / "zero").read_bytes() == b""
+    assert (tmp_path / "folder" / "empty").is_dir()
+    assert (tmp_path / "b.bin").read_bytes() == STREAM[10:]
+    assert os.stat(tmp_path / "b.bin").st_mtime == 1000000000.0
+    assert not [name for _, _, files in os.walk(tmp_path) for name in files if name.endswith(".part")]
+
+def test_discard_keeps_existing_copies(tmp_path):
+    (tmp_path / "b.bin").write_bytes(b"old")
+    writer = BatchWriter(str(tmp_path), ENTRIES)
+    writer.write(STREAM[:12])
+    assert not writer.complete()
+    writer.discard()
+    assert (tmp_path / "b.bin").read_bytes() == b"old"
+    assert sorted(os.listdir(tmp_path / "folder")) == ["empty"]
+
+def test_more_data_than_announced_is_refused(tmp_path):
+    writer = BatchWriter(str(tmp_path), ENTRIES)
+    with pytest.raises(ProtocolError):
+        writer.write(STREAM + b"!")
+    writer.discard()
+
+def test_rewrite_repairs_a_range_across_files(tmp_path):
+    writer = BatchWriter(str(tmp_path), ENTRIES)
+    writer.write(bytes(len(STREAM)))
+    writer.close()
+    writer.rewrite(8, STREAM[8:13])
+    writer.commit()
+    assert (tmp_path / "folder" / "a.bin").read_bytes() == bytes(8) + STREAM[8:10]
+    assert (tmp_path / "b.bin").read_bytes() == STREAM[10:13] + bytes(2)
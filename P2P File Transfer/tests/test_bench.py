@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from p2pft.bench import (
+    AUTO_BUFFER, build_cases, compare_results, identity_paths, make_workload, parse_buffer_size, parse_size,
+    parse_workload, run_case,
+)
+from p2pft.identity import generate_certificates
+
+def test_sizes_and_workloads_parse():
+    assert [parse_size(text) for text in ("512", "4K", "1.5M", "10gb")] == [512, 4096, 3 * 512 * 1024, 10 * 1024 ** 3]
+    assert parse_buffer_size(" Auto ") == AUTO_BUFFER and parse_buffer_size("64K") == 65536
+    assert parse_workload("100M") == (1, 100 * 1024 ** 2)
+    assert parse_workload("1000x4K") == (1000, 4096)
+
+def test_small_file_workloads_are_distinct_and_reused(tmp_path):
+    path = make_workload(str(tmp_path), "1200x1K", "text")
+    files = sorted(os.path.join(folder, name) for folder, _, names in os.walk(path) for name in names)
+    assert len(files) == 1200 and sorted(os.listdir(path)) == ["0000", "0001"]
+    contents = set()
+    for name in files:
+        with open(name, "rb") as f:
+            contents.add(f.read())
+    assert len(contents) == 1200 and {len(data) for data in contents} == {1024}
+    assert make_workload(str(tmp_path), "1200x1K", "text") == path
+    assert os.path.getsize(make_workload(str(tmp_path), "3K", "random")) == 3072
+
+def test_cases_sweep_every_combination():
+    cases = build_cases(["1K", "1M"], "text", [AUTO_BUFFER, 65536], [0], [False, True], [1], ["ecdsa"], repeat=2)
+    assert len(cases) == 2 * 2 * 2 * 2
+    assert {case["run"] for case in cases} == {0, 1}
+
+def test_comparison_uses_the_best_completed_run():
+    def result(speed, run=0, status="Completed", workload="1M"):
+        return dict(build_cases([workload], "text", [AUTO_BUFFER], [0], [False], [1], ["ecdsa"])[0],
+                    run=run, status=status, mb_per_s=speed)
+    baseline = {"results": [result(80), result(100, run=1), result(500, status="Failed")]}
+    [(case, speed, previous)] = compare_results([result(90), result(120, run=1), result(5, workload="1K")], baseline)
+    assert (case["workload"], speed, previous) == ("1M", 120, 100)
+
+@pytest.mark.parametrize("workload, streams, buffer_size", [("64K", 1, AUTO_BUFFER), ("50x1K", 2, 65536)])
+def test_case_runs_over_loopback(tmp_path, monkeypatch, workload, streams, buffer_size):
+    monkeypatch.chdir(tmp_path)  # run_case moves into its scratch directory and back to workdir
+    workdir = str(tmp_path)
+    os.mkdir(os.path.join(workdir, "data"))  # Prepared as run_benchmarks() does
+    make_workload(os.path.join(workdir, "data"), workload, "text")
+    generate_certificates(*identity_paths(workdir, "ecdsa"))
+    [case] = build_cases([workload], "text", [buffer_size], [0], [False], [streams], ["ecdsa"])
+
+    result = run_case(dict(case, workdir=workdir))
+
+    count, size = parse_workload(workload)
+    assert result["status"] == "Completed"
+    assert result["bytes"] == streams * count * size
+    assert result["mb_per_s"] > 0 and result["handshake_ms"] > 0
+    assert "workdir" not in result
+    assert sorted(os.listdir(workdir)) == ["data", "ecdsa_cert.pem", "ecdsa_key.pem"]
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from p2pft.cli import chosen_command, main
+from p2pft.engine import parse_connection_code
+from p2pft.settings import SETTINGS_DB, SETTINGS_KEY_FILE, SecureSettings
+
+def run(argv):
+    with pytest.raises(SystemExit) as exit_info:
+        main(argv)
+    return exit_info.value.code
+
+def test_connection_codes():
+    assert parse_connection_code(" 192.168.1.5:8443:abcdef12 ") == ("192.168.1.5", 8443, "abcdef12")
+    with pytest.raises(ValueError):
+        parse_connection_code("192.168.1.5:abcdef12")
+
+@pytest.mark.parametrize("argv", [["--help"], ["bench", "--help"], ["discover", "--help"], ["identity"]])
+def test_commands_without_defaults_leave_no_settings(tmp_path, monkeypatch, capsys, argv):
+    monkeypatch.chdir(tmp_path)
+    assert run(argv) == 0
+    assert not {SETTINGS_KEY_FILE, SETTINGS_DB} & set(os.listdir(tmp_path))
+
+def test_send_defaults_follow_the_saved_settings(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    settings = SecureSettings()
+    settings.save_settings({"compression": True})
+    settings.close()
+    assert run(["send", "--help"]) == 0
+    assert "Compress data frames (default: True)" in " ".join(capsys.readouterr().out.split())
+
+def test_settings_follow_the_command_argparse_picks(capsys):
+    assert chosen_command(["send", "-p", "9000", "file.bin"]) == "send"
+    assert chosen_command(["discover", "--wait", "2"]) == "discover"
+    assert chosen_command(["recv", "--help"]) == "recv"  # Found before the command's help exits
+    with pytest.raises(SystemExit):
+        chosen_command(["--help"])
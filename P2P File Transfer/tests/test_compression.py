@@ -0,0 +1,39 @@
+import os
+import zlib
+
+import pytest
+
+from p2pft.compression import AdaptiveCompressor, available_codecs, byte_entropy, decompress_frame
+from p2pft.protocol import FLAG_ZLIB, ProtocolError
+
+TEXT = b"".join(b"line %d of a very compressible log file\n" % n for n in range(8000))
+
+def test_entropy_separates_text_from_random():
+    assert byte_entropy(TEXT) < 5
+    assert byte_entropy(os.urandom(64 * 1024)) > 7.5
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_compressed_frames_round_trip(codec):
+    compressor = AdaptiveCompressor(codec)
+    payload, flags = compressor.compress(TEXT[:256 * 1024])
+    assert flags and len(payload) < len(TEXT[:256 * 1024]) // 4
+    assert decompress_frame(flags, payload) == TEXT[:256 * 1024]
+
+def test_incompressible_frames_go_out_raw():
+    data = os.urandom(256 * 1024)
+    assert AdaptiveCompressor("zlib").compress(data) == (data, 0)
+
+def test_decompression_is_bounded_by_the_frame_size():
+    bomb = zlib.compress(bytes(4 * 1024 * 1024))
+    with pytest.raises(ProtocolError):
+        decompress_frame(FLAG_ZLIB, bomb)
+
+def test_compressed_session(tmp_path, loopback):
+    source = tmp_path / "log.txt"
+    source.write_bytes(TEXT * 4)
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    sent, received = loopback([str(source)], dest, compress=True)
+    assert received.ok
+    assert (dest / "log.txt").read_bytes() == source.read_bytes()
+    assert sent.metrics.counters["wire_bytes"] < source.stat().st_size // 4
@@ -0,0 +1,167 @@
+import functools
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from p2pft import dedup, engine
+from p2pft.dedup import CDC_AVG_BITS, CDC_MAX_SIZE, CDC_MIN_SIZE, ChunkStore, file_recipe
+from p2pft.engine import Receiver, TransferProgress
+from p2pft.metrics import TransferMetrics
+from p2pft.protocol import FRAME_CHUNK, FRAME_CONTROL, FRAME_RECIPE, RECIPE_RECORD, ProtocolError
+
+def records(recipe):
+    return list(RECIPE_RECORD.iter_unpack(recipe))
+
+def missing(bitmap, count):
+    return [n for n in range(count) if bitmap[n >> 3] & (0x80 >> (n & 7))]
+
+@pytest.fixture
+def data():
+    return random.Random(30).randbytes(3 * 1024 * 1024)
+
+@pytest.fixture
+def chunk_root(tmp_path, monkeypatch):
+    """Keep the receiver's chunk store inside the test's directory"""
+    root = str(tmp_path / "chunks")
+    monkeypatch.setattr(engine, "ChunkStore", functools.partial(ChunkStore, root))
+    return root
+
+def test_chunks_cover_the_file_within_size_bounds(tmp_path, data):
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+    chunks = records(file_recipe(path))
+    assert sum(length for _, length in chunks) == len(data)
+    assert all(CDC_MIN_SIZE <= length <= CDC_MAX_SIZE for _, length in chunks[:-1])
+
+def test_boundaries_resynchronize_after_an_insert(tmp_path, data):
+    (tmp_path / "old.bin").write_bytes(data)
+    (tmp_path / "new.bin").write_bytes(data[:100000] + b"inserted" + data[100000:])
+    old = {digest for digest, _ in records(file_recipe(tmp_path / "old.bin"))}
+    new = records(file_recipe(tmp_path / "new.bin"))
+    assert sum(digest not in old for digest, _ in new) <= 2
+
+def test_text_is_cut_near_the_average_size(tmp_path):
+    # A small alphabet still finds cut points, rather than falling back to the maximum size
+    path = tmp_path / "log.txt"
+    path.write_bytes(b"".join(b"%d,%d,%.3f,line %x\n" % (n, n % 97, n / 7, n * 7919) for n in range(200000)))
+    chunks = records(file_recipe(path))
+    assert sum(length == CDC_MAX_SIZE for _, length in chunks) < len(chunks) // 10
+    assert sum(length for _, length in chunks) // len(chunks) < 2 << CDC_AVG_BITS
+
+def test_store_reports_what_it_holds(tmp_path, data):
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+    recipe = file_recipe(path)
+    count = len(records(recipe))
+    store = ChunkStore(str(tmp_path / "chunks"))
+    try:
+        assert missing(store.wanted(recipe), count) == list(range(count))
+        store.ingest(path, recipe)
+        assert missing(store.wanted(recipe), count) == []
+        digest, length = records(recipe)[1]
+        assert store.read(digest, length) == data[records(recipe)[0][1]:][:length]
+    finally:
+        store.close()
+
+def test_damaged_chunks_are_dropped(tmp_path, data):
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+    recipe = file_recipe(path)
+    digest, length = records(recipe)[0]
+    store = ChunkStore(str(tmp_path / "chunks"))
+    try:
+        store.ingest(path, recipe)
+        with open(store._path(digest), "r+b") as f:
+            f.write(b"X")
+        with pytest.raises(ProtocolError):
+            store.read(digest, length)
+        assert missing(store.wanted(recipe), len(records(recipe))) == [0]
+    finally:
+        store.close()
+
+def test_eviction_spares_chunks_pinned_by_another_transfer(tmp_path, data):
+    root = str(tmp_path / "chunks")
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+    recipe = file_recipe(path)
+    seed = ChunkStore(root)
+    seed.ingest(path, recipe)
+    seed.close()
+
+    reader, other = ChunkStore(root, max_size=0), ChunkStore(root, max_size=0)
+    assert not any(reader.wanted(recipe))
+    other.evict()
+    other.close()
+    for digest, length in records(recipe):
+        reader.read(digest, length)
+    reader.close()
+
+    # With the pins released, eviction brings the store down to max_size
+    cleanup = ChunkStore(root, max_size=0)
+    cleanup.evict()
+    assert any(cleanup.wanted(recipe))
+    cleanup.close()
+
+def test_dedup_session_reuses_stored_chunks(tmp_path, data, chunk_root, loopback):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "first.bin").write_bytes(data)
+    (source / "second.bin").write_bytes(data[:2000000] + os.urandom(5000) + data[2000000:])
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    assert loopback([str(source / "first.bin")], dest, dedup=True)[1].ok
+    _, received = loopback([str(source / "second.bin")], dest, dedup=True)
+
+    assert received.ok
+    assert (dest / "second.bin").read_bytes() == (source / "second.bin").read_bytes()
+    assert received.metrics.counters["deduplicated_bytes"] > len(data) * 9 // 10
+
+def test_chunk_frame_without_recipes_is_a_protocol_error(tmp_path, framed_pair):
+    sender, receiving = framed_pair
+
+    def misbehave():
+        sender.recv_json(FRAME_CONTROL)  # hello
+        sender.send_json(FRAME_CONTROL, {"type": "session", "delta": False, "dedup": False})
+        sender.send_manifest([{"path": "file.bin", "size": 100, "mtime": 0.0}])
+        sender.send_frame(FRAME_CHUNK, RECIPE_RECORD.pack(bytes(32), 100))
+
+    thread = threading.Thread(target=misbehave)
+    thread.start()
+    receiver = Receiver("127.0.0.1", 0, "", str(tmp_path), autotune=False)
+    with pytest.raises(ProtocolError, match="without chunk recipes"):
+        receiver._receive_batch(receiving, TransferProgress(), TransferMetrics())
+    thread.join()
+    assert os.listdir(tmp_path) == []  # The partial file was discarded
+
+def test_slow_chunking_does_not_time_out_the_receiver(tmp_path, data, chunk_root, loopback, monkeypatch):
+    # Chunking takes several times the socket timeout, but each recipe piece goes out as it is chunked
+    monkeypatch.setattr(engine, "TRANSFER_TIMEOUT", 0.5)
+    monkeypatch.setattr(dedup, "CDC_READ_SIZE", 512 * 1024)
+
+    def slow_pieces(path):
+        for piece in dedup.recipe_pieces(path):
+            time.sleep(0.2)
+            yield piece
+    monkeypatch.setattr(engine, "recipe_pieces", slow_pieces)
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "file.bin").write_bytes(data)
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    sent, received = loopback([str(source / "file.bin")], dest, dedup=True)
+
+    assert received.ok and sent.ok
+    assert (dest / "file.bin").read_bytes() == data
+
+def test_partial_recipe_record_is_a_protocol_error(framed_pair):
+    sender, receiving = framed_pair
+    sender.send_json(FRAME_CONTROL, {"type": "recipe", "index": 0})
+    sender.send_frame(FRAME_RECIPE, RECIPE_RECORD.pack(bytes(32), 100)[:-1])
+    sender.send_json(FRAME_CONTROL, {"type": "recipes_done"})
+    with pytest.raises(ProtocolError, match="partial record"):
+        receiving.recv_recipes()
@@ -0,0 +1,110 @@
+import hashlib
+import io
+import os
+import random
+import time
+
+import pytest
+
+from p2pft import delta, engine
+from p2pft.delta import DELTA_MIN_BLOCK_SIZE, DeltaEncoder, delta_block_size, file_signature
+
+def apply_delta(basis, operations):
+    out = bytearray()
+    for kind, value in operations:
+        if kind == "copy":
+            offset, length = value
+            out += basis[offset:offset + length]
+        else:
+            out += value
+    return bytes(out)
+
+def encode(basis_path, new, block_size=DELTA_MIN_BLOCK_SIZE):
+    encoder = DeltaEncoder(block_size, file_signature(basis_path, block_size))
+    f = io.BytesIO(new)
+    f.name = "new"
+    hasher = hashlib.sha256()
+    operations = list(encoder.encode(f, len(new), hasher))
+    assert hasher.digest() == hashlib.sha256(new).digest()
+    return operations
+
+def literal_bytes(operations):
+    return sum(len(value) for kind, value in operations if kind == "data")
+
+@pytest.fixture
+def basis(tmp_path):
+    data = random.Random(29).randbytes(1024 * 1024 + 123)
+    path = tmp_path / "basis.bin"
+    path.write_bytes(data)
+    return str(path), data
+
+def test_block_size_grows_with_the_file():
+    assert delta_block_size(0) == DELTA_MIN_BLOCK_SIZE
+    assert delta_block_size(1 << 30) >= 32 * 1024
+    assert delta_block_size(1 << 30) ** 2 >= 1 << 30
+
+@pytest.mark.parametrize("edit", ["unchanged", "insert", "delete", "overwrite", "append", "truncate"])
+def test_edits_reconstruct_and_reuse_the_basis(basis, edit):
+    path, data = basis
+    middle = len(data) // 2
+    new = {
+        "unchanged": data,
+        "insert": data[:middle] + b"inserted bytes" + data[middle:],
+        "delete": data[:middle] + data[middle + 777:],
+        "overwrite": data[:middle] + bytes(5000) + data[middle + 5000:],
+        "append": data + b"tail" * 1000,
+        "truncate": data[:middle],
+    }[edit]
+    operations = encode(path, new)
+    assert apply_delta(data, operations) == new
+    # Only the edited neighbourhood, a couple of blocks and the partial last block, goes out as literals
+    assert literal_bytes(operations) <= 4 * DELTA_MIN_BLOCK_SIZE + 5000 + 4000
+
+def test_unrelated_data_is_sent_literally(basis):
+    path, _ = basis
+    new = os.urandom(512 * 1024)
+    operations = encode(path, new)
+    assert apply_delta(b"", operations) == new
+    assert literal_bytes(operations) == len(new)
+
+def test_delta_session_copies_from_the_old_copy(tmp_path, basis, loopback):
+    path, data = basis
+    source = tmp_path / "src"
+    source.mkdir()
+    new = data[:1000] + b"changed" + data[1000:]
+    (source / "file.bin").write_bytes(new)
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    (dest / "file.bin").write_bytes(data)
+
+    sent, received = loopback([str(source / "file.bin")], dest, delta=True)
+
+    assert received.ok
+    assert (dest / "file.bin").read_bytes() == new
+    assert received.metrics.counters["copied_bytes"] > len(data) * 9 // 10
+    assert sent.metrics.counters["wire_bytes"] < len(data) // 10
+
+def test_slow_signatures_do_not_time_out_the_sender(tmp_path, basis, loopback, monkeypatch):
+    # Hashing the old copy takes several times the socket timeout, but each piece goes out as it is hashed
+    path, data = basis
+    monkeypatch.setattr(engine, "TRANSFER_TIMEOUT", 0.5)
+    monkeypatch.setattr(delta, "DELTA_READ_SIZE", 64 * 1024)
+
+    def slow_pieces(path, block_size):
+        for piece in delta.signature_pieces(path, block_size):
+            time.sleep(0.2)
+            yield piece
+    monkeypatch.setattr(engine, "signature_pieces", slow_pieces)
+    source = tmp_path / "src"
+    source.mkdir()
+    new = data[:1000] + b"changed" + data[1000:]
+    (source / "file.bin").write_bytes(new)
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    (dest / "file.bin").write_bytes(data)
+
+    sent, received = loopback([str(source / "file.bin")], dest, delta=True)
+
+    assert received.ok and sent.ok
+    assert (dest / "file.bin").read_bytes() == new
+    assert file_signature(path, 4096) == b"".join(delta.signature_pieces(path, 4096))
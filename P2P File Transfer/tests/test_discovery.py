@@ -0,0 +1,93 @@
+import json
+import time
+
+import pytest
+
+from p2pft.discovery import DISCOVERY_VERSION, MAX_ANNOUNCE_SIZE, Discovery
+
+FINGERPRINT = "ab" * 32
+
+def message(kind="announce", **fields):
+    return json.dumps(dict({"p2pft": DISCOVERY_VERSION, "type": kind, "id": "other", "fingerprint": FINGERPRINT,
+                            "port": 9000, "name": "laptop", "offers": ["photos"], "offer_count": 1}, **fields)).encode()
+
+def test_announcements_fill_the_table_until_they_expire(clock):
+    node = Discovery(ttl=15)
+    node._handle(message(), "10.0.0.2")
+    assert node.peers() == [{"host": "10.0.0.2", "port": 9000, "fingerprint": FINGERPRINT, "name": "laptop",
+                             "offers": ["photos"], "offer_count": 1}]
+    clock.now += 14
+    node._handle(message(offers=[]), "10.0.0.2")  # Heard again, with its offers changed
+    clock.now += 14
+    assert node.peers()[0]["offers"] == []
+    clock.now += 1
+    assert node.peers() == []
+
+def test_leaving_peers_are_dropped_at_once():
+    node = Discovery()
+    node._handle(message(), "10.0.0.2")
+    node._handle(message(port=9001), "10.0.0.2")
+    node._handle(message("bye", fingerprint=FINGERPRINT.upper()), "10.0.0.2")
+    assert [peer["port"] for peer in node.peers()] == [9001]
+
+@pytest.mark.parametrize("data", [
+    b"not json", b"[]", message(p2pft=DISCOVERY_VERSION + 1), message(fingerprint="abcd"), message(port=70000),
+    message(port="x"), message(id="self"), message("unknown"),
+])
+def test_foreign_and_own_datagrams_are_ignored(data):
+    node = Discovery()
+    node._id = "self"
+    node._handle(data, "10.0.0.2")
+    assert node.peers() == []
+
+def test_announce_needs_a_fingerprint():
+    with pytest.raises(ValueError):
+        Discovery().announce(9000)
+
+class SentDatagrams:
+    """Stands in for the multicast socket, keeping what is sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append(json.loads(data))
+
+def test_oversized_offer_lists_are_cut_to_one_datagram():
+    node = Discovery(FINGERPRINT, 9000, offers=[f"offer {n:04d}" for n in range(500)])
+    node._sock = SentDatagrams()
+    node._send("announce", 9000)
+    sent = node._sock.sent[0]
+    assert 0 < len(sent["offers"]) < 500 and sent["offer_count"] == 500
+    assert len(json.dumps(sent)) <= MAX_ANNOUNCE_SIZE
+
+def test_nodes_find_each_other_over_multicast(free_port):
+    discovery_port = free_port()
+    announcing = Discovery(FINGERPRINT, 9000, "alpha", ["photos"], discovery_port=discovery_port, interval=0.2)
+    listening = Discovery(discovery_port=discovery_port, interval=0.2)
+    try:
+        listening.start()
+        announcing.start()
+    except OSError as e:
+        announcing.close()
+        listening.close()
+        pytest.skip(f"No multicast here: {e}")
+    try:
+        assert wait_for(lambda: [peer["name"] for peer in listening.peers()] == ["alpha"])
+        announcing.announce(9001, ["music"])
+        assert wait_for(lambda: sorted(peer["port"] for peer in listening.peers()) == [9000, 9001])
+        announcing.withdraw(9000)
+        assert wait_for(lambda: [peer["offers"] for peer in listening.peers()] == [["music"]])
+        announcing.close()
+        assert wait_for(lambda: listening.peers() == [])
+    finally:
+        announcing.close()
+        listening.close()
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+
+from p2pft.cli import main
+from p2pft.identity import (
+    CERT_FILE, KEY_FILE, OLD_IDENTITY_SUFFIX, fingerprint_matches, generate_certificates,
+    get_cert_fingerprint, identity_backup_suffix, is_legacy_identity, rotate_identity,
+)
+
+def legacy_identity(directory):
+    """An RSA identity as earlier versions wrote it, with the key in the traditional format"""
+    cert_path, key_path = str(directory / CERT_FILE), str(directory / KEY_FILE)
+    generate_certificates(cert_path, key_path, key_type="rsa")
+    with open(key_path, "rb") as f:
+        key = serialization.load_pem_private_key(f.read(), None)
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+def test_existing_identity_is_kept(tmp_path):
+    cert_path, key_path = legacy_identity(tmp_path)
+    fingerprint = get_cert_fingerprint(cert_path)
+    generate_certificates(cert_path, key_path)
+    assert is_legacy_identity(key_path)
+    assert get_cert_fingerprint(cert_path) == fingerprint
+
+def test_rotation_replaces_a_legacy_identity(tmp_path):
+    cert_path, key_path = legacy_identity(tmp_path)
+    fingerprint = get_cert_fingerprint(cert_path)
+
+    old_fingerprint, new_fingerprint = rotate_identity(cert_path, key_path)
+
+    assert old_fingerprint == fingerprint != new_fingerprint == get_cert_fingerprint(cert_path)
+    assert not is_legacy_identity(key_path)
+    assert is_legacy_identity(key_path + OLD_IDENTITY_SUFFIX)
+    assert get_cert_fingerprint(cert_path + OLD_IDENTITY_SUFFIX) == fingerprint
+
+def test_each_rotation_keeps_its_own_backup(tmp_path):
+    cert_path, key_path = legacy_identity(tmp_path)
+    fingerprints = [get_cert_fingerprint(cert_path)]
+    for _ in range(3):
+        fingerprints.append(rotate_identity(cert_path, key_path)[1])
+
+    backups = [OLD_IDENTITY_SUFFIX, OLD_IDENTITY_SUFFIX + ".1", OLD_IDENTITY_SUFFIX + ".2"]
+    assert [get_cert_fingerprint(cert_path + suffix) for suffix in backups] == fingerprints[:3]
+    assert all(os.path.exists(key_path + suffix) for suffix in backups)
+    assert identity_backup_suffix(cert_path, key_path) == OLD_IDENTITY_SUFFIX + ".3"
+
+def test_new_identities_are_not_legacy(tmp_path):
+    for key_type in ("ecdsa", "ed25519", "rsa"):
+        key_path = str(tmp_path / f"{key_type}.pem")
+        generate_certificates(str(tmp_path / f"{key_type}.crt"), key_path, key_type=key_type)
+        assert not is_legacy_identity(key_path)
+
+def test_short_fingerprints_match_their_prefix():
+    fingerprint = "ab12cd34" + "0" * 56
+    assert fingerprint_matches(fingerprint, " AB12CD34 ")
+    assert not fingerprint_matches(fingerprint, "ab12cd")
+    assert not fingerprint_matches(fingerprint, "ab12cd35")
+
+def run(argv):
+    with pytest.raises(SystemExit) as exit_info:
+        main(argv)
+    return exit_info.value.code
+
+def test_identity_command_rotates(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    legacy_identity(tmp_path)
+    fingerprint = get_cert_fingerprint()
+    assert run(["identity"]) == 0
+    assert f"Fingerprint: {fingerprint}" in capsys.readouterr().out
+
+    assert run(["identity", "--rotate"]) == 0
+    out = capsys.readouterr().out
+    assert f"Old fingerprint: {fingerprint}" in out
+    assert f"Fingerprint: {get_cert_fingerprint()}" in out
+    assert os.path.exists(CERT_FILE + OLD_IDENTITY_SUFFIX)
+
+    assert run(["identity", "--rotate"]) == 0
+    assert f"(kept with a {OLD_IDENTITY_SUFFIX}.1 suffix)" in capsys.readouterr().out
+    assert get_cert_fingerprint(CERT_FILE + OLD_IDENTITY_SUFFIX) == fingerprint
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import p2pft
+
+def loaded_after(statement):
+    """Top-level modules loaded by running statement in a fresh interpreter"""
+    code = f"import sys\n{statement}\nprint(' '.join(sorted({{name.split('.')[0] for name in sys.modules}})))"
+    return set(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(p2pft.__path__[0])).stdout.split())
+
+@pytest.mark.parametrize("statement", [
+    "import p2pft", "import p2pft.engine", "from p2pft import Receiver, get_cert_fingerprint",
+    "import p2pft.settings",
+])
+def test_cryptography_is_not_loaded_by_imports(statement):
+    assert "cryptography" not in loaded_after(statement)
+
+def test_exports_resolve_on_first_use():
+    from p2pft.engine import Sender
+    from p2pft.server import TransferServer
+    assert p2pft.Sender is Sender and p2pft.TransferServer is TransferServer
+    assert set(p2pft.__all__) <= set(dir(p2pft))
+    with pytest.raises(AttributeError):
+        p2pft.missing
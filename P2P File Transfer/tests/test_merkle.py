@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from p2pft.merkle import LeafChecker, MerkleHasher, leaf_hash, merkle_root
+from p2pft.protocol import FRAME_DATA, FramedSocket, ProtocolError
+
+CHUNK = 1024
+
+def leaves_of(data, chunk_size=CHUNK):
+    hasher = MerkleHasher(chunk_size)
+    hasher.update(data)
+    return hasher.finish()
+
+def test_leaves_do_not_depend_on_how_data_arrives():
+    data = os.urandom(10 * CHUNK + 7)
+    hasher = MerkleHasher(CHUNK)
+    for start in range(0, len(data), 300):
+        hasher.update(data[start:start + 300])
+    assert hasher.finish() == leaves_of(data) == [leaf_hash(data[i:i + CHUNK]) for i in range(0, len(data), CHUNK)]
+
+def test_root_of_odd_levels_and_empty_streams():
+    a, b, c = (leaf_hash(bytes([n])) for n in range(3))
+    assert merkle_root([a]) == a
+    assert merkle_root([a, b, c]) == merkle_root([merkle_root([a, b]), c])
+    assert merkle_root([]) == merkle_root(leaves_of(b""))
+    assert merkle_root([a, b]) != merkle_root([b, a])
+
+def test_checker_finds_and_accepts_repaired_chunks():
+    data = bytearray(os.urandom(5 * CHUNK))
+    expected = leaves_of(data)
+    checker = LeafChecker(CHUNK)
+    checker.add_expected(0, b"".join(expected))
+    data[2 * CHUNK + 10] ^= 0xff
+    checker.hasher.update(data)
+    assert checker.root_matches(merkle_root(expected).hex())
+    assert checker.bad_chunks() == [2]
+    assert not checker.accept(2, data[2 * CHUNK:3 * CHUNK])
+    data[2 * CHUNK + 10] ^= 0xff
+    assert checker.accept(2, data[2 * CHUNK:3 * CHUNK])
+    assert checker.bad_chunks() == []
+
+@pytest.mark.parametrize("index", [-1, 5, 1 << 40])
+def test_resent_chunk_outside_the_stream_is_a_protocol_error(index):
+    data = os.urandom(5 * CHUNK)
+    checker = LeafChecker(CHUNK)
+    checker.add_expected(index, leaf_hash(data[:CHUNK]))  # A hostile sender can publish such a leaf too
+    checker.hasher.update(data)
+    checker.bad_chunks()
+    with pytest.raises(ProtocolError, match="outside the stream"):
+        checker.accept(index, data[:CHUNK])
+    assert checker.hasher.finish() == leaves_of(data)
+
+def test_missing_leaves_fail_the_root():
+    expected = leaves_of(os.urandom(3 * CHUNK))
+    checker = LeafChecker(CHUNK)
+    checker.add_expected(0, b"".join(expected[:2]))
+    checker.hasher.update(bytes(3 * CHUNK))
+    assert not checker.root_matches(merkle_root(expected).hex())
+
+@pytest.fixture
+def corrupt_data_frames(monkeypatch):
+    """Returns a function that flips a byte in the first count data frames received, and lists their sizes"""
+    recv_frame = FramedSocket.recv_frame
+    corrupted = []
+
+    def install(count):
+        def recv_corrupted(self):
+            frame_type, flags, payload = recv_frame(self)
+            if frame_type == FRAME_DATA and not flags and payload and len(corrupted) < count:
+                payload[len(payload) // 2] ^= 0xff
+                corrupted.append(len(payload))
+            return frame_type, flags, payload
+        monkeypatch.setattr(FramedSocket, "recv_frame", recv_corrupted)
+        return corrupted
+
+    return install
+
+def test_corrupted_chunk_is_sent_again(tmp_path, loopback, corrupt_data_frames):
+    source = tmp_path / "data.bin"
+    source.write_bytes(os.urandom(3 * 1024 * 1024 + 11))
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    corrupted = corrupt_data_frames(1)
+
+    sent, received = loopback([str(source)], dest, autotune=False)
+
+    assert corrupted and received.ok
+    assert received.metrics.counters["retransmitted_chunks"] == 1
+    assert (dest / "data.bin").read_bytes() == source.read_bytes()
+
+def test_chunk_that_never_arrives_intact_fails_the_batch(tmp_path, loopback, corrupt_data_frames):
+    source = tmp_path / "data.bin"
+    source.write_bytes(os.urandom(2 * 1024 * 1024))
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    corrupt_data_frames(1000)
+
+    _, received = loopback([str(source)], dest, autotune=False)
+
+    assert received.status == "Failed (Checksum)"
+    assert os.listdir(dest) == []
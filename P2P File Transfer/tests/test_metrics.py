@@ -0,0 +1,76 @@
+import json
+import os
+
+from p2pft import metrics as metrics_module
+from p2pft.engine import TransferResult
+from p2pft.metrics import MetricsRecorder, TransferMetrics
+
+def transfer(size=1000, status="Completed"):
+    metrics = TransferMetrics()
+    metrics.phases["send"] = 0.25
+    metrics.stalls["rate_limit"] = 0.5
+    metrics.count("wire_bytes", size)
+    metrics.duration = 2.0
+    return TransferResult("data.bin", size, status, peer="127.0.0.1:8443", metrics=metrics)
+
+def samples(path):
+    with open(path) as f:
+        return dict(line.rsplit(" ", 1) for line in f.read().splitlines() if not line.startswith("#"))
+
+def recorder(tmp_path):
+    return MetricsRecorder(str(tmp_path / "metrics.jsonl"), str(tmp_path / "p2pft.prom"))
+
+def test_transfers_are_logged_and_totalled(tmp_path):
+    recorder(tmp_path).record(transfer(), "Sent", "2026-01-02 03:04:05")
+
+    with open(tmp_path / "metrics.jsonl") as f:
+        entry = json.loads(f.read())
+    assert entry["timestamp"] == "2026-01-02 03:04:05"
+    assert (entry["direction"], entry["size"], entry["status"]) == ("Sent", 1000, "Completed")
+    assert entry["metrics"]["phases"] == {"send": 0.25}
+    exported = samples(tmp_path / "p2pft.prom")
+    assert exported['p2pft_transfers_total{direction="sent",status="completed"}'] == "1"
+    assert exported['p2pft_transfer_bytes_total{direction="sent"}'] == "1000"
+    assert exported['p2pft_transfer_stall_seconds_total{direction="sent",cause="rate_limit"}'] == "0.500000"
+    assert exported['p2pft_last_transfer_throughput_bytes_per_second{direction="sent"}'] == "500.000000"
+
+def test_totals_carry_on_across_recorders(tmp_path):
+    recorder(tmp_path).record(transfer(), "Received")
+    recorder(tmp_path).record(transfer(500), "Received")
+    recorder(tmp_path).record(transfer(300, "Failed (Checksum)"), "Received")
+
+    exported = samples(tmp_path / "p2pft.prom")
+    assert exported['p2pft_transfers_total{direction="received",status="completed"}'] == "2"
+    assert exported['p2pft_transfers_total{direction="received",status="failed"}'] == "1"
+    assert exported['p2pft_transfer_bytes_total{direction="received"}'] == "1500"
+    assert exported['p2pft_transfer_wire_bytes_total{direction="received"}'] == "1800"
+    with open(tmp_path / "metrics.jsonl") as f:
+        assert len(f.read().splitlines()) == 3
+
+def test_failure_without_a_session_is_counted(tmp_path):
+    recorder(tmp_path).record(TransferResult("data.bin", 0, "Failed (Connection)"), "Received")
+    exported = samples(tmp_path / "p2pft.prom")
+    assert exported['p2pft_transfers_total{direction="received",status="failed"}'] == "1"
+    assert not any(name.startswith("p2pft_last_") for name in exported)
+
+def test_log_is_rotated_when_it_grows(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics_module, "METRICS_LOG_MAX_SIZE", 100)
+    metrics_recorder = recorder(tmp_path)
+    metrics_recorder.record(transfer(), "Sent")
+    metrics_recorder.record(transfer(), "Sent")
+    assert os.path.exists(tmp_path / "metrics.jsonl.1")
+    with open(tmp_path / "metrics.jsonl") as f:
+        assert len(f.read().splitlines()) == 1
+
+def test_loopback_transfer_fills_in_its_phases(tmp_path, loopback):
+    source = tmp_path / "data.bin"
+    source.write_bytes(os.urandom(1024 * 1024))
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    sent, received = loopback([str(source)], dest)
+
+    assert {"handshake", "read", "send"} <= set(sent.metrics.phases)
+    assert {"handshake", "receive", "write", "commit"} <= set(received.metrics.phases)
+    assert received.metrics.counters["wire_bytes"] >= 1024 * 1024
+    assert 0 < received.metrics.duration
@@ -0,0 +1,86 @@
+import socket
+import time
+
+import pytest
+
+from p2pft.probe import PeerProber
+
+@pytest.fixture
+def prober():
+    prober = PeerProber(interval=10, max_backoff=25)
+    yield prober
+    prober.close()
+
+@pytest.fixture
+def listening():
+    """Address of a localhost socket accepting connections"""
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        yield server.getsockname()
+
+def settle(prober, address):
+    """Wait for the probe in flight to finish; returns its number of failures so far"""
+    state = prober._states[address]
+    assert wait(lambda: not state.probing)
+    return state.failures
+
+def wait(condition, attempts=500):
+    # Counted rather than timed, as the tests stop time.monotonic
+    for _ in range(attempts):
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_changes_are_reported_once(prober, listening, free_port, clock):
+    closed = ("127.0.0.1", free_port())
+    assert prober.poll([listening, closed]) == {}  # Probes only just started
+    settle(prober, listening)
+    settle(prober, closed)
+
+    assert prober.poll([listening, closed]) == {listening: True, closed: False}
+    assert prober.poll([listening, closed]) == {}
+    assert prober.status(listening) and prober.status(closed) is False
+    assert prober.status(("127.0.0.1", 1)) is None
+
+def test_offline_peers_back_off(prober, free_port, clock):
+    closed = ("127.0.0.1", free_port())
+    delays = []
+    for _ in range(4):
+        prober.poll([closed])
+        failures = settle(prober, closed)
+        delays.append(prober._states[closed].next_probe - clock.now)
+        clock.now += delays[-1] - 1
+        prober.poll([closed])  # Not due yet
+        assert not prober._states[closed].probing and prober._states[closed].failures == failures
+        clock.now += 1
+    assert delays == [10, 20, 25, 25]
+
+def test_hint_makes_a_peer_due(prober, free_port, clock):
+    closed = ("127.0.0.1", free_port())
+    prober.poll([closed])
+    settle(prober, closed)
+    prober.hint(closed)
+    prober.poll([closed])
+    assert settle(prober, closed) == 2
+
+def test_forgotten_peers_are_dropped(prober, free_port, clock):
+    closed = ("127.0.0.1", free_port())
+    prober.poll([closed])
+    settle(prober, closed)
+    assert prober.poll([]) == {}
+    assert prober.status(closed) is None
+
+def test_peers_left_out_are_not_probed_and_are_reported_again_on_return(prober, listening, clock):
+    # The UI leaves out the saved peers discovery hears, and lists them again once they go quiet
+    prober.poll([listening])
+    settle(prober, listening)
+    assert prober.poll([listening]) == {listening: True}
+    prober.poll([])
+    clock.now += 100
+    prober.poll([])
+    assert listening not in prober._states
+    prober.poll([listening])  # Due at once
+    settle(prober, listening)
+    assert prober.poll([listening]) == {listening: True}
@@ -0,0 +1,33 @@
+import pytest
+
+from p2pft.engine import TransferProgress
+
+def test_sample_reports_percent_speed_and_eta(clock):
+    progress = TransferProgress(smoothing=0.5)
+    progress.start(1000)
+    progress.add(100)
+    clock.now += 1
+    assert progress.sample() == (10.0, 100, 100.0, 9.0)
+
+    # Speed is smoothed across samples
+    progress.add(300)
+    clock.now += 1
+    percent, done, speed, eta = progress.sample()
+    assert (percent, done, speed) == (40.0, 400, 200.0)
+    assert eta == pytest.approx(3.0)
+
+def test_no_eta_before_anything_moved(clock):
+    progress = TransferProgress()
+    progress.start(1000)
+    clock.now += 1
+    assert progress.sample() == (0.0, 0, 0.0, None)
+
+def test_restart_resets_the_counters(clock):
+    progress = TransferProgress()
+    progress.start(10)
+    progress.add(10)
+    progress.start(50)
+    assert (progress.total, progress.done) == (50, 0)
+    assert not progress.finished
+    progress.finish()
+    assert progress.finished
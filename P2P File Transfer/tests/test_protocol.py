@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from p2pft.protocol import (
+    FRAME_CONTROL, FRAME_DATA, FRAME_HEADER, MANIFEST_FRAME_SIZE, PROTOCOL_MAGIC, PROTOCOL_VERSION, FramedSocket, ProtocolError,
+)
+
+def test_frames_keep_their_boundaries(framed_pair):
+    left, right = framed_pair
+    left.send_frame(FRAME_DATA, b"first", flags=1)
+    left.send_frame(FRAME_DATA, b"")
+    left.send_json(FRAME_CONTROL, {"type": "hello"})
+    buf = left.data_buffer(16)
+    buf[:5] = b"12345"
+    left.send_data(5)
+
+    frame_type, flags, payload = right.recv_frame()
+    assert (frame_type, flags, bytes(payload)) == (FRAME_DATA, 1, b"first")
+    assert bytes(right.recv_frame()[2]) == b""
+    assert right.recv_json(FRAME_CONTROL) == {"type": "hello"}
+    assert bytes(right.recv_frame()[2]) == b"12345"
+
+def test_handshake_agrees_on_version(framed_pair):
+    left, right = framed_pair
+    thread = threading.Thread(target=left.handshake)
+    thread.start()
+    assert right.handshake() == PROTOCOL_VERSION
+    thread.join()
+    assert left.peer_version == PROTOCOL_VERSION
+
+@pytest.mark.parametrize("preamble, message", [
+    (b"HTTP/", "not a P2P file transfer endpoint"),
+    (PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION + 1]), "Unsupported protocol version"),
+])
+def test_handshake_rejects_other_peers(framed_pair, preamble, message):
+    left, right = framed_pair
+    left.sock.sendall(preamble)
+    with pytest.raises(ProtocolError, match=message):
+        right.handshake()
+
+def test_oversized_frames_are_refused_on_both_ends(framed_pair):
+    left, right = framed_pair
+    small = FramedSocket(left.sock, max_frame_size=8)
+    with pytest.raises(ProtocolError):
+        small.send_frame(FRAME_DATA, b"123456789")
+    left.sock.sendall(FramedSocket.PREFIX.pack(FRAME_DATA, 0, right.max_frame_size + 1))
+    with pytest.raises(ProtocolError, match="above the maximum frame size"):
+        right.recv_frame()
+
+def test_unexpected_frame_type_is_a_protocol_error(framed_pair):
+    left, right = framed_pair
+    left.send_json(FRAME_HEADER, {"files": []})
+    with pytest.raises(ProtocolError, match="Expected frame type"):
+        right.recv_json(FRAME_CONTROL)
+
+def test_connection_closed_mid_frame(framed_pair):
+    left, right = framed_pair
+    left.sock.sendall(FramedSocket.PREFIX.pack(FRAME_DATA, 0, 10) + b"short")
+    left.sock.close()
+    with pytest.raises(ConnectionError):
+        right.recv_frame()
+
+def test_large_manifest_spans_header_frames(framed_pair):
+    left, right = framed_pair
+    entries = [{"path": f"folder/file-{n:06d}.txt", "size": n, "mtime": 0.0} for n in range(20000)]
+    assert len(str(entries)) > 2 * MANIFEST_FRAME_SIZE
+    thread = threading.Thread(target=left.send_manifest, args=(entries,))
+    thread.start()
+    assert right.recv_manifest() == entries
+    thread.join()
@@ -0,0 +1,32 @@
+import pytest
+
+from p2pft.engine import RateLimiter
+
+def test_unlimited_never_waits(clock):
+    limiter = RateLimiter(0)
+    assert limiter.reserve(10 ** 9) == 0
+    assert limiter.acquire(10 ** 9) == 0
+
+def test_burst_then_debt_paid_back_at_the_rate(clock):
+    limiter = RateLimiter(1000, burst_seconds=0.1)
+    assert limiter.reserve(100) == 0  # The initial burst
+    assert limiter.reserve(500) == pytest.approx(0.5)
+    # Concurrent senders queue behind the same debt
+    assert limiter.reserve(500) == pytest.approx(1.0)
+    clock.now += 1.0
+    assert limiter.reserve(0) == pytest.approx(0.0)
+
+def test_idle_time_refills_only_up_to_the_burst(clock):
+    limiter = RateLimiter(1000, burst_seconds=0.1)
+    limiter.reserve(100)
+    clock.now += 60
+    assert limiter.reserve(100) == 0
+    assert limiter.reserve(100) == pytest.approx(0.1)
+
+def test_rate_changes_apply_to_the_next_reservation(clock):
+    limiter = RateLimiter(1000)
+    limiter.reserve(1100)
+    limiter.set_rate(2000)
+    assert limiter.reserve(1000) == pytest.approx(1.0)  # 1000 bytes of debt plus 1000 more, at the new rate
+    limiter.set_rate(0)
+    assert limiter.reserve(10 ** 6) == 0
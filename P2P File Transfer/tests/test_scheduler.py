@@ -0,0 +1,130 @@
+import socket
+import threading
+import time
+
+from p2pft import scheduler
+from p2pft.engine import ConnectionPool, Receiver
+from p2pft.scheduler import FairShare, TransferJob, TransferScheduler, port_available, queue_order, weight
+from p2pft.settings import SecureSettings
+
+def test_queue_runs_by_priority_then_age():
+    jobs = [
+        TransferJob("send", "old low", {}, 0, created="2026-01-01 00:00:00.000000"),
+        TransferJob("send", "done", {}, 3, state="completed", created="2026-01-01 00:00:00.000000"),
+        TransferJob("send", "new urgent", {}, 3, created="2026-01-03 00:00:00.000000"),
+        TransferJob("send", "running low", {}, 0, state="running", created="2026-01-04 00:00:00.000000"),
+        TransferJob("send", "old urgent", {}, 3, created="2026-01-02 00:00:00.000000"),
+    ]
+    assert [job.name for job in sorted(jobs, key=queue_order)] == [
+        "running low", "old urgent", "new urgent", "old low", "done"]
+
+def test_budget_is_split_by_weight(clock):
+    share = FairShare(3000)
+    low, high = share.limiter(weight(0)), share.limiter(weight(1))
+    low.reserve(1)
+    high.reserve(1)
+    assert (low.bucket.rate_limit, high.bucket.rate_limit) == (1000, 2000)
+
+    share.set_weight(low, weight(1))
+    assert low.bucket.rate_limit == high.bucket.rate_limit == 1500
+    share.release(low)
+    assert high.bucket.rate_limit == 3000
+
+def test_idle_transfer_gives_up_its_share(clock):
+    share = FairShare(3000, idle_after=0.5)
+    waiting, sending = share.limiter(), share.limiter()
+    waiting.reserve(1)
+    sending.reserve(1)
+    assert sending.bucket.rate_limit == 1500
+    clock.now += 1
+    sending.reserve(1)
+    assert sending.bucket.rate_limit == 3000
+    waiting.reserve(1)  # Back in once it sends again
+    assert sending.bucket.rate_limit == waiting.bucket.rate_limit == 1500
+
+def test_unlimited_budget_stays_unlimited():
+    share = FairShare(0)
+    limiter = share.limiter(weight(3))
+    assert limiter.reserve(10 ** 9) == 0
+
+def test_ports_in_use_are_skipped(monkeypatch, free_port):
+    with socket.socket() as taken:
+        taken.bind(("0.0.0.0", 0))
+        taken.listen()
+        port = taken.getsockname()[1]
+        assert not port_available(port)
+        monkeypatch.setattr(scheduler, "DEFAULT_PORT", port)
+        assert TransferScheduler()._free_port() > port
+
+def test_send_without_a_free_port_fails_and_frees_its_slot(monkeypatch):
+    monkeypatch.setattr(scheduler, "DEFAULT_PORT", 65530)
+    monkeypatch.setattr(scheduler, "port_available", lambda port: False)
+    finished, errors = [], []
+    queue = TransferScheduler(max_concurrent=1, on_finish=lambda job, result: finished.append(result.status),
+                              on_error=lambda job, error: errors.append(error))
+    job = queue.submit("send", "stuck", {"paths": []})
+    assert job.state == "failed"
+    assert finished == ["Failed"]
+    assert isinstance(errors[0], OSError)
+    assert not queue._running
+
+def listening(job, timeout=10):
+    deadline = time.monotonic() + timeout
+    while job.port is None or port_available(job.port):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def test_jobs_start_by_priority_when_a_slot_frees(tmp_path, monkeypatch, identity, free_port):
+    monkeypatch.setattr(scheduler, "DEFAULT_PORT", free_port())
+    (tmp_path / "data.bin").write_bytes(b"queued" * 1000)
+    started, finished = [], []
+    done = threading.Semaphore(0)
+
+    def changed(job):
+        if job.state == "running" and job.name not in started:
+            started.append(job.name)
+
+    def on_finish(job, result):
+        finished.append((job.name, result.status))
+        done.release()
+
+    queue = TransferScheduler(max_concurrent=1, on_change=changed, on_finish=on_finish)
+    options = {"cert_path": identity[0], "key_path": identity[1]}
+    first = queue.submit("send", "first", dict(options, paths=[str(tmp_path / "data.bin")]), 0)
+    low = queue.submit("send", "low", dict(options, paths=[str(tmp_path / "data.bin")]), 0)
+    urgent = queue.submit("send", "urgent", dict(options, paths=[str(tmp_path / "data.bin")]), 3)
+    dropped = queue.submit("send", "dropped", dict(options, paths=[str(tmp_path / "data.bin")]), 3)
+    assert [job.name for job in queue.jobs()] == ["first", "urgent", "dropped", "low"]
+    assert queue.cancel(dropped.id)
+    assert not queue.cancel(first.id)
+
+    for expected, job in (("first", first), ("urgent", urgent), ("low", low)):
+        dest = tmp_path / expected
+        dest.mkdir()
+        assert listening(job)
+        receiver = Receiver("127.0.0.1", job.port, identity[2], str(dest), pool=ConnectionPool())
+        assert receiver.receive().ok
+        assert done.acquire(timeout=30)
+        assert (dest / "data.bin").read_bytes() == (tmp_path / "data.bin").read_bytes()
+
+    assert started == ["first", "urgent", "low"]
+    assert finished == [("first", "Completed"), ("urgent", "Completed"), ("low", "Completed")]
+    assert queue.job(dropped.id).state == "cancelled"
+
+def test_saved_queue_survives_a_restart(tmp_path):
+    store = SecureSettings(str(tmp_path / "settings.db"), str(tmp_path / "settings.key"))
+    running = TransferJob("send", "interrupted", {"paths": []}, 2, state="running", port=9000)
+    queued = TransferJob("receive", "waiting", {"host": "127.0.0.1"}, 0)
+    for job in (running, queued):
+        store.save_job(job.to_dict())
+
+    queue = TransferScheduler(store)  # Not started, so nothing runs
+    restored = queue.jobs()
+    assert [(job.name, job.state, job.port) for job in restored] == [
+        ("interrupted", "queued", None), ("waiting", "queued", None)]
+    assert queue.cancel(queued.id)
+    queue.clear_finished()
+    assert [job["id"] for job in store.jobs()] == [running.id]
+    store.close()
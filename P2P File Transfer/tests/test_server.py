@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from p2pft import engine
+from p2pft.batch import build_manifest
+from p2pft.dedup import ChunkStore
+from p2pft.engine import ConnectionPool, Receiver
+from p2pft.fanout import FanOut
+from p2pft.merkle import MerkleHasher, merkle_root
+from p2pft.protocol import ProtocolError
+from p2pft.server import Catalog, TransferServer
+
+@pytest.fixture
+def serve(identity, free_port):
+    """Start a TransferServer on a free localhost port; returns the port"""
+    cert_path, key_path, _ = identity
+    stop = threading.Event()
+    threads = []
+
+    def start(catalog, **options):
+        port = free_port()
+        server = TransferServer(catalog, port=port, cert_path=cert_path, key_path=key_path, **options)
+        thread = threading.Thread(target=server.run, args=(stop,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return port
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    yield start
+    stop.set()
+    for thread in threads:
+        thread.join(10)
+
+@pytest.fixture
+def offers(tmp_path):
+    """Two offers, a 3 MB file and a small folder"""
+    source = tmp_path / "src"
+    (source / "folder").mkdir(parents=True)
+    (source / "big.bin").write_bytes(os.urandom(3 * 1024 * 1024 + 5))
+    for n in range(20):
+        (source / "folder" / f"{n}.txt").write_bytes(b"%d\n" % n * (n + 1))
+    return source
+
+def receiver(identity, port, dest, offer=None):
+    return Receiver("127.0.0.1", port, identity[2], str(dest), offer=offer, pool=ConnectionPool())
+
+def receive_concurrently(identity, port, dests, offer=None):
+    results = {}
+
+    def fetch(dest):
+        results[dest] = receiver(identity, port, dest, offer).receive()
+
+    threads = [threading.Thread(target=fetch, args=(dest,)) for dest in dests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    return results
+
+def test_lists_its_catalog(identity, serve, offers):
+    port = serve(Catalog.from_paths([str(offers / "big.bin"), str(offers / "folder")]))
+    listing = receiver(identity, port, offers).list_offers()
+    assert sorted((offer["name"], offer["files"]) for offer in listing) == [("big.bin", 1), ("folder", 20)]
+
+def test_concurrent_receivers_each_get_their_offer(tmp_path, identity, serve, offers):
+    port = serve(Catalog.from_paths([str(offers / "big.bin"), str(offers / "folder")]))
+    dests = [tmp_path / f"dest{n}" for n in range(4)]
+    for dest in dests:
+        dest.mkdir()
+    results = receive_concurrently(identity, port, dests[:2], "big.bin")
+    results.update(receive_concurrently(identity, port, dests[2:], "folder"))
+
+    assert all(result.ok for result in results.values())
+    for dest in dests[:2]:
+        assert (dest / "big.bin").read_bytes() == (offers / "big.bin").read_bytes()
+    for dest in dests[2:]:
+        assert sorted(os.listdir(dest / "folder")) == sorted(os.listdir(offers / "folder"))
+
+def test_unknown_offer_is_refused(tmp_path, identity, serve, offers):
+    port = serve(Catalog.from_paths([str(offers / "big.bin")]))
+    with pytest.raises(ProtocolError, match="No offer named"):
+        receiver(identity, port, tmp_path, "missing").receive()
+
+def test_broadcast_receivers_share_one_pass(tmp_path, identity, serve, offers):
+    port = serve(Catalog.from_paths([str(offers / "big.bin")]), broadcast=True)
+    dests = [tmp_path / f"dest{n}" for n in range(3)]
+    for dest in dests:
+        dest.mkdir()
+    results = receive_concurrently(identity, port, dests)
+    assert all(result.ok for result in results.values())
+    for dest in dests:
+        assert (dest / "big.bin").read_bytes() == (offers / "big.bin").read_bytes()
+
+def test_dedup_receivers_reuse_stored_chunks(tmp_path, identity, serve, offers, monkeypatch):
+    monkeypatch.setattr(engine, "ChunkStore", functools.partial(ChunkStore, str(tmp_path / "chunks")))
+    port = serve(Catalog.from_paths([str(offers / "big.bin")]), dedup=True)
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    assert receiver(identity, port, first).receive().ok
+    result = receiver(identity, port, second).receive()
+    assert result.ok
+    assert (second / "big.bin").read_bytes() == (offers / "big.bin").read_bytes()
+    assert result.metrics.counters["deduplicated_bytes"] > (offers / "big.bin").stat().st_size * 9 // 10
+
+def leaves_of(data):
+    hasher = MerkleHasher()
+    hasher.update(data)
+    return hasher.finish()
+
+def fanout_pass(offers, slots=4, max_stall=0.01):
+    return FanOut(build_manifest([str(offers / "big.bin")]), asyncio.Semaphore(4), 256 * 1024, slots, max_stall)
+
+async def read_all(fanout, member):
+    buf = bytearray(fanout.chunk_size)
+    data = bytearray()
+    for index in range(fanout.chunk_count):
+        data += buf[:await fanout.read(member, index, buf)]
+    await fanout.leave(member)
+    return bytes(data)
+
+def test_member_that_joined_before_reading_outlives_the_others(offers):
+    async def scenario():
+        fanout = fanout_pass(offers)
+        early, negotiating = fanout.join(), fanout.join()
+        first = await read_all(fanout, early)
+        await asyncio.sleep(0.05)  # Still negotiating while the only other member has left
+        return first, await read_all(fanout, negotiating), await fanout.result()
+
+    first, late, leaves = asyncio.run(scenario())
+    expected = (offers / "big.bin").read_bytes()
+    assert first == late == expected
+    assert merkle_root(leaves) == merkle_root(leaves_of(expected))
+
+def test_stragglers_catch_up_from_disk(offers):
+    async def scenario():
+        fanout = fanout_pass(offers, slots=2)
+        fast, slow = fanout.join(), fanout.join()
+        fast_data = await read_all(fanout, fast)
+        return fast_data, await read_all(fanout, slow), fanout
+
+    fast, slow, fanout = asyncio.run(scenario())
+    assert fast == slow == (offers / "big.bin").read_bytes()
+    # One pass for both, plus what the straggler missed while it fell out of the ring
+    assert fanout.chunk_count < fanout.disk_reads < 2 * fanout.chunk_count
+
+def test_pooled_connection_is_reused(tmp_path, identity, serve, offers):
+    port = serve(Catalog.from_paths([str(offers / "folder")]))
+    pool = ConnectionPool()
+    key = ("127.0.0.1", port, identity[2])
+    Receiver("127.0.0.1", port, identity[2], str(tmp_path / "first"), pool=pool).receive()
+    kept = pool._idle[key][-1][1]
+    assert Receiver("127.0.0.1", port, identity[2], str(tmp_path / "second"), pool=pool).receive().ok
+    assert pool._idle[key] and pool._idle[key][-1][1] is kept
+    pool.clear()
+
+def test_new_connections_resume_the_tls_session(tmp_path, identity, serve, offers):
+    port = serve(Catalog.from_paths([str(offers / "folder")]))
+    pool = ConnectionPool(idle_timeout=0)  # Every transfer needs a new connection
+    key = ("127.0.0.1", port, identity[2])
+    Receiver("127.0.0.1", port, identity[2], str(tmp_path / "first"), pool=pool).receive()
+    first = pool._idle[key][-1][1]
+    assert not first.sock.session_reused
+    assert Receiver("127.0.0.1", port, identity[2], str(tmp_path / "second"), pool=pool).receive().ok
+    second = pool._idle[key][-1][1]
+    assert second is not first and second.sock.session_reused
+    assert first.sock.fileno() == -1  # Idled out and closed
+    pool.clear()
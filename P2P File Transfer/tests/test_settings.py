@@ -0,0 +1,98 @@
+import json
+import sqlite3
+
+import pytest
+from cryptography.fernet import Fernet
+
+from p2pft import settings as settings_module
+from p2pft.settings import LEGACY_SETTINGS_FILE, SETTINGS_DB, SETTINGS_KEY_FILE, SecureSettings
+
+@pytest.fixture
+def open_store(tmp_path, monkeypatch):
+    """Returns a function opening the store in a scratch directory; every store opened is closed afterwards"""
+    monkeypatch.chdir(tmp_path)
+    stores = []
+
+    def open_():
+        stores.append(SecureSettings())
+        return stores[-1]
+
+    yield open_
+    for store in stores:
+        store.close()
+
+def history_entry(n, status="Completed"):
+    return {"timestamp": f"2026-01-01 00:00:{n:02d}", "filename": f"file{n}.bin", "peer": "10.0.0.2",
+            "status": status, "direction": "Sent" if n % 2 else "Received"}
+
+def test_everything_survives_reopening(open_store):
+    store = open_store()
+    store.save_settings({"port": 9000, "compression": True})
+    store.save_settings({"port": 9001})
+    store.save_peer({"name": "laptop", "host": "10.0.0.2"})
+    store.save_peer({"name": "nas", "host": "10.0.0.3"})
+    store.save_peer({"name": "laptop", "host": "10.0.0.4"})
+    store.remove_peer("nas")
+    store.save_job({"id": "a", "state": "queued"})
+    store.save_job({"id": "b", "state": "queued"})
+    store.save_job({"id": "a", "state": "running"})
+    store.remove_job("b")
+    store.close()
+
+    reopened = open_store()
+    assert reopened.load_settings() == {"port": 9001, "compression": True}
+    assert reopened.peers() == [{"name": "laptop", "host": "10.0.0.4"}]
+    assert reopened.peer("nas") is None
+    assert reopened.jobs() == [{"id": "a", "state": "running"}]
+
+def test_values_are_encrypted_at_rest(open_store):
+    store = open_store()
+    store.save_peer({"name": "laptop", "host": "10.0.0.2"})
+    store.add_history(history_entry(1))
+    with sqlite3.connect(SETTINGS_DB) as db:
+        dump = "\n".join(db.iterdump())
+    assert "laptop" not in dump and "file1.bin" not in dump
+
+def test_history_pages_newest_first(open_store):
+    store = open_store()
+    for n in range(10):
+        store.add_history(history_entry(n))
+    assert store.history_count() == 10
+    assert [entry["filename"] for entry in store.history_page(2, 3)] == ["file7.bin", "file6.bin", "file5.bin"]
+    assert store.history_page(10, 5) == []
+
+def test_search_matches_every_word_and_keeps_up(open_store):
+    store = open_store()
+    for n in range(6):
+        store.add_history(history_entry(n, "Failed" if n == 4 else "Completed"))
+    assert [entry["filename"] for entry in store.search_history("sent FILE")] == ["file5.bin", "file3.bin", "file1.bin"]
+    assert [entry["filename"] for entry in store.search_history(status="Failed")] == ["file4.bin"]
+
+    store.add_history(history_entry(7))  # Added after the index was built
+    assert store.search_history("file7")[0]["filename"] == "file7.bin"
+    store.clear_history()
+    assert store.search_history() == [] and store.history_count() == 0
+
+def test_oldest_history_is_dropped(open_store, monkeypatch):
+    monkeypatch.setattr(settings_module, "HISTORY_MAX_ENTRIES", 3)
+    store = open_store()
+    store.search_history()
+    for n in range(5):
+        store.add_history(history_entry(n))
+    assert store.history_count() == 3
+    assert [entry["filename"] for entry in store.search_history()] == ["file4.bin", "file3.bin", "file2.bin"]
+
+def test_legacy_settings_are_migrated(tmp_path, open_store):
+    key = Fernet.generate_key()
+    (tmp_path / SETTINGS_KEY_FILE).write_bytes(key)
+    legacy = {"port": 9000, "saved_peers": [{"name": "laptop", "host": "10.0.0.2"}],
+              "transfer_history": [history_entry(1), history_entry(2)]}
+    (tmp_path / LEGACY_SETTINGS_FILE).write_bytes(Fernet(key).encrypt(json.dumps(legacy).encode()))
+
+    store = open_store()
+
+    assert store.load_settings() == {"port": 9000}
+    assert store.peer("laptop") == {"name": "laptop", "host": "10.0.0.2"}
+    assert [entry["filename"] for entry in store.history_page(0, 10)] == ["file2.bin", "file1.bin"]
+    assert not (tmp_path / LEGACY_SETTINGS_FILE).exists()
+    assert (tmp_path / (LEGACY_SETTINGS_FILE + ".migrated")).exists()
@@ -0,0 +1,126 @@
+import os
+import random
+import socket
+import threading
+import time
+
+import pytest
+
+from p2pft import swarm
+from p2pft.swarm import PieceStore, SwarmDescriptor, SwarmNode
+
+PIECE_SIZE = 64 * 1024
+
+@pytest.fixture
+def payload(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "data.bin").write_bytes(os.urandom(20 * PIECE_SIZE + 100))
+    return source / "data.bin"
+
+@pytest.fixture
+def node_options(identity, free_port):
+    """Returns a function giving the keyword arguments of a new node: a free port and the test identity"""
+    return lambda: dict(port=free_port(), cert_path=identity[0], key_path=identity[1])
+
+@pytest.fixture
+def swarm_nodes(monkeypatch):
+    """Returns a function that runs a node until the test ends or the stop event it returns is set"""
+    monkeypatch.setattr(swarm, "SWARM_UPDATE_INTERVAL", 0.2)
+    running = []
+
+    def start(node):
+        stop = threading.Event()
+        thread = threading.Thread(target=node.run, args=(stop,), daemon=True)
+        thread.start()
+        running.append((stop, thread))
+        assert wait_for(lambda: accepting(node.port))
+        return stop
+
+    yield start
+    for stop, thread in running:
+        stop.set()
+    for stop, thread in running:
+        thread.join(10)
+
+def accepting(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=1).close()
+    except ConnectionRefusedError:
+        return False
+    return True
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def test_rarest_piece_is_fetched_first(tmp_path, payload, identity):
+    descriptor, _ = SwarmDescriptor.from_paths([str(payload)], PIECE_SIZE)
+    node = SwarmNode(PieceStore.receiving(descriptor, str(tmp_path / "dest")),
+                     cert_path=identity[0], key_path=identity[1])
+    everything = bytes([0xff]) * len(node.store.have)
+    rare = bytearray(everything)
+    rare[0] &= 0x7f  # Peer b lacks piece 0, so only peer a has it
+    node._set_peer_have("a", everything)
+    node._set_peer_have("b", bytes(rare))
+    assert node._pick("a") == 0
+    assert node._pick("a") != 0  # Piece 0 is in flight now
+    node._set_peer_have("a", None)
+    assert node._counts[0] == 0
+
+def test_picking_does_not_rescan_every_piece(identity):
+    count = 40000
+    descriptor = SwarmDescriptor([{"path": "big.bin", "size": count * PIECE_SIZE}], PIECE_SIZE, bytes(32 * count))
+    node = SwarmNode(PieceStore(descriptor, [], complete=False), cert_path=identity[0], key_path=identity[1])
+    rng = random.Random(36)
+    for peer in "abc":
+        node._set_peer_have(peer, rng.randbytes(len(node.store.have)))
+    held = [index for index in range(count) if node._peer_have["a"][index >> 3] & (0x80 >> (index & 7))]
+
+    started = time.monotonic()
+    picked = []
+    while (index := node._pick("a")) is not None:
+        picked.append(index)
+    assert time.monotonic() - started < 5  # A full scan per pick takes minutes here
+    assert sorted(picked) == held
+    counts = [node._counts[index] for index in picked]
+    assert counts == sorted(counts)  # Rarest first
+
+def test_finished_files_are_flushed_before_the_rename(tmp_path, payload, monkeypatch):
+    descriptor, manifest = SwarmDescriptor.from_paths([str(payload)], PIECE_SIZE)
+    store = PieceStore.receiving(descriptor, str(tmp_path / "dest"))
+    target = tmp_path / "dest" / "data.bin"
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(target.exists()) or real_fsync(fd))
+    buf = bytearray(PIECE_SIZE)
+    for index in range(descriptor.piece_count):
+        length = PieceStore.seeding(descriptor, manifest).read_piece(index, buf)
+        assert store.write_piece(index, bytes(buf[:length]))
+    assert synced == [False]
+    assert target.read_bytes() == payload.read_bytes()
+
+def test_pieces_spread_and_members_leave(tmp_path, payload, identity, node_options, swarm_nodes):
+    seeder_options = node_options()
+    seeder = SwarmNode.seed([str(payload)], PIECE_SIZE, **seeder_options)
+    swarm_nodes(seeder)
+    address = ("127.0.0.1", seeder_options["port"])
+    nodes = [SwarmNode.join(address, identity[2], str(tmp_path / f"node{n}"), **node_options())
+             for n in range(3)]
+    stops = [swarm_nodes(node) for node in nodes]
+
+    assert all(node.completed.wait(30) for node in nodes)
+    for n in range(3):
+        assert (tmp_path / f"node{n}" / "data.bin").read_bytes() == payload.read_bytes()
+    # Finished nodes stay listed on the tracker, as they keep serving
+    assert wait_for(lambda: len(seeder._members) == 3)
+
+    stops[0].set()
+    assert wait_for(lambda: len(seeder._members) == 2)
+    gone = ("127.0.0.1", nodes[0].port)
+    assert gone not in seeder._members
+    assert wait_for(lambda: gone not in nodes[1]._peers)
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from p2pft.batch import build_manifest, safe_join
+from p2pft.cli import print_result
+from p2pft.protocol import ProtocolError
+
+def make_tree(root):
+    """A folder with nested, empty and zero-length entries; returns it"""
+    tree = root / "tree"
+    (tree / "docs" / "deep").mkdir(parents=True)
+    (tree / "empty").mkdir()
+    (tree / "a.txt").write_bytes(b"alpha\n" * 1000)
+    (tree / "docs" / "b.bin").write_bytes(os.urandom(300 * 1024))
+    (tree / "docs" / "deep" / "zero").write_bytes(b"")
+    return tree
+
+def same_tree(left, right):
+    def listing(root):
+        return sorted((os.path.relpath(folder, root), sorted(files), sorted(dirs))
+                      for folder, dirs, files in os.walk(root))
+    if listing(left) != listing(right):
+        return False
+    for folder, _, files in os.walk(left):
+        for name in files:
+            source = os.path.join(folder, name)
+            with open(source, "rb") as a, open(os.path.join(right, os.path.relpath(source, left)), "rb") as b:
+                if a.read() != b.read():
+                    return False
+    return True
+
+def test_manifest_lists_files_and_empty_folders(tmp_path):
+    tree = make_tree(tmp_path)
+    single = tmp_path / "single.txt"
+    single.write_bytes(b"x")
+    paths = [entry["path"] for _, entry in build_manifest([str(tree), str(single)])]
+    assert paths == ["tree/a.txt", "tree/docs/b.bin", "tree/docs/deep/zero", "tree/empty", "single.txt"]
+
+@pytest.mark.parametrize("path", ["../escape", "a/../../b", "/etc/passwd", "a//b", "./a"])
+def test_unsafe_manifest_paths_are_refused(tmp_path, path):
+    with pytest.raises(ProtocolError):
+        safe_join(str(tmp_path), path)
+
+def test_tree_and_file_in_one_session(tmp_path, loopback):
+    tree = make_tree(tmp_path)
+    single = tmp_path / "single.txt"
+    single.write_bytes(b"one file next to the folder")
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    sent, received = loopback([str(tree), str(single)], dest)
+
+    assert received.ok and sent.ok
+    assert received.size == sent.size == sum(entry["size"] for _, entry in build_manifest([str(tree), str(single)]))
+    assert same_tree(tree, dest / "tree")
+    assert (dest / "single.txt").read_bytes() == single.read_bytes()
+    assert os.stat(dest / "tree" / "a.txt").st_mtime == os.stat(tree / "a.txt").st_mtime
+    assert not [name for _, _, files in os.walk(dest) for name in files if name.endswith(".part")]
+
+def test_results_name_the_peer_for_the_history(tmp_path, loopback, capsys):
+    source = tmp_path / "single.txt"
+    source.write_bytes(b"x")
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    _, received = loopback([str(source)], dest)
+
+    assert (received.name, received.peer) == ("single.txt", "127.0.0.1")
+    print_result(received)
+    assert capsys.readouterr().out.startswith("Completed 127.0.0.1: single.txt")
@@ -0,0 +1,63 @@
+import socket
+import sys
+
+import pytest
+
+from p2pft.metrics import TransferMetrics
+from p2pft.protocol import MAX_FRAME_SIZE
+from p2pft.tuning import MIN_READ_SIZE, PathTuner, power_of_two, tcp_rtt
+
+@pytest.fixture
+def sock():
+    """One end of a local stream socket, which has buffers but no RTT of its own"""
+    left, right = socket.socketpair()
+    with left, right:
+        yield left
+
+def test_sizes_round_down_to_a_power_of_two_within_bounds():
+    assert power_of_two(700 * 1024, MIN_READ_SIZE, MAX_FRAME_SIZE) == 512 * 1024
+    assert power_of_two(1, MIN_READ_SIZE, MAX_FRAME_SIZE) == MIN_READ_SIZE
+    assert power_of_two(10 * MAX_FRAME_SIZE, MIN_READ_SIZE, MAX_FRAME_SIZE) == MAX_FRAME_SIZE
+
+def test_read_size_and_buffer_follow_the_bandwidth_delay_product(sock, clock):
+    metrics = TransferMetrics()
+    buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    tuner = PathTuner(sock, MIN_READ_SIZE, metrics, rtt=0.05, interval=0.5)
+    assert metrics.tuning == [{"at": 0.0, "rtt_ms": 50.0, "read_size": MIN_READ_SIZE}]
+
+    clock.now += 0.4
+    assert not tuner.sample(10 ** 6)  # Too soon to decide
+    clock.now += 0.1
+    assert tuner.sample(50 * 10 ** 6)  # 100 MB/s over 50 ms: 5 MB in flight
+
+    assert tuner.read_size == 512 * 1024
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) > buffer
+    decision = metrics.tuning[-1]
+    assert (decision["read_size"], decision["throughput"], decision["bdp"]) == (512 * 1024, 10 ** 8, 5 * 10 ** 6)
+    assert decision["send_buffer_requested"] == 10 ** 7
+
+    clock.now += 0.5
+    assert not tuner.sample(60 * 10 ** 6)  # Slower now; the best throughput still stands
+    assert tuner.read_size == 512 * 1024
+
+def test_nothing_changes_without_an_rtt(sock, clock):
+    tuner = PathTuner(sock, MIN_READ_SIZE, interval=0.5)
+    clock.now += 1
+    assert not tuner.sample(10 ** 9)
+    assert tuner.read_size == MIN_READ_SIZE
+
+def test_receiving_side_only_grows_its_buffer(sock, clock):
+    metrics = TransferMetrics()
+    tuner = PathTuner(sock, None, metrics, rtt=0.05, buffer_option=socket.SO_RCVBUF, interval=0.5)
+    clock.now += 0.5
+    assert tuner.sample(50 * 10 ** 6)
+    assert tuner.read_size is None
+    assert "receive_buffer" in metrics.tuning[-1] and "read_size" not in metrics.tuning[-1]
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="TCP_INFO is read on Linux only")
+def test_kernel_rtt_of_a_tcp_connection():
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        with socket.create_connection(server.getsockname()) as client:
+            conn, _ = server.accept()
+            with conn:
+                assert 0 < tcp_rtt(client) < 1